@@ -0,0 +1,139 @@
+# backend/api/async_views.py
+
+import json
+import traceback
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from django.urls import reverse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from core.models import StudentAnswer
+from .ocr_engines import OCR_ENGINES
+from .serializers import StudentAnswerEvaluationSerializer, GradingJobSerializer
+from .model_answers import generate_model_answer_cached_async
+from .services import read_image
+from .tasks import ocr_answer_async, mark_answer_async, enqueue_grading_job
+
+# Async versions of run-ocr, run-marking and generate-model-answer. Under an
+# ASGI server (e.g. `uvicorn config.asgi:application`) a request waiting on
+# Gemini or Vision doesn't hold a worker thread, so one worker can serve
+# hundreds of slow AI calls at once. They take the same parameters and return
+# the same bodies as the DRF views in views.py.
+
+
+# --- HELPERS ---
+
+def request_data(request):
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body or b"{}")
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+    return request.POST
+
+def option(request, data, name, default=''):
+    return request.GET.get(name, data.get(name, default))
+
+def flag(request, data, name):
+    # True for ?<name>=true (or "<name>": true in the body), as query_flag in views.py.
+    return str(option(request, data, name)).lower() in ('1', 'true', 'yes')
+
+async def get_answer(pk):
+    try:
+        return await StudentAnswer.objects.select_related(
+            'question__test__marking_principle', 'student__class_group'
+        ).aget(pk=pk)
+    except StudentAnswer.DoesNotExist:
+        return None
+
+@sync_to_async
+def serialize_answer(request, answer):
+    return StudentAnswerEvaluationSerializer(answer, context={'request': request}).data
+
+@sync_to_async
+def queue_job(request, answer, kind, **payload):
+    job = enqueue_grading_job(answer, kind, **payload)
+    data = GradingJobSerializer(job).data
+    data['job_url'] = request.build_absolute_uri(reverse('gradingjob-detail', args=[job.id]))
+    return data
+
+def invalid_body():
+    return JsonResponse({"error": "The request body must be a JSON object."}, status=400)
+
+def answer_not_found():
+    return JsonResponse({"detail": "No StudentAnswer matches the given query."}, status=404)
+
+
+# --- VIEWS ---
+
+@csrf_exempt
+@require_POST
+async def run_ocr_async_view(request, pk):
+    data = request_data(request)
+    if data is None:
+        return invalid_body()
+    answer = await get_answer(pk)
+    if answer is None:
+        return answer_not_found()
+    if not answer.uploaded_image:
+        return JsonResponse({"detail": "No image found for this answer."}, status=400)
+    # force=true skips the OCR cache; ?engine= picks the OCR engine for this request.
+    force = flag(request, data, 'force')
+    engine = option(request, data, 'engine') or None
+    if engine and engine not in OCR_ENGINES:
+        return JsonResponse({"error": f"Unknown OCR engine '{engine}'. Choose one of: {', '.join(OCR_ENGINES)}."},
+                            status=400)
+    if flag(request, data, 'async'):
+        return JsonResponse(await queue_job(request, answer, 'ocr', force=force, engine=engine), status=202)
+    try:
+        await ocr_answer_async(answer, force=force, engine=engine)
+        return JsonResponse(await serialize_answer(request, answer))
+    except Exception as e:
+        traceback.print_exc()
+        return JsonResponse({"detail": f"OCR failed: {str(e)}"}, status=500)
+
+@csrf_exempt
+@require_POST
+async def run_marking_async_view(request, pk):
+    data = request_data(request)
+    if data is None:
+        return invalid_body()
+    answer = await get_answer(pk)
+    if answer is None:
+        return answer_not_found()
+    corrected_text = data.get('corrected_text', answer.ocr_text)
+    # force=true skips the evaluation cache and always asks the AI again.
+    force = flag(request, data, 'force')
+    if flag(request, data, 'async'):
+        job = await queue_job(request, answer, 'marking', corrected_text=corrected_text, force=force)
+        return JsonResponse(job, status=202)
+    try:
+        await mark_answer_async(answer, corrected_text, use_cache=not force)
+        return JsonResponse(await serialize_answer(request, answer))
+    except Exception as e:
+        traceback.print_exc()
+        return JsonResponse({"detail": f"AI Marking failed: {str(e)}"}, status=500)
+
+@csrf_exempt
+@require_POST
+async def generate_model_answer_async_view(request):
+    data = request_data(request)
+    if data is None:
+        return invalid_body()
+    description = data.get('description', '')
+    marking_scheme = data.get('marking_scheme', '')
+    question_image = request.FILES.get('question_image')
+    if not description or not marking_scheme:
+        return JsonResponse({"error": "Description and marking scheme are required."}, status=400)
+    if question_image and question_image.size > settings.MODEL_ANSWER_IMAGE_MAX_BYTES:
+        return JsonResponse({"error": f"The image is larger than {settings.MODEL_ANSWER_IMAGE_MAX_BYTES} bytes."},
+                            status=400)
+    # The image goes to Gemini straight from the upload; nothing is written to storage.
+    image_content = await sync_to_async(read_image)(question_image) if question_image else None
+    result = await generate_model_answer_cached_async(description, marking_scheme, image_content,
+                                                      use_cache=not flag(request, data, 'force'))
+    return JsonResponse(result)
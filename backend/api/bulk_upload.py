@@ -0,0 +1,240 @@
+# backend/api/bulk_upload.py
+
+import csv
+import hashlib
+import io
+import os
+import re
+import tarfile
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from core.models import StudentAnswer
+from .scripts import prepare_page, store_answer_image, delete_stored_images, set_new_image, save_answers
+from .tasks import enqueue_grading_jobs
+
+# A whole class's scans in one ZIP or tar. Entries are read one at a time
+# from the uploaded archive (which Django has already spooled to a temporary
+# file), preprocessed and written to storage on a few threads, so memory
+# holds a handful of scans whatever the archive size. Answers are then
+# created or updated in bulk.
+#
+# Each scan is matched to a student and a question by a manifest CSV
+# ("file,student,question": the path in the archive, the student's id or
+# name, the question number), uploaded alongside or as manifest.csv in the
+# archive, or else by its path: "<student>/Q<n>.jpg" or "<student>_Q<n>.jpg".
+
+MANIFEST_NAME = 'manifest.csv'
+FILENAME_PATTERN = re.compile(r"^(?P<student>.+?)[\s_\-/]+q(?:uestion)?[\s_\-]*(?P<question>\d+)$", re.IGNORECASE)
+MANIFEST_COLUMNS = {
+    'file': ('file', 'filename', 'path'),
+    'student': ('student', 'student_id', 'student_name'),
+    'question': ('question', 'q_number', 'q'),
+}
+
+
+class BulkUploadError(Exception):
+    """An archive or manifest that can't be used at all; the message is safe to show the user."""
+
+
+# --- READING THE ARCHIVE ---
+
+def archive_entries(archive):
+    """
+    Yields (name, size, open) for every file in a ZIP or tar (optionally
+    compressed) archive. Nothing is read until open() is called.
+    """
+    archive.seek(0)
+    if zipfile.is_zipfile(archive):
+        archive.seek(0)
+        with zipfile.ZipFile(archive) as zip_file:
+            for info in zip_file.infolist():
+                if not info.is_dir():
+                    yield info.filename, info.file_size, lambda info=info: zip_file.open(info)
+        return
+    archive.seek(0)
+    try:
+        tar_file = tarfile.open(fileobj=archive, mode='r:*')
+    except tarfile.TarError:
+        raise BulkUploadError("The archive must be a ZIP or tar file.")
+    with tar_file:
+        # Iterating reads one member header at a time.
+        for member in tar_file:
+            if member.isfile():
+                yield member.name, member.size, lambda member=member: tar_file.extractfile(member)
+
+def is_scan_entry(name):
+    base_name = os.path.basename(name)
+    return not (name.startswith('__MACOSX/') or base_name.startswith('.') or base_name.lower() == MANIFEST_NAME)
+
+def read_entry(size, open_entry):
+    """The entry's bytes, refusing anything over BULK_UPLOAD_MAX_FILE_BYTES whatever its header claims."""
+    limit = settings.BULK_UPLOAD_MAX_FILE_BYTES
+    if size > limit:
+        return None
+    with open_entry() as f:
+        data = f.read(limit + 1)
+    return data if len(data) <= limit else None
+
+
+# --- MATCHING SCANS TO ANSWERS ---
+
+def read_manifest(text):
+    """{archive path: (student, question)} from manifest CSV text."""
+    reader = csv.DictReader(io.StringIO(text.lstrip('\ufeff')))
+    headers = {(name or '').strip().lower(): name for name in reader.fieldnames or []}
+    columns = {}
+    for column, aliases in MANIFEST_COLUMNS.items():
+        found = next((headers[alias] for alias in aliases if alias in headers), None)
+        if found is None:
+            raise BulkUploadError(f"The manifest needs a '{column}' column.")
+        columns[column] = found
+    return {
+        normalise_path(row[columns['file']] or ''): ((row[columns['student']] or '').strip(),
+                                                     (row[columns['question']] or '').strip())
+        for row in reader
+    }
+
+def find_manifest(archive):
+    for name, size, open_entry in archive_entries(archive):
+        if os.path.basename(name).lower() == MANIFEST_NAME:
+            data = read_entry(size, open_entry)
+            if data is None:
+                raise BulkUploadError("manifest.csv is too large.")
+            return data.decode('utf-8-sig')
+    return None
+
+def normalise_path(name):
+    return name.strip().replace('\\', '/').lstrip('./')
+
+class AnswerMatcher:
+    """Resolves a (student, question) reference to the test's Question and Student rows."""
+
+    def __init__(self, test):
+        self.questions = {str(question.q_number): question for question in test.questions.all()}
+        self.students_by_id, self.students_by_name = {}, {}
+        for student in test.class_group.students.all():
+            self.students_by_id[str(student.id)] = student
+            # A name shared by two students can't be used; they need ids in the manifest.
+            key = student.name.strip().casefold()
+            self.students_by_name[key] = None if key in self.students_by_name else student
+
+    def match(self, student_ref, question_ref):
+        """(student, question), or raises ValueError with the reason."""
+        question = self.questions.get(question_ref.lstrip('Qq').lstrip('0') or '0')
+        if question is None:
+            raise ValueError(f"no question {question_ref} in this test")
+        student = self.students_by_id.get(student_ref)
+        if student is None:
+            key = student_ref.replace('_', ' ').strip().casefold()
+            if key in self.students_by_name and self.students_by_name[key] is None:
+                raise ValueError(f"more than one student is called '{student_ref}'")
+            student = self.students_by_name.get(key) or self.students_by_name.get(student_ref.strip().casefold())
+        if student is None:
+            raise ValueError(f"no student '{student_ref}' in this class")
+        return student, question
+
+def reference_from_path(name):
+    """(student, question) from "<student>/Q<n>.jpg" or "<student>_Q<n>.jpg", or None."""
+    match = FILENAME_PATTERN.match(os.path.splitext(normalise_path(name))[0])
+    return (match.group('student').split('/')[-1], match.group('question')) if match else None
+
+
+# --- INGEST ---
+
+def process_scan(base_name, data):
+    """Runs on a worker thread: preprocesses the scan and writes it to storage."""
+    content, extension = prepare_page(data)
+    stored_name = store_answer_image(f"{base_name}.{extension}", content)
+    return stored_name, hashlib.sha256(content).hexdigest()
+
+def ingest_archive(test, archive, manifest=None, queue_ocr=False, engine=None):
+    """
+    Stores every scan in the archive as the answer of the student and
+    question it maps to, creating or replacing answers in one transaction.
+    manifest is CSV text; by default manifest.csv in the archive, else file
+    names are used. With queue_ocr, an OCR job is queued for each answer.
+    Returns counts and the entries that were skipped, with the reason.
+    """
+    if manifest is None:
+        manifest = find_manifest(archive)
+    references = read_manifest(manifest) if manifest is not None else None
+    matcher = AnswerMatcher(test)
+    skipped, targets, stored = [], {}, {}
+    pending = deque()
+
+    def collect(future_entry):
+        future, name, key = future_entry
+        try:
+            stored[key] = (name, *future.result())
+        except Exception as e:
+            skipped.append({'file': name, 'reason': f"not a readable image ({e})"})
+
+    entry_count = 0
+    try:
+        with ThreadPoolExecutor(max_workers=settings.BULK_UPLOAD_WORKERS, thread_name_prefix='bulk-upload') as pool:
+            for name, size, open_entry in archive_entries(archive):
+                if not is_scan_entry(name):
+                    continue
+                entry_count += 1
+                if entry_count > settings.BULK_UPLOAD_MAX_FILES:
+                    raise BulkUploadError(f"An archive can hold at most {settings.BULK_UPLOAD_MAX_FILES} scans.")
+                path = normalise_path(name)
+                if references is None:
+                    reference = reference_from_path(path)
+                else:
+                    reference = references.get(path) or references.get(os.path.basename(path))
+                if reference is None:
+                    skipped.append({'file': name, 'reason': "not in the manifest" if references is not None
+                                    else "the file name doesn't give the student and question"})
+                    continue
+                try:
+                    student, question = matcher.match(*reference)
+                except ValueError as e:
+                    skipped.append({'file': name, 'reason': str(e)})
+                    continue
+                key = (student.id, question.id)
+                if key in targets:
+                    skipped.append({'file': name, 'reason': f"{targets[key]} is also {student.name}'s "
+                                                            f"answer to Q{question.q_number}"})
+                    continue
+                data = read_entry(size, open_entry)
+                if data is None:
+                    skipped.append({'file': name, 'reason': "larger than the maximum scan size"})
+                    continue
+                targets[key] = name
+                future = pool.submit(process_scan, f"bulk_{student.id}_q{question.q_number}", data)
+                pending.append((future, name, key))
+                # Keep only a few scans in memory: wait for the oldest before reading far ahead.
+                while len(pending) > settings.BULK_UPLOAD_WORKERS * 2:
+                    collect(pending.popleft())
+            while pending:
+                collect(pending.popleft())
+    except Exception:
+        # Leaving the pool waited for the scans in flight; remove everything already stored.
+        while pending:
+            collect(pending.popleft())
+        delete_stored_images([stored_name for _, stored_name, _ in stored.values()])
+        raise
+
+    existing = {
+        (answer.student_id, answer.question_id): answer
+        for answer in StudentAnswer.objects.filter(question__test=test, student_id__in={s for s, _ in stored})
+    }
+    new, updated = [], []
+    for (student_id, question_id), (_, stored_name, image_sha256) in stored.items():
+        answer = existing.get((student_id, question_id))
+        if answer is None:
+            answer = StudentAnswer(student_id=student_id, question_id=question_id)
+            new.append(answer)
+        else:
+            updated.append(answer)
+        set_new_image(answer, stored_name, image_sha256)
+    # Thumbnails are made lazily by the rendition view; making a thousand here would hold up the request.
+    save_answers(new, updated, renditions=False, batch_size=500)
+
+    ocr_jobs = enqueue_grading_jobs(new + updated, 'ocr', force=False, engine=engine) if queue_ocr else 0
+    return {'created': len(new), 'updated': len(updated), 'skipped': skipped, 'ocr_jobs_queued': ocr_jobs}
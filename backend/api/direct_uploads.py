@@ -0,0 +1,110 @@
+# backend/api/direct_uploads.py
+
+import io
+import uuid
+
+from django.conf import settings
+from django.core import signing
+from PIL import Image
+
+from core.models import StudentAnswer
+from .scripts import set_new_image, save_answers
+from .storage_io import file_info, presigned_put, read_file
+
+# Answer images uploaded straight to the bucket. The client asks for an
+# upload URL, PUTs the image to it and then confirms; the server checks the
+# stored object and only then creates or updates the StudentAnswer. The image
+# bytes never pass through a web worker. (The bucket's CORS rules must allow
+# PUT from the app's origin.) The upload token is signed, so a confirm can
+# only attach the object that was handed out for that student and question.
+#
+# With local media storage there is nothing to sign, so the upload URL points
+# at direct_upload_view, which writes the body to storage itself.
+
+UPLOAD_TOKEN_SALT = 'api.direct_uploads'
+IMAGE_CONTENT_TYPES = {'image/jpeg': 'jpg', 'image/png': 'png', 'image/webp': 'webp'}
+# Enough of the file for Pillow to recognise the image format.
+SNIFF_BYTES = 64 * 1024
+
+
+class DirectUploadError(Exception):
+    """A direct upload that can't be started or confirmed; the message is safe to show the user."""
+
+
+def answer_storage():
+    return StudentAnswer._meta.get_field('uploaded_image').storage
+
+def start_upload(student, question, content_type, local_upload_url):
+    """
+    Reserves a storage name for a new answer image and returns where and how
+    to upload it. local_upload_url(token) builds the fallback URL for storage
+    that can't sign uploads.
+    """
+    if content_type not in IMAGE_CONTENT_TYPES:
+        raise DirectUploadError(f"content_type must be one of: {', '.join(IMAGE_CONTENT_TYPES)}.")
+    name = f"student_answers/direct/{uuid.uuid4().hex}.{IMAGE_CONTENT_TYPES[content_type]}"
+    token = signing.dumps({'name': name, 'student': student.id, 'question': question.id,
+                           'content_type': content_type}, salt=UPLOAD_TOKEN_SALT)
+    expires_in = settings.DIRECT_UPLOAD_EXPIRY_SECONDS
+    upload = presigned_put(answer_storage(), name, content_type, expires_in)
+    if upload is None:
+        upload = {'url': local_upload_url(token), 'method': 'PUT', 'headers': {'Content-Type': content_type}}
+    return {'upload_token': token, **upload, 'expires_in': expires_in,
+            'max_bytes': settings.DIRECT_UPLOAD_MAX_BYTES}
+
+def read_token(token):
+    """The upload the token was issued for. Tokens stay valid a little past the URL's expiry to allow a slow confirm."""
+    try:
+        return signing.loads(token, salt=UPLOAD_TOKEN_SALT, max_age=settings.DIRECT_UPLOAD_EXPIRY_SECONDS + 300)
+    except signing.SignatureExpired:
+        raise DirectUploadError("The upload token has expired; ask for a new upload URL.")
+    except signing.BadSignature:
+        raise DirectUploadError("Invalid upload token.")
+
+def confirm_upload(token):
+    """
+    Checks the uploaded object (it exists, isn't too large and is an image)
+    and creates or updates the answer to point at it. An object that fails
+    the checks is deleted. Returns the answer.
+    """
+    upload = read_token(token)
+    storage, name = answer_storage(), upload['name']
+    info = file_info(storage, name)
+    if info is None:
+        raise DirectUploadError("Nothing has been uploaded for this token yet.")
+    try:
+        if info['size'] > settings.DIRECT_UPLOAD_MAX_BYTES:
+            raise DirectUploadError(f"The image is larger than {settings.DIRECT_UPLOAD_MAX_BYTES} bytes.")
+        try:
+            image_format = Image.open(io.BytesIO(read_file(storage, name, length=SNIFF_BYTES))).format
+        except Exception:
+            image_format = None
+        if image_format not in ('JPEG', 'MPO', 'PNG', 'WEBP'):
+            raise DirectUploadError("The uploaded file is not a JPEG, PNG or WebP image.")
+    except DirectUploadError:
+        storage.delete(name)
+        raise
+
+    answer = StudentAnswer.objects.filter(student_id=upload['student'], question_id=upload['question']).first()
+    if answer is not None and answer.uploaded_image.name == name:
+        return answer  # Already confirmed.
+    new, updated = [], []
+    if answer is None:
+        answer = StudentAnswer(student_id=upload['student'], question_id=upload['question'])
+        new.append(answer)
+    else:
+        updated.append(answer)
+    # No hash yet: OCR computes it from the bytes it downloads anyway, so confirming reads only the first few KB.
+    set_new_image(answer, name, "")
+    # Renditions are left to the lazy rendition view rather than downloaded here.
+    save_answers(new, updated, renditions=False)
+    return answer
+
+def store_local_upload(token, stream, size):
+    """direct_upload_view's half of the flow: writes a PUT body to storage under the token's name."""
+    upload = read_token(token)
+    if size > settings.DIRECT_UPLOAD_MAX_BYTES:
+        raise DirectUploadError(f"The image is larger than {settings.DIRECT_UPLOAD_MAX_BYTES} bytes.")
+    storage = answer_storage()
+    storage.delete(upload['name'])  # A repeated PUT replaces the earlier one.
+    storage.save(upload['name'], stream)
@@ -0,0 +1,264 @@
+# backend/api/evaluation_cache.py
+
+import hashlib
+import itertools
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError
+from django.db.models import F
+from django.utils import timezone
+
+from core.models import CacheLookupStats, EvaluationCacheEntry
+from .services import (GEMINI_MODEL_NAME, build_evaluation_prompt, evaluate_answer_with_ai,
+                       evaluate_answer_with_ai_async, evaluate_answers_batch_with_ai)
+
+# Evaluations and generated model answers (api/model_answers.py) are cached
+# in separate namespaces, each with its own backend, size limit, TTL and stats.
+#
+# Hit/miss counters live in the CacheLookupStats table, so every worker
+# process reports into the same numbers even when the cache itself is a
+# per-process backend like LocMemCache.
+# Writes to the 'db' store by this process, for evicting every N writes.
+_db_writes = itertools.count(1)
+
+
+# --- STORES ---
+
+class DatabaseEvaluationStore:
+    """
+    Keeps evaluations in the EvaluationCacheEntry table with TTL and LRU
+    eviction. Expired entries are misses as soon as they expire, but
+    eviction only runs every evict_every writes (or from
+    `manage.py prune_evaluation_cache`), so a write is normally one query.
+    """
+    name = 'db'
+
+    def __init__(self, ttl, max_entries, evict_every=0, namespace='evaluation'):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self.namespace = namespace
+
+    @property
+    def entries(self):
+        return EvaluationCacheEntry.objects.filter(namespace=self.namespace)
+
+    def get(self, key):
+        entry = self.entries.filter(key=key).first()
+        if entry is None:
+            return None
+        now = timezone.now()
+        if self.ttl and entry.created_at < now - timedelta(seconds=self.ttl):
+            entry.delete()
+            return None
+        EvaluationCacheEntry.objects.filter(pk=entry.pk).update(
+            last_used_at=now, hit_count=F('hit_count') + 1
+        )
+        return entry.result
+
+    def set(self, key, result, model_name):
+        # update-then-insert: update_or_create's locking transaction fails on
+        # SQLite when parallel workers store the same key. A rewritten entry
+        # is new again, so its TTL restarts.
+        now = timezone.now()
+        values = {'result': result, 'model_name': model_name, 'created_at': now, 'last_used_at': now}
+        if not self.entries.filter(key=key).update(**values):
+            try:
+                EvaluationCacheEntry.objects.create(key=key, namespace=self.namespace, **values)
+            except IntegrityError:
+                pass
+        if self.evict_every and next(_db_writes) % self.evict_every == 0:
+            self.evict()
+
+    def evict(self):
+        """Deletes expired entries, then the least recently used above max_entries. Returns how many."""
+        deleted = 0
+        if self.ttl:
+            cutoff = timezone.now() - timedelta(seconds=self.ttl)
+            deleted += self.entries.filter(created_at__lt=cutoff).delete()[0]
+        if self.max_entries:
+            # The most recently used entry past the limit, and everything used
+            # no later than it (so entries tied with it go too).
+            boundary = self.entries.order_by('-last_used_at').values_list(
+                'last_used_at', flat=True
+            )[self.max_entries:self.max_entries + 1]
+            boundary = list(boundary)
+            if boundary:
+                deleted += self.entries.filter(last_used_at__lte=boundary[0]).delete()[0]
+        return deleted
+
+    def count(self):
+        return self.entries.count()
+
+
+class DjangoCacheEvaluationStore:
+    """Keeps evaluations in one of the configured Django cache backends."""
+
+    def __init__(self, alias, ttl, namespace='evaluation'):
+        self.name = alias
+        self.ttl = ttl or None
+        self.namespace = namespace
+
+    def get(self, key):
+        return caches[self.name].get(f"{self.namespace}:{key}")
+
+    def set(self, key, result, model_name):
+        # Size limits and eviction are left to the backend (e.g. MAX_ENTRIES in CACHES).
+        caches[self.name].set(f"{self.namespace}:{key}", result, timeout=self.ttl)
+
+    def count(self):
+        return None
+
+
+def build_store(backend, ttl, max_entries, namespace):
+    if backend == 'off':
+        return None
+    if backend == 'db':
+        return DatabaseEvaluationStore(ttl, max_entries, settings.EVALUATION_CACHE_EVICT_EVERY, namespace)
+    return DjangoCacheEvaluationStore(backend, ttl, namespace)
+
+def get_store():
+    """Returns the configured evaluation store, or None when caching is switched off."""
+    return build_store(settings.EVALUATION_CACHE_BACKEND, settings.EVALUATION_CACHE_TTL,
+                       settings.EVALUATION_CACHE_MAX_ENTRIES, 'evaluation')
+
+def get_model_answer_store():
+    """Returns the configured model answer store, or None when it's switched off."""
+    if not settings.MODEL_ANSWER_CACHE:
+        return None
+    return build_store(settings.MODEL_ANSWER_CACHE_BACKEND, settings.MODEL_ANSWER_CACHE_TTL,
+                       settings.MODEL_ANSWER_CACHE_MAX_ENTRIES, 'model_answer')
+
+
+# --- PUBLIC HELPERS ---
+
+def make_cache_key(prompt, model_name=GEMINI_MODEL_NAME):
+    return hashlib.sha256(f"{model_name}\0{prompt}".encode('utf-8')).hexdigest()
+
+def count_lookup(stat, namespace='evaluation'):
+    """Records a 'hits' or 'misses' for the namespace."""
+    counters = CacheLookupStats.objects.filter(namespace=namespace)
+    if not counters.update(**{stat: F(stat) + 1}):
+        # First lookup ever; another process may be creating the row too.
+        CacheLookupStats.objects.get_or_create(namespace=namespace)
+        counters.update(**{stat: F(stat) + 1})
+
+def _namespace_stats(namespace, backend, store):
+    counters = CacheLookupStats.objects.filter(namespace=namespace).first()
+    hits, misses = (counters.hits, counters.misses) if counters else (0, 0)
+    return {
+        'backend': backend,
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / (hits + misses), 3) if hits + misses else None,
+        'entries': store.count() if store else 0,
+    }
+
+def get_stats():
+    """Evaluation cache stats, with the model answer cache's under 'model_answers'."""
+    model_answer_store = get_model_answer_store()
+    return {
+        **_namespace_stats('evaluation', settings.EVALUATION_CACHE_BACKEND, get_store()),
+        'model_answers': _namespace_stats(
+            'model_answer', model_answer_store.name if model_answer_store else 'off', model_answer_store
+        ),
+    }
+
+def evaluate_answer_cached(student_answer_text, model_answer, marking_scheme, max_mark,
+                           marking_principles="", use_cache=True):
+    """
+    Same as evaluate_answer_with_ai, but identical prompts are answered from
+    the cache instead of calling Gemini again. Failed evaluations are never cached.
+    """
+    store = get_store() if use_cache else None
+    if store is None:
+        return evaluate_answer_with_ai(student_answer_text, model_answer, marking_scheme,
+                                       max_mark, marking_principles)
+
+    prompt = build_evaluation_prompt(student_answer_text, model_answer, marking_scheme,
+                                     max_mark, marking_principles)
+    key = make_cache_key(prompt)
+    started = time.perf_counter()
+    result = store.get(key)
+    if result is not None:
+        count_lookup('hits')
+        return _cache_hit(result, started)
+
+    count_lookup('misses')
+    result = evaluate_answer_with_ai(student_answer_text, model_answer, marking_scheme,
+                                     max_mark, marking_principles)
+    if not result.get('failed'):
+        store.set(key, _cacheable(result), GEMINI_MODEL_NAME)
+    return result
+
+async def evaluate_answer_cached_async(student_answer_text, model_answer, marking_scheme, max_mark,
+                                       marking_principles="", use_cache=True):
+    """Async evaluate_answer_cached. The store is synchronous, so its calls run in a worker thread."""
+    store = get_store() if use_cache else None
+    if store is None:
+        return await evaluate_answer_with_ai_async(student_answer_text, model_answer, marking_scheme,
+                                                   max_mark, marking_principles)
+
+    prompt = build_evaluation_prompt(student_answer_text, model_answer, marking_scheme,
+                                     max_mark, marking_principles)
+    key = make_cache_key(prompt)
+    started = time.perf_counter()
+    result = await sync_to_async(store.get)(key)
+    if result is not None:
+        await sync_to_async(count_lookup)('hits')
+        return _cache_hit(result, started)
+
+    await sync_to_async(count_lookup)('misses')
+    result = await evaluate_answer_with_ai_async(student_answer_text, model_answer, marking_scheme,
+                                                 max_mark, marking_principles)
+    if not result.get('failed'):
+        await sync_to_async(store.set)(key, _cacheable(result), GEMINI_MODEL_NAME)
+    return result
+
+def evaluate_answers_batch_cached(answers, model_answer, marking_scheme, max_mark, marking_principles="",
+                                  use_cache=True):
+    """
+    Same as evaluate_answers_batch_with_ai, but answers whose single-answer
+    prompt is cached are answered from the cache and left out of the batches.
+    New results are stored under the same keys, so a later single-answer
+    evaluation reuses them too. Failed evaluations are never cached.
+    """
+    store = get_store() if use_cache else None
+    if store is None:
+        return evaluate_answers_batch_with_ai(answers, model_answer, marking_scheme, max_mark, marking_principles)
+
+    keys = {
+        answer_id: make_cache_key(build_evaluation_prompt(text, model_answer, marking_scheme,
+                                                          max_mark, marking_principles))
+        for answer_id, text in answers.items()
+    }
+    results = {}
+    for answer_id, key in keys.items():
+        started = time.perf_counter()
+        result = store.get(key)
+        count_lookup('misses' if result is None else 'hits')
+        if result is not None:
+            results[answer_id] = _cache_hit(result, started)
+
+    missing = {answer_id: text for answer_id, text in answers.items() if answer_id not in results}
+    if missing:
+        fresh = evaluate_answers_batch_with_ai(missing, model_answer, marking_scheme, max_mark, marking_principles)
+        for answer_id, result in fresh.items():
+            if not result.get('failed'):
+                store.set(keys[answer_id], _cacheable(result), GEMINI_MODEL_NAME)
+        results.update(fresh)
+    return results
+
+def _cache_hit(result, started):
+    # A cache hit spends no tokens.
+    usage = {'input_tokens': 0, 'output_tokens': 0,
+             'latency_ms': round((time.perf_counter() - started) * 1000, 1), 'cached': True}
+    return {**result, 'usage': usage}
+
+def _cacheable(result):
+    # Usage describes one call, not the evaluation, so it isn't cached.
+    return {k: v for k, v in result.items() if k != 'usage'}
@@ -0,0 +1,18 @@
+# backend/api/filters.py
+
+from django_filters import rest_framework as filters
+
+from core.models import StudentAnswer
+
+
+class StudentAnswerFilter(filters.FilterSet):
+    # ?test=<id> is shorthand for ?question__test=<id>. Plain number filters
+    # don't look the related row up first, so filtering adds no queries.
+    test = filters.NumberFilter(field_name='question__test')
+    question__test = filters.NumberFilter(field_name='question__test')
+    student = filters.NumberFilter(field_name='student')
+    question = filters.NumberFilter(field_name='question')
+
+    class Meta:
+        model = StudentAnswer
+        fields = ['test', 'question__test', 'student', 'question', 'is_evaluated']
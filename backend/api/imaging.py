@@ -0,0 +1,160 @@
+# backend/api/imaging.py
+
+import io
+import os
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps, ImageStat
+
+# Deskew search range and step, in degrees. Phone photos of a page on a desk
+# are rarely more than a few degrees off.
+DESKEW_MAX_ANGLE = 5.0
+DESKEW_STEP = 0.5
+# Width of the small copy used to estimate skew and the content box.
+ANALYSIS_WIDTH = 400
+# Cropping must never cut off writing, however faint. Otsu's threshold
+# separates the paper from the darkest ink; for the crop, ink is anything
+# darker than the paper by CROP_PAPER_DEVIATIONS of its standard deviation
+# (and at least CROP_MIN_CONTRAST grey levels), so light pencil on a page
+# that also has dark ink still counts. A crop that would remove more than
+# CROP_MAX_REMOVED of the page is not trusted and the page is kept whole.
+CROP_PAPER_DEVIATIONS = 3
+CROP_MIN_CONTRAST = 16
+CROP_MAX_REMOVED = 0.5
+IMAGE_EXTENSIONS = {'JPEG': 'jpg', 'WEBP': 'webp', 'PNG': 'png'}
+
+
+# --- PIPELINE STEPS ---
+
+def _ink_mask(gray):
+    """White where there is writing, black elsewhere."""
+    threshold = ImageStat.Stat(gray).mean[0] * 0.75
+    return gray.point(lambda p: 255 if p < threshold else 0)
+
+def otsu_threshold(gray):
+    """The grey level that best splits the image into dark (ink) and light (paper) pixels."""
+    histogram = gray.histogram()
+    total, weighted_total = sum(histogram), sum(level * count for level, count in enumerate(histogram))
+    best_level, best_variance = 0, -1.0
+    dark_count = dark_sum = 0
+    for level, count in enumerate(histogram):
+        dark_count += count
+        dark_sum += level * count
+        light_count = total - dark_count
+        if not dark_count or not light_count:
+            continue
+        dark_mean, light_mean = dark_sum / dark_count, (weighted_total - dark_sum) / light_count
+        variance = dark_count * light_count * (dark_mean - light_mean) ** 2
+        if variance > best_variance:
+            best_level, best_variance = level, variance
+    return best_level
+
+def _crop_mask(gray):
+    """A lenient _ink_mask for cropping: faint strokes count as writing."""
+    otsu = otsu_threshold(gray)
+    paper = list(enumerate(gray.histogram()))[otsu + 1:]
+    count = sum(n for _, n in paper)
+    if not count:
+        return gray.point(lambda p: 0)  # One flat colour: nothing to crop to.
+    mean = sum(level * n for level, n in paper) / count
+    deviation = (sum((level - mean) ** 2 * n for level, n in paper) / count) ** 0.5
+    threshold = mean - max(CROP_PAPER_DEVIATIONS * deviation, CROP_MIN_CONTRAST)
+    return gray.point(lambda p: 255 if p < threshold else 0)
+
+def _row_profile_score(mask):
+    # Text lines that run straight across give sharp peaks and gaps in the
+    # per-row ink totals, so the straightest rotation has the largest variance.
+    rows = mask.resize((1, mask.height), Image.Resampling.BOX)
+    return ImageStat.Stat(rows).var[0]
+
+def estimate_skew(gray):
+    """Returns the rotation (degrees) that best straightens the text lines."""
+    scale = ANALYSIS_WIDTH / gray.width
+    small = gray.resize((ANALYSIS_WIDTH, max(1, int(gray.height * scale))), Image.Resampling.BILINEAR)
+    mask = _ink_mask(small)
+    best_angle, best_score = 0.0, _row_profile_score(mask)
+    steps = int(DESKEW_MAX_ANGLE / DESKEW_STEP)
+    for step in range(-steps, steps + 1):
+        angle = step * DESKEW_STEP
+        if angle == 0:
+            continue
+        score = _row_profile_score(mask.rotate(angle, resample=Image.Resampling.BILINEAR, fillcolor=0))
+        if score > best_score:
+            best_angle, best_score = angle, score
+    return best_angle
+
+def crop_to_content(gray, margin=0.02):
+    """
+    Trims empty borders around the writing, keeping a small margin. The
+    page is returned uncropped when the crop would remove more than
+    CROP_MAX_REMOVED of it.
+    """
+    bbox = _crop_mask(gray).getbbox()
+    if not bbox:
+        return gray
+    pad_x, pad_y = int(gray.width * margin), int(gray.height * margin)
+    left, top, right, bottom = bbox
+    box = (max(0, left - pad_x), max(0, top - pad_y), min(gray.width, right + pad_x), min(gray.height, bottom + pad_y))
+    kept = (box[2] - box[0]) * (box[3] - box[1]) / (gray.width * gray.height)
+    if kept < 1 - CROP_MAX_REMOVED:
+        return gray
+    return gray.crop(box)
+
+def preprocess_image(data):
+    """
+    Prepares a scan for OCR: EXIF auto-orientation, grayscale, downscale to
+    OCR_MAX_DIMENSION, deskew, crop to the writing and recompress.
+    Takes and returns bytes; the second value is the file extension to use.
+    """
+    image = Image.open(io.BytesIO(data))
+    image = ImageOps.exif_transpose(image)
+    gray = image.convert('L')
+    gray.thumbnail((settings.OCR_MAX_DIMENSION, settings.OCR_MAX_DIMENSION), Image.Resampling.LANCZOS)
+
+    angle = estimate_skew(gray)
+    if angle:
+        gray = gray.rotate(angle, resample=Image.Resampling.BICUBIC, expand=True, fillcolor=255)
+    gray = crop_to_content(gray)
+    gray = ImageOps.autocontrast(gray, cutoff=1)
+
+    # Photos compress far better as JPEG/WebP, but clean digital pages
+    # (screenshots, typed sheets) are smaller as grayscale PNG. Keep the smaller.
+    encodings = []
+    for image_format in (settings.OCR_IMAGE_FORMAT.upper(), 'PNG'):
+        output = io.BytesIO()
+        if image_format == 'PNG':
+            gray.save(output, format='PNG', optimize=True)
+        else:
+            gray.save(output, format=image_format, quality=settings.OCR_IMAGE_QUALITY, optimize=True)
+        encodings.append((len(output.getvalue()), output.getvalue(), IMAGE_EXTENSIONS[image_format]))
+    _, data, extension = min(encodings, key=lambda encoding: encoding[0])
+    return data, extension
+
+
+# --- UPLOAD HOOK ---
+
+def prepare_uploaded_image(upload):
+    """
+    Returns the extra save() kwargs for a new answer image: the preprocessed
+    file as uploaded_image and, with KEEP_ORIGINAL_UPLOADS, the untouched
+    upload as original_image. Returns {} when there's nothing to do.
+    """
+    if not upload or not settings.PREPROCESS_UPLOADS:
+        return {}
+    upload.seek(0)
+    original = upload.read()
+    try:
+        processed, extension = preprocess_image(original)
+    except Exception as e:
+        # An image Pillow can't handle is stored as uploaded; Vision may still read it.
+        print(f"Image preprocessing failed, keeping the original: {e}")
+        upload.seek(0)
+        return {}
+    upload.seek(0)
+
+    base_name = os.path.splitext(os.path.basename(upload.name))[0]
+    fields = {'uploaded_image': ContentFile(processed, name=f"{base_name}.{extension}")}
+    if settings.KEEP_ORIGINAL_UPLOADS:
+        fields['original_image'] = upload
+    return fields
@@ -0,0 +1,75 @@
+# backend/api/management/commands/bench_ai_clients.py
+
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import grpc
+from django.core.management.base import BaseCommand
+from google.cloud import vision
+from google.cloud.vision_v1.services.image_annotator.transports import ImageAnnotatorGrpcTransport
+
+from api.services import VISION_CHANNEL_OPTIONS, get_client
+
+
+def start_stub_vision_server():
+    """Starts a local gRPC server that answers Vision OCR calls instantly. Returns (server, address)."""
+    def batch_annotate_images(request, context):
+        return vision.BatchAnnotateImagesResponse(responses=[
+            vision.AnnotateImageResponse(full_text_annotation={'text': 'stub text'})
+            for _ in request.requests
+        ])
+
+    handler = grpc.method_handlers_generic_handler('google.cloud.vision.v1.ImageAnnotator', {
+        'BatchAnnotateImages': grpc.unary_unary_rpc_method_handler(
+            batch_annotate_images,
+            request_deserializer=vision.BatchAnnotateImagesRequest.deserialize,
+            response_serializer=vision.BatchAnnotateImagesResponse.serialize,
+        ),
+    })
+    server = grpc.server(ThreadPoolExecutor(max_workers=8))
+    server.add_generic_rpc_handlers((handler,))
+    port = server.add_insecure_port('127.0.0.1:0')
+    server.start()
+    return server, f'127.0.0.1:{port}'
+
+def build_stub_client(address):
+    channel = grpc.insecure_channel(address, options=VISION_CHANNEL_OPTIONS)
+    return vision.ImageAnnotatorClient(transport=ImageAnnotatorGrpcTransport(channel=channel))
+
+
+class Command(BaseCommand):
+    help = ("Measures per-call OCR latency against a local stub Vision server, "
+            "building a new client for every call versus reusing the pooled client.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=200)
+
+    def handle(self, *args, **options):
+        server, address = start_stub_vision_server()
+        image = vision.Image(content=b'not really an image')
+        try:
+            def fresh_call():
+                client = build_stub_client(address)
+                client.document_text_detection(image=image)
+                client.transport.close()
+
+            def pooled_call():
+                client = get_client(f'bench-vision-{address}', lambda: build_stub_client(address))
+                client.document_text_detection(image=image)
+
+            for label, call in (('new client per call', fresh_call), ('pooled client', pooled_call)):
+                call()  # Warm-up so imports and the stub server don't count.
+                timings = []
+                for _ in range(options['calls']):
+                    start = time.perf_counter()
+                    call()
+                    timings.append((time.perf_counter() - start) * 1000)
+                timings.sort()
+                self.stdout.write(
+                    f"{label:>20}: mean {statistics.mean(timings):.2f} ms, "
+                    f"p50 {timings[len(timings) // 2]:.2f} ms, "
+                    f"p95 {timings[int(len(timings) * 0.95) - 1]:.2f} ms"
+                )
+        finally:
+            server.stop(None)
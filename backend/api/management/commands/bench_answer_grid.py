@@ -0,0 +1,102 @@
+# backend/api/management/commands/bench_answer_grid.py
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.test import APIRequestFactory
+
+from api.views import StudentAnswerViewSet, TestViewSet
+from core.models import Class, Student, Test, Question, StudentAnswer
+
+
+class Command(BaseCommand):
+    help = ("Seeds a large number of answers inside a transaction that is rolled "
+            "back afterwards, then times the grid-status and filtered answer list endpoints.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--answers', type=int, default=100_000)
+        parser.add_argument('--students', type=int, default=30, help="Students per class.")
+        parser.add_argument('--questions', type=int, default=10, help="Questions per test.")
+        parser.add_argument('--runs', type=int, default=20)
+        parser.add_argument('--budget-ms', type=float, default=100.0,
+                            help="Fail if the p95 grid-status latency is above this.")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            test_id = self.seed(options['answers'], options['students'], options['questions'])
+            try:
+                self.measure(test_id, options)
+            finally:
+                # Nothing seeded here is kept.
+                transaction.set_rollback(True)
+
+    def seed(self, answer_count, students_per_class, questions_per_test):
+        per_test = students_per_class * questions_per_test
+        test_count = max(1, answer_count // per_test)
+        start = time.perf_counter()
+
+        classes = Class.objects.bulk_create([Class(name=f"Bench class {i}") for i in range(test_count)])
+        tests = Test.objects.bulk_create([
+            Test(class_group=c, name="Bench test", question_count=questions_per_test) for c in classes
+        ])
+        students = Student.objects.bulk_create([
+            Student(class_group=c, name=f"Student {i}") for c in classes for i in range(students_per_class)
+        ])
+        questions = Question.objects.bulk_create([
+            Question(test=t, q_number=i + 1, model_answer="Model answer", marking_scheme="Scheme")
+            for t in tests for i in range(questions_per_test)
+        ])
+
+        answers = []
+        for index, test in enumerate(tests):
+            test_students = students[index * students_per_class:(index + 1) * students_per_class]
+            test_questions = questions[index * questions_per_test:(index + 1) * questions_per_test]
+            for student in test_students:
+                for question in test_questions:
+                    answers.append(StudentAnswer(
+                        question=question, student=student,
+                        uploaded_image='student_answers/bench.png',
+                        ocr_text="Some recognised text", is_evaluated=bool(student.id % 2),
+                        mark_gained=student.id % 10,
+                    ))
+        StudentAnswer.objects.bulk_create(answers, batch_size=5000)
+        self.stdout.write(
+            f"Seeded {len(answers)} answers across {test_count} tests in {time.perf_counter() - start:.1f}s"
+        )
+        # Time a test in the middle of the table rather than the first rows inserted.
+        return tests[len(tests) // 2].id
+
+    def measure(self, test_id, options):
+        factory = APIRequestFactory()
+        grid_view = TestViewSet.as_view({'get': 'grid_status'})
+        list_view = StudentAnswerViewSet.as_view({'get': 'list'})
+        cases = [
+            ('grid-status', lambda: grid_view(factory.get(f'/api/tests/{test_id}/grid-status/'), pk=test_id)),
+            ('answers?test=&view=slim', lambda: list_view(
+                factory.get('/api/answers/', {'test': test_id, 'view': 'slim'}))),
+            ('answers?test=&is_evaluated=false', lambda: list_view(
+                factory.get('/api/answers/', {'test': test_id, 'is_evaluated': 'false', 'view': 'slim'}))),
+        ]
+
+        grid_p95 = None
+        for label, call in cases:
+            call()  # Warm-up
+            timings = []
+            for _ in range(options['runs']):
+                start = time.perf_counter()
+                response = call()
+                response.render()
+                timings.append((time.perf_counter() - start) * 1000)
+            timings.sort()
+            p95 = timings[max(0, int(len(timings) * 0.95) - 1)]
+            if label == 'grid-status':
+                grid_p95 = p95
+            self.stdout.write(
+                f"{label:>34}: {len(response.data)} rows, "
+                f"p50 {timings[len(timings) // 2]:.1f} ms, p95 {p95:.1f} ms"
+            )
+
+        if grid_p95 > options['budget_ms']:
+            raise CommandError(f"grid-status p95 {grid_p95:.1f} ms is over the {options['budget_ms']} ms budget")
+        self.stdout.write(self.style.SUCCESS(f"grid-status p95 within the {options['budget_ms']} ms budget"))
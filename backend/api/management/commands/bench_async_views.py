@@ -0,0 +1,105 @@
+# backend/api/management/commands/bench_async_views.py
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, Client
+
+from api import services
+from core.models import Class, Student, Test, Question, StudentAnswer
+
+STUB_EVALUATION = '{"mark_gained": 5, "summary": "Stub", "strengths": "-", "improvements": "-"}'
+
+
+class StubResponse:
+    text = STUB_EVALUATION
+    usage_metadata = None
+
+
+class StubGeminiModel:
+    """Stands in for Gemini: answers every call after a fixed delay."""
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def generate_content(self, prompt, request_options=None):
+        time.sleep(self.delay)
+        return StubResponse()
+
+    async def generate_content_async(self, prompt, request_options=None):
+        await asyncio.sleep(self.delay)
+        return StubResponse()
+
+
+class Command(BaseCommand):
+    help = ("Load-tests run-marking through the sync (WSGI) view on a thread pool and the async "
+            "(ASGI) view on one event loop, with Gemini stubbed to a fixed latency. "
+            "Seeded rows are deleted afterwards.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--latency-ms', type=float, default=500.0, help="Stubbed Gemini latency.")
+        parser.add_argument('--wsgi-threads', type=int, default=8,
+                            help="Concurrent requests on the sync path, like gunicorn --threads.")
+        parser.add_argument('--concurrency', type=int, default=200,
+                            help="Concurrent requests on the async path.")
+
+    def handle(self, *args, **options):
+        services.get_gemini_model = lambda stub=StubGeminiModel(options['latency_ms'] / 1000): stub
+        class_group = Class.objects.create(name="Async bench")
+        try:
+            answer_ids = self.seed(class_group, options['requests'])
+            self.report('WSGI (sync views)', self.run_sync(answer_ids, options['wsgi_threads']), options)
+            self.report('ASGI (async views)', asyncio.run(self.run_async(answer_ids, options['concurrency'])),
+                        options)
+        finally:
+            class_group.delete()
+
+    def seed(self, class_group, count):
+        test = Test.objects.create(class_group=class_group, name="Async bench")
+        question = Question.objects.create(test=test, q_number=1, model_answer="Model answer",
+                                           marking_scheme="Scheme")
+        students = Student.objects.bulk_create([
+            Student(class_group=class_group, name=f"Student {i}") for i in range(count)
+        ])
+        answers = StudentAnswer.objects.bulk_create([
+            StudentAnswer(question=question, student=student, ocr_text=f"Answer {student.name}",
+                          uploaded_image='student_answers/bench.png')
+            for student in students
+        ])
+        return [answer.id for answer in answers]
+
+    def run_sync(self, answer_ids, threads):
+        def post(answer_id):
+            # force=true bypasses the evaluation cache so every request reaches the stub.
+            response = Client(headers={'host': 'localhost'}).post(
+                f'/api/answers/{answer_id}/run-marking/?force=true')
+            return response.status_code
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            statuses = list(pool.map(post, answer_ids))
+        return statuses, time.perf_counter() - start
+
+    async def run_async(self, answer_ids, concurrency):
+        client = AsyncClient(headers={'host': 'localhost'})
+        limit = asyncio.Semaphore(concurrency)
+
+        async def post(answer_id):
+            async with limit:
+                response = await client.post(f'/api/async/answers/{answer_id}/run-marking/?force=true')
+                return response.status_code
+
+        start = time.perf_counter()
+        statuses = await asyncio.gather(*(post(answer_id) for answer_id in answer_ids))
+        return statuses, time.perf_counter() - start
+
+    def report(self, label, outcome, options):
+        statuses, seconds = outcome
+        ok = sum(1 for code in statuses if code == 200)
+        self.stdout.write(self.style.SUCCESS(
+            f"{label}: {len(statuses)} requests ({ok} OK) in {seconds:.2f}s, "
+            f"{len(statuses) / seconds:.1f} req/s with {options['latency_ms']:.0f} ms AI latency"
+        ))
@@ -0,0 +1,145 @@
+# backend/api/management/commands/bench_bulk_upload.py
+
+import io
+import resource
+import tarfile
+import tempfile
+import time
+import zipfile
+
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+from PIL import Image, ImageDraw
+
+from api.bulk_upload import ingest_archive
+from core.models import Class, Student, Test, Question, StudentAnswer
+from core.renditions import delete_renditions
+
+
+def make_scan(index, size):
+    """A grey page with some dark 'handwriting' lines, different for every index."""
+    image = Image.new('L', size, 235)
+    draw = ImageDraw.Draw(image)
+    width, height = size
+    for line in range(12):
+        top = int(height * 0.1) + line * int(height * 0.06)
+        draw.line((width * 0.1, top, width * (0.5 + (index * 7 + line) % 40 / 100), top + 3), fill=40, width=4)
+    draw.text((width * 0.1, height * 0.05), f"Scan {index}", fill=0)
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=80)
+    return output.getvalue()
+
+
+class Command(BaseCommand):
+    help = ("Builds a ZIP or tar of synthetic scans for a seeded class and times the bulk upload "
+            "ingest against one POST /api/answers/ per scan. Seeded rows and stored files are deleted afterwards.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scans', type=int, default=1000)
+        parser.add_argument('--questions', type=int, default=10)
+        parser.add_argument('--format', choices=['zip', 'tar'], default='zip')
+        parser.add_argument('--width', type=int, default=1240, help="Scan width in pixels (A4 at 150 dpi).")
+        parser.add_argument('--height', type=int, default=1754)
+        parser.add_argument('--workers', type=int, default=None, help="Overrides BULK_UPLOAD_WORKERS.")
+        parser.add_argument('--no-preprocess', action='store_true', help="Store scans as they are.")
+        parser.add_argument('--baseline', type=int, default=50,
+                            help="Scans to upload one request at a time for comparison (0 to skip).")
+
+    def handle(self, *args, **options):
+        overrides = {'PREPROCESS_UPLOADS': not options['no_preprocess'], 'BULK_UPLOAD_MAX_FILES': options['scans']}
+        if options['workers']:
+            overrides['BULK_UPLOAD_WORKERS'] = options['workers']
+        class_group = Class.objects.create(name="Bulk upload bench")
+        try:
+            with override_settings(**overrides):
+                test, students = self.seed(class_group, options['scans'], options['questions'])
+                with tempfile.TemporaryFile() as archive:
+                    started = time.perf_counter()
+                    names = self.build_archive(archive, students, options)
+                    self.stdout.write(f"Built a {archive.tell() / 1e6:.1f} MB {options['format']} of {len(names)} "
+                                      f"scans in {time.perf_counter() - started:.1f}s")
+                    self.run_ingest(test, archive, options)
+                if options['baseline']:
+                    self.run_baseline(test, students, options)
+        finally:
+            self.cleanup(class_group)
+
+    def seed(self, class_group, scans, question_count):
+        test = Test.objects.create(class_group=class_group, name="Bulk upload bench")
+        for number in range(1, question_count + 1):
+            Question.objects.create(test=test, q_number=number, model_answer="-", marking_scheme="-")
+        students = Student.objects.bulk_create([
+            Student(class_group=class_group, name=f"Student {i:04d}")
+            for i in range(-(-scans // question_count))
+        ])
+        return test, students
+
+    def scan_names(self, students, options):
+        for index in range(options['scans']):
+            student = students[index // options['questions']]
+            yield index, f"{student.name}/Q{index % options['questions'] + 1}.jpg"
+
+    def build_archive(self, archive, students, options):
+        size = (options['width'], options['height'])
+        names = []
+        if options['format'] == 'zip':
+            with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as zip_file:
+                for index, name in self.scan_names(students, options):
+                    zip_file.writestr(name, make_scan(index, size))
+                    names.append(name)
+        else:
+            with tarfile.open(fileobj=archive, mode='w') as tar_file:
+                for index, name in self.scan_names(students, options):
+                    data = make_scan(index, size)
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    tar_file.addfile(info, io.BytesIO(data))
+                    names.append(name)
+        return names
+
+    def run_ingest(self, test, archive, options):
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        started = time.perf_counter()
+        result = ingest_archive(test, archive)
+        seconds = time.perf_counter() - started
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        stored = result['created'] + result['updated']
+        self.stdout.write(self.style.SUCCESS(
+            f"Bulk ingest: {stored} answers ({len(result['skipped'])} skipped) in {seconds:.2f}s, "
+            f"{stored / seconds:.1f} scans/s; peak RSS grew by {(rss_after - rss_before) / 1024:.1f} MB"
+        ))
+        for skipped in result['skipped'][:5]:
+            self.stdout.write(f"  skipped {skipped['file']}: {skipped['reason']}")
+
+    def run_baseline(self, test, students, options):
+        # The same scans posted one at a time, as the app uploads them today, to a fresh set of answers.
+        self.delete_answers(StudentAnswer.objects.filter(question__test=test))
+        questions = {question.q_number: question.id for question in test.questions.all()}
+        client = Client(headers={'host': 'localhost'})
+        size = (options['width'], options['height'])
+        count = min(options['baseline'], options['scans'])
+        scans = [make_scan(index, size) for index in range(count)]
+        started = time.perf_counter()
+        for index, data in enumerate(scans):
+            student = students[index // options['questions']]
+            upload = io.BytesIO(data)
+            upload.name = 'scan.jpg'
+            client.post('/api/answers/', {
+                'student': student.id, 'question': questions[index % options['questions'] + 1], 'uploaded_image': upload,
+            })
+        seconds = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"One POST per scan: {count} answers in {seconds:.2f}s, {count / seconds:.1f} scans/s "
+            f"(about {options['scans'] * seconds / count:.0f}s for {options['scans']})"
+        ))
+
+    def delete_answers(self, answers):
+        storage = StudentAnswer._meta.get_field('uploaded_image').storage
+        for image in answers.values_list('uploaded_image', flat=True):
+            storage.delete(image)
+            delete_renditions(storage, image)
+        answers.delete()
+
+    def cleanup(self, class_group):
+        self.delete_answers(StudentAnswer.objects.filter(student__class_group=class_group))
+        class_group.delete()
@@ -0,0 +1,73 @@
+# backend/api/management/commands/bench_preprocessing.py
+
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.imaging import preprocess_image
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp', '.tif', '.tiff')
+
+
+class Command(BaseCommand):
+    help = ("Runs the OCR preprocessing pipeline over a folder of sample scans and "
+            "reports bytes saved. With --ocr it also times Vision on the original and processed images.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('folder')
+        parser.add_argument('--ocr', action='store_true',
+                            help="Also call Google Vision for each image (uses API quota).")
+
+    def handle(self, *args, **options):
+        folder = options['folder']
+        if not os.path.isdir(folder):
+            raise CommandError(f"{folder} is not a directory")
+        paths = sorted(
+            os.path.join(folder, name) for name in os.listdir(folder)
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        )
+        if not paths:
+            raise CommandError(f"No images found in {folder}")
+
+        if options['ocr']:
+            from google.cloud import vision
+            from api.services import VISION_TIMEOUT, get_vision_client
+            client = get_vision_client()
+
+            def ocr_ms(content):
+                start = time.perf_counter()
+                client.document_text_detection(image=vision.Image(content=content), timeout=VISION_TIMEOUT)
+                return (time.perf_counter() - start) * 1000
+
+        totals = {'before': 0, 'after': 0, 'process_ms': 0.0, 'ocr_before_ms': 0.0, 'ocr_after_ms': 0.0}
+        for path in paths:
+            with open(path, 'rb') as f:
+                original = f.read()
+            start = time.perf_counter()
+            processed, _ = preprocess_image(original)
+            process_ms = (time.perf_counter() - start) * 1000
+
+            totals['before'] += len(original)
+            totals['after'] += len(processed)
+            totals['process_ms'] += process_ms
+            line = (f"{os.path.basename(path)}: {len(original) / 1024:.0f} KB -> "
+                    f"{len(processed) / 1024:.0f} KB in {process_ms:.0f} ms")
+            if options['ocr']:
+                before_ms, after_ms = ocr_ms(original), ocr_ms(processed)
+                totals['ocr_before_ms'] += before_ms
+                totals['ocr_after_ms'] += after_ms
+                line += f", OCR {before_ms:.0f} ms -> {after_ms:.0f} ms"
+            self.stdout.write(line)
+
+        count = len(paths)
+        saved = 100 * (1 - totals['after'] / totals['before'])
+        self.stdout.write(self.style.SUCCESS(
+            f"{count} images: {totals['before'] / 1024:.0f} KB -> {totals['after'] / 1024:.0f} KB "
+            f"({saved:.0f}% smaller), mean preprocessing {totals['process_ms'] / count:.0f} ms"
+        ))
+        if options['ocr']:
+            self.stdout.write(
+                f"Mean OCR latency: {totals['ocr_before_ms'] / count:.0f} ms original, "
+                f"{totals['ocr_after_ms'] / count:.0f} ms processed"
+            )
@@ -0,0 +1,68 @@
+# backend/api/management/commands/bench_principle_retrieval.py
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.services import build_evaluation_prompt, estimate_tokens, evaluate_answer_with_ai
+from api.tasks import get_principles_text
+from core.models import Question
+
+
+class Command(BaseCommand):
+    help = ("Compares grading prompt size (and, with --ai, Gemini latency) when sending a test's "
+            "whole marking principles text against the retrieved sections for each question.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('test_id', type=int)
+        parser.add_argument('--ai', action='store_true',
+                            help="Also grade each question's model answer both ways (uses API quota).")
+
+    def handle(self, *args, **options):
+        questions = list(Question.objects.select_related('test__marking_principle')
+                         .filter(test_id=options['test_id']))
+        if not questions:
+            raise CommandError(f"Test #{options['test_id']} has no questions")
+        if not questions[0].test.marking_principle:
+            raise CommandError("The test has no marking principle")
+        full_text = questions[0].test.marking_principle.full_text()
+
+        totals = {'full': 0, 'retrieved': 0, 'retrieval_ms': 0.0, 'full_ai_ms': 0.0, 'retrieved_ai_ms': 0.0}
+        for question in questions:
+            start = time.perf_counter()
+            retrieved_text = get_principles_text(question.test, question)
+            retrieval_ms = (time.perf_counter() - start) * 1000
+
+            sizes = {}
+            for label, principles in (('full', full_text), ('retrieved', retrieved_text)):
+                # The model answer stands in for a student's answer.
+                prompt = build_evaluation_prompt(question.model_answer, question.model_answer,
+                                                 question.marking_scheme, question.max_mark, principles)
+                sizes[label] = estimate_tokens(prompt)
+                totals[label] += sizes[label]
+            totals['retrieval_ms'] += retrieval_ms
+            line = (f"Q{question.q_number}: {sizes['full']} -> {sizes['retrieved']} prompt tokens, "
+                    f"retrieval {retrieval_ms:.1f} ms")
+
+            if options['ai']:
+                marks = {}
+                for label, principles in (('full', full_text), ('retrieved', retrieved_text)):
+                    start = time.perf_counter()
+                    result = evaluate_answer_with_ai(question.model_answer, question.model_answer,
+                                                     question.marking_scheme, question.max_mark, principles)
+                    totals[f'{label}_ai_ms'] += (time.perf_counter() - start) * 1000
+                    marks[label] = result['mark_gained']
+                line += f", mark {marks['full']} -> {marks['retrieved']}"
+            self.stdout.write(line)
+
+        count = len(questions)
+        saved = 100 * (1 - totals['retrieved'] / totals['full'])
+        self.stdout.write(self.style.SUCCESS(
+            f"{count} questions: {totals['full']} -> {totals['retrieved']} prompt tokens "
+            f"({saved:.0f}% smaller), mean retrieval {totals['retrieval_ms'] / count:.1f} ms"
+        ))
+        if options['ai']:
+            self.stdout.write(
+                f"Mean Gemini latency: {totals['full_ai_ms'] / count:.0f} ms full, "
+                f"{totals['retrieved_ai_ms'] / count:.0f} ms retrieved"
+            )
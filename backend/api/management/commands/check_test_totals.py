@@ -0,0 +1,36 @@
+# backend/api/management/commands/check_test_totals.py
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Sum
+
+from core.models import Test
+
+
+class Command(BaseCommand):
+    help = "Checks the stored total_max_mark/question_count of every test against its questions."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help="Rewrite any totals that are out of date.")
+
+    def handle(self, *args, **options):
+        tests = Test.objects.annotate(
+            actual_total=Sum('questions__max_mark'),
+            actual_count=Count('questions'),
+        )
+        stale = []
+        for test in tests:
+            actual_total = test.actual_total or 0
+            if test.total_max_mark != actual_total or test.question_count != test.actual_count:
+                stale.append(test.id)
+                self.stdout.write(
+                    f"Test #{test.id} '{test.name}': stored {test.total_max_mark} marks / "
+                    f"{test.question_count} questions, actual {actual_total} / {test.actual_count}"
+                )
+
+        if not stale:
+            self.stdout.write(self.style.SUCCESS("All test totals are consistent."))
+        elif options['fix']:
+            Test.refresh_question_totals(*stale)
+            self.stdout.write(self.style.SUCCESS(f"Fixed {len(stale)} test(s)."))
+        else:
+            self.stdout.write(self.style.WARNING(f"{len(stale)} test(s) out of date. Run with --fix to repair."))
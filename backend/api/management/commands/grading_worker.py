@@ -0,0 +1,40 @@
+# backend/api/management/commands/grading_worker.py
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from api.tasks import claim_next_grading_job, run_grading_job
+
+
+class Command(BaseCommand):
+    help = "Runs queued OCR and marking jobs. Start as many workers as you like."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help="Exit when the queue is empty instead of waiting for new jobs.")
+        parser.add_argument('--sleep', type=float, default=1.0,
+                            help="Seconds to wait between polls when the queue is empty.")
+        parser.add_argument('--max-jobs', type=int, default=0,
+                            help="Exit after this many jobs (0 means no limit).")
+
+    def handle(self, *args, **options):
+        processed = 0
+        self.stdout.write("Grading worker started.")
+        try:
+            while not options['max_jobs'] or processed < options['max_jobs']:
+                close_old_connections()
+                job = claim_next_grading_job()
+                if job is None:
+                    if options['once']:
+                        break
+                    time.sleep(options['sleep'])
+                    continue
+
+                job = run_grading_job(job)
+                processed += 1
+                self.stdout.write(f"{job} in {job.run_seconds:.2f}s")
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(f"Grading worker stopped after {processed} job(s).")
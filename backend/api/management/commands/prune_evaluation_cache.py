@@ -0,0 +1,22 @@
+# backend/api/management/commands/prune_evaluation_cache.py
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.evaluation_cache import DatabaseEvaluationStore
+
+
+class Command(BaseCommand):
+    help = ("Deletes expired evaluation and model answer cache entries, and the least recently "
+            "used above each cache's size limit. Only applies to caches using the 'db' backend.")
+
+    def handle(self, *args, **options):
+        stores = [
+            DatabaseEvaluationStore(settings.EVALUATION_CACHE_TTL, settings.EVALUATION_CACHE_MAX_ENTRIES,
+                                    namespace='evaluation'),
+            DatabaseEvaluationStore(settings.MODEL_ANSWER_CACHE_TTL, settings.MODEL_ANSWER_CACHE_MAX_ENTRIES,
+                                    namespace='model_answer'),
+        ]
+        for store in stores:
+            deleted = store.evict()
+            self.stdout.write(self.style.SUCCESS(f"Removed {deleted} {store.namespace} cache entries."))
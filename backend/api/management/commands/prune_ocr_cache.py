@@ -0,0 +1,27 @@
+# backend/api/management/commands/prune_ocr_cache.py
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.models import OcrCacheEntry
+
+
+class Command(BaseCommand):
+    help = "Deletes OCR cache entries that haven't been used for a number of days."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=90,
+                            help="Remove entries not used in this many days (default: 90).")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only report how many entries would be removed.")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        stale = OcrCacheEntry.objects.filter(last_used_at__lt=cutoff)
+        if options['dry_run']:
+            self.stdout.write(f"{stale.count()} OCR cache entries would be removed.")
+            return
+        deleted, _ = stale.delete()
+        self.stdout.write(self.style.SUCCESS(f"Removed {deleted} OCR cache entries."))
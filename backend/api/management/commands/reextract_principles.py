@@ -0,0 +1,35 @@
+# backend/api/management/commands/reextract_principles.py
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from core.models import MarkingPrinciple
+from core.principles import extract_principle
+
+
+class Command(BaseCommand):
+    help = ("Re-extracts the text, page chunks and retrieval index of marking principle PDFs. By default "
+            "only principles that failed, never finished or have no page chunks or index are processed.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('ids', nargs='*', type=int, help="Only these principle ids.")
+        parser.add_argument('--all', action='store_true', help="Re-extract every principle.")
+
+    def handle(self, *args, **options):
+        principles = MarkingPrinciple.objects.exclude(pdf_file="").order_by('id')
+        if options['ids']:
+            principles = principles.filter(pk__in=options['ids'])
+        elif not options['all']:
+            principles = principles.annotate(chunk_count=Count('chunks')).exclude(
+                extraction_status='finished', chunk_count__gt=0, retrieval_index__isnull=False
+            )
+
+        count = 0
+        for principle in principles:
+            # Runs in this process, one principle at a time.
+            extract_principle(principle.id)
+            principle.refresh_from_db()
+            self.stdout.write(f"#{principle.id} {principle.name}: {principle.extraction_status}, "
+                              f"{principle.pages_extracted}/{principle.page_count} pages")
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f"Re-extracted {count} principle(s)."))
@@ -0,0 +1,109 @@
+# backend/api/model_answers.py
+
+import hashlib
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from core.models import Question
+from core.question_index import get_question_index, normalise_text
+from .evaluation_cache import count_lookup, get_model_answer_store
+from .services import (GEMINI_MODEL_NAME, MODEL_ANSWER_ERROR_PREFIX, build_model_answer_prompt,
+                       generate_model_answer_with_ai, generate_model_answer_with_ai_async, read_image)
+
+# Teachers ask for model answers to the same questions again and again, in
+# other classes and in later years. Before Gemini is asked:
+#
+# 1. The same question text, marking scheme and image (ignoring whitespace
+#    and Unicode form, but not case) is answered from the model answer
+#    cache.
+# 2. A saved question with identical text and scheme, and no image on
+#    either side, lends its model answer.
+#
+# Only then is an answer generated. Similar but not identical questions are
+# never reused automatically (a different number makes a different
+# question); their answers are returned as suggestions for the teacher to
+# pick from, from the in-memory index in core/question_index.py.
+
+
+def make_cache_key(description, marking_scheme, image_sha256=""):
+    # The prompt template is part of the key, so changing it doesn't serve old answers.
+    prompt = build_model_answer_prompt(normalise_text(description), normalise_text(marking_scheme))
+    raw = f"model-answer\0{GEMINI_MODEL_NAME}\0{prompt}\0{image_sha256}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def is_usable(model_answer):
+    return bool(model_answer and model_answer.strip()) and not model_answer.startswith(MODEL_ANSWER_ERROR_PREFIX)
+
+def suggest_model_answers(description, marking_scheme, exclude=(), limit=None):
+    """The model answers of the saved questions most similar to this one, best first."""
+    index = get_question_index()
+    matches = index.search(description, marking_scheme, limit or settings.MODEL_ANSWER_SUGGESTIONS,
+                           settings.MODEL_ANSWER_SUGGESTION_MIN_SIMILARITY, exclude=set(exclude))
+    questions = Question.objects.select_related('test').in_bulk([question_id for question_id, _ in matches])
+    suggestions = []
+    for question_id, similarity in matches:
+        question = questions.get(question_id)
+        if question is None or not is_usable(question.model_answer):
+            continue
+        suggestions.append({
+            'question_id': question.id,
+            'test_id': question.test_id,
+            'test': question.test.name,
+            'q_number': question.q_number,
+            'description': question.description,
+            'model_answer': question.model_answer,
+            'has_image': bool(question.question_image),
+            'similarity': round(similarity, 3),
+        })
+    return suggestions
+
+def _lookup(description, marking_scheme, image_sha256, use_cache):
+    """(store, key, result) where result is the reused answer, or None on a miss."""
+    store = get_model_answer_store() if use_cache else None
+    key = make_cache_key(description, marking_scheme, image_sha256)
+    if store is not None:
+        cached = store.get(key)
+        count_lookup('misses' if cached is None else 'hits', 'model_answer')
+        if cached is not None:
+            return store, key, {'model_answer': cached['model_answer'], 'source': 'cache'}
+    if use_cache and not image_sha256:
+        question_id = get_question_index().find_exact(description, marking_scheme)
+        if question_id is not None:
+            question = Question.objects.only('id', 'model_answer').filter(pk=question_id).first()
+            if question is not None and is_usable(question.model_answer):
+                return store, key, {'model_answer': question.model_answer, 'source': 'question',
+                                    'question_id': question.id}
+    return store, key, None
+
+def _finish(store, key, model_answer, description, marking_scheme, reused):
+    result = reused or {'model_answer': model_answer, 'source': 'generated'}
+    if reused is None and store is not None and is_usable(model_answer):
+        store.set(key, {'model_answer': model_answer}, GEMINI_MODEL_NAME)
+    exclude = [result['question_id']] if 'question_id' in result else []
+    result['suggestions'] = suggest_model_answers(description, marking_scheme, exclude=exclude)
+    return result
+
+def generate_model_answer_cached(description, marking_scheme, image=None, use_cache=True):
+    """
+    generate_model_answer_with_ai, answered from the cache or a saved
+    question when possible. Returns {'model_answer', 'source' ('cache',
+    'question' or 'generated'), 'suggestions'} plus 'question_id' when a saved
+    question's answer was reused. use_cache=False always generates.
+    """
+    image_content = read_image(image) if image else None
+    image_sha256 = hashlib.sha256(image_content).hexdigest() if image_content else ""
+    store, key, reused = _lookup(description, marking_scheme, image_sha256, use_cache)
+    model_answer = None
+    if reused is None:
+        model_answer = generate_model_answer_with_ai(description, marking_scheme, image_content)
+    return _finish(store, key, model_answer, description, marking_scheme, reused)
+
+async def generate_model_answer_cached_async(description, marking_scheme, image_content=None, use_cache=True):
+    """Async generate_model_answer_cached. The lookups are synchronous, so they run in a worker thread."""
+    image_sha256 = hashlib.sha256(image_content).hexdigest() if image_content else ""
+    store, key, reused = await sync_to_async(_lookup)(description, marking_scheme, image_sha256, use_cache)
+    model_answer = None
+    if reused is None:
+        model_answer = await generate_model_answer_with_ai_async(description, marking_scheme, image_content)
+    return await sync_to_async(_finish)(store, key, model_answer, description, marking_scheme, reused)
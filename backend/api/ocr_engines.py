@@ -0,0 +1,162 @@
+# backend/api/ocr_engines.py
+
+import io
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Every engine reads a list of image bytes and returns one text per image, in
+# order. Like perform_ocr, a page that couldn't be read gets an
+# "OCR Failed: ..." text rather than raising.
+
+
+# --- TESSERACT (LOCAL) ---
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def configure_tesseract(tesseract_cmd=None):
+    """
+    Points pytesseract at TESSERACT_CMD (or the given path). Runs once per
+    process: at startup (ApiConfig.ready) and in each pool worker as it starts.
+    """
+    if tesseract_cmd is None:
+        tesseract_cmd = settings.TESSERACT_CMD
+    if not tesseract_cmd:
+        return
+    try:
+        import pytesseract
+    except ImportError:
+        return  # Only needed when the Tesseract engine is used.
+    pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+
+def get_tesseract_pool():
+    """This process's pool of OCR_LOCAL_WORKERS Tesseract processes, started on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=settings.OCR_LOCAL_WORKERS, initializer=configure_tesseract,
+                                        initargs=(settings.TESSERACT_CMD,))
+        return _pool
+
+def _discard_tesseract_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def tesseract_read(content, lang='eng'):
+    """
+    Reads one image with the local Tesseract binary. Returns the text and the
+    mean word confidence (0-100). A module-level function so pool workers can run it.
+    """
+    try:
+        import pytesseract
+        from PIL import Image
+
+        data = pytesseract.image_to_data(Image.open(io.BytesIO(content)), lang=lang,
+                                         output_type=pytesseract.Output.DICT)
+    except Exception as e:
+        logger.exception("Tesseract OCR failed")
+        return f"OCR Failed: {str(e)}", 0.0
+
+    # image_to_data lists words with their block/paragraph/line numbers; put the
+    # lines back together. Layout rows that aren't words have a confidence of -1.
+    lines, confidences = {}, []
+    for index, word in enumerate(data['text']):
+        confidence = float(data['conf'][index])
+        if confidence < 0 or not word.strip():
+            continue
+        line_key = (data['block_num'][index], data['par_num'][index], data['line_num'][index])
+        lines.setdefault(line_key, []).append(word)
+        confidences.append(confidence)
+    text = "\n".join(" ".join(words) for words in lines.values())
+    return text, (sum(confidences) / len(confidences) if confidences else 0.0)
+
+
+class TesseractEngine:
+    """
+    Offline OCR. Several pages are read in parallel in a pool of processes,
+    one per core, shared by every request in the process.
+    """
+    name = 'tesseract'
+
+    def __init__(self, vision_client=None):
+        self.lang = settings.TESSERACT_LANG
+
+    def read_with_confidence(self, contents):
+        """(text, confidence) for each image."""
+        if min(settings.OCR_LOCAL_WORKERS, len(contents)) <= 1:
+            return [tesseract_read(content, self.lang) for content in contents]
+        # Tesseract is CPU-bound, so threads would just queue behind each other.
+        pool = get_tesseract_pool()
+        try:
+            return list(pool.map(tesseract_read, contents, [self.lang] * len(contents)))
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for memory). The next call starts a new pool.
+            logger.warning("Tesseract pool broke; reading in-process.")
+            _discard_tesseract_pool(pool)
+            return [tesseract_read(content, self.lang) for content in contents]
+
+    def read_many(self, contents):
+        return [text for text, _ in self.read_with_confidence(contents)]
+
+
+# --- GOOGLE VISION ---
+
+class VisionEngine:
+    """Google Vision document text detection, batched as in perform_ocr_batch."""
+    name = 'vision'
+
+    def __init__(self, vision_client=None):
+        self.client = vision_client
+
+    def read_many(self, contents):
+        from .services import perform_ocr_batch, perform_ocr_content
+
+        if len(contents) == 1:
+            return [perform_ocr_content(contents[0], client=self.client)]
+        return perform_ocr_batch(contents, client=self.client)
+
+
+# --- LOCAL FIRST ---
+
+class LocalFirstEngine:
+    """
+    Tesseract first; pages it fails on, finds no text in or is unsure about
+    (below OCR_LOCAL_MIN_CONFIDENCE) are read again with Vision.
+    """
+    name = 'local-first'
+
+    def __init__(self, vision_client=None):
+        self.local = TesseractEngine()
+        self.vision = VisionEngine(vision_client)
+
+    def read_many(self, contents):
+        results = self.local.read_with_confidence(contents)
+        texts = [text for text, _ in results]
+        unsure = [
+            index for index, (text, confidence) in enumerate(results)
+            if text.startswith("OCR Failed") or not text.strip()
+            or confidence < settings.OCR_LOCAL_MIN_CONFIDENCE
+        ]
+        if unsure:
+            for index, text in zip(unsure, self.vision.read_many([contents[i] for i in unsure])):
+                texts[index] = text
+        return texts
+
+
+OCR_ENGINES = {engine.name: engine for engine in (VisionEngine, TesseractEngine, LocalFirstEngine)}
+
+def get_ocr_engine(name=None, vision_client=None):
+    """Builds the named engine, or the OCR_ENGINE setting's when name is empty."""
+    name = name or settings.OCR_ENGINE
+    if name not in OCR_ENGINES:
+        raise ValueError(f"Unknown OCR engine '{name}'. Choose one of: {', '.join(OCR_ENGINES)}.")
+    return OCR_ENGINES[name](vision_client=vision_client)
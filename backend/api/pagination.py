@@ -0,0 +1,14 @@
+# backend/api/pagination.py
+
+from rest_framework.pagination import CursorPagination
+
+
+class OptionalCursorPagination(CursorPagination):
+    """
+    Cursor pagination that only switches on when the client sends ?page_size=N.
+    Without it the endpoint keeps returning a plain list, which the workflow UI expects.
+    """
+    page_size = None
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+    ordering = 'id'
@@ -0,0 +1,298 @@
+# backend/api/ratelimit.py
+
+import asyncio
+import contextvars
+import itertools
+import logging
+import random
+import re
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError
+from google.api_core import exceptions as google_exceptions
+
+from core.models import RateLimitBucket, ConcurrencySlot
+from .resilience import (ahedged_call, before_call, hedged_call, observe_latency, record_failure,
+                         record_success)
+
+logger = logging.getLogger(__name__)
+
+# Every outbound Gemini/Vision call goes through call_with_limits (or its
+# async twin). It waits for a free concurrency slot and for room in the
+# provider's per-minute buckets, then retries rate-limit and transient errors
+# with jittered exponential backoff, waiting at least as long as the provider
+# asks. Buckets and slots are rows in the database, so every web and worker
+# process shares the same quota. Each attempt also passes the provider's
+# circuit breaker and may be hedged (see api/resilience.py).
+#
+# Within a request (see config.middleware.AIRetryBudgetMiddleware) all the
+# waiting and retrying stops once AI_REQUEST_RETRY_BUDGET is spent, and the
+# last error is raised; background jobs have no such limit.
+
+# Errors worth another attempt: quota (429) and transient server-side failures.
+RETRYABLE_ERRORS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.BadGateway,
+    google_exceptions.GatewayTimeout,
+    google_exceptions.DeadlineExceeded,
+)
+# How often a waiting caller checks for a free slot, in seconds.
+SLOT_POLL_INTERVAL = 0.05
+# Backoff after losing a bucket update to another process: jittered, doubling, capped.
+CAS_BACKOFF = 0.002
+CAS_MAX_BACKOFF = 0.05
+_retry_in_re = re.compile(r"retry in ([\d.]+)\s*s", re.IGNORECASE)
+# time.monotonic() by which the current request's AI calls must be done, or None.
+_deadline = contextvars.ContextVar('ai_retry_deadline', default=None)
+
+
+class QuotaWaitExceeded(google_exceptions.TooManyRequests):
+    """The provider's quota or concurrency cap won't allow the call before the retry budget runs out."""
+
+
+@contextmanager
+def retry_budget(seconds):
+    """AI calls made inside stop waiting and retrying `seconds` from now (no limit if seconds is falsy)."""
+    token = _deadline.set(time.monotonic() + seconds if seconds else None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+def _check_wait(provider, delay, deadline):
+    if deadline is not None and time.monotonic() + delay > deadline:
+        raise QuotaWaitExceeded(f"{provider} limits would delay the call past the request's retry budget")
+
+
+# --- TOKEN BUCKETS ---
+
+def _bucket_take(key, amount, per_minute, wait=True):
+    """
+    Takes `amount` from the bucket. Returns 0 when taken, or the seconds until
+    there will be enough. With wait=False the amount is always taken, even
+    into debt (for usage only known after the call).
+    """
+    capacity, rate = float(per_minute), per_minute / 60.0
+    # A single call bigger than the whole bucket would otherwise never fit.
+    amount = min(amount, capacity)
+    for conflicts in itertools.count():
+        now = time.time()
+        bucket = RateLimitBucket.objects.filter(key=key).first()
+        if bucket is None:
+            try:
+                RateLimitBucket.objects.create(key=key, level=capacity, updated_at=now)
+            except IntegrityError:
+                pass  # Another process created it first.
+            continue
+        level = min(capacity, bucket.level + max(now - bucket.updated_at, 0) * rate)
+        if wait and level < amount:
+            return (amount - level) / rate
+        # Compare-and-swap: only succeeds if nobody changed the bucket since we read it.
+        if RateLimitBucket.objects.filter(pk=bucket.pk, level=bucket.level, updated_at=bucket.updated_at) \
+                .update(level=level - amount, updated_at=now):
+            return 0
+        # Lost to another caller; back off so busy buckets aren't hammered with reads.
+        time.sleep(random.uniform(0, min(CAS_MAX_BACKOFF, CAS_BACKOFF * 2 ** conflicts)))
+
+def _quota_buckets(provider, units, tokens):
+    """(bucket key, amount, per-minute limit) for each bucket a call draws from."""
+    limits = settings.AI_RATE_LIMITS[provider]
+    for kind, amount, per_minute in (('requests', units, limits['requests_per_minute']),
+                                     ('tokens', tokens, limits['tokens_per_minute'])):
+        if amount and per_minute:
+            yield f"{provider}:{kind}", amount, per_minute
+
+def acquire_quota(provider, units=1, tokens=0, deadline=None):
+    """
+    Blocks until the provider's request (and token) buckets allow the call.
+    Raises QuotaWaitExceeded rather than wait past the deadline.
+    """
+    for key, amount, per_minute in _quota_buckets(provider, units, tokens):
+        while (delay := _bucket_take(key, amount, per_minute)):
+            _check_wait(provider, delay, deadline)
+            time.sleep(delay + random.uniform(0, 0.05))
+
+async def aacquire_quota(provider, units=1, tokens=0, deadline=None):
+    """acquire_quota for async callers."""
+    for key, amount, per_minute in _quota_buckets(provider, units, tokens):
+        while (delay := await sync_to_async(_bucket_take)(key, amount, per_minute)):
+            _check_wait(provider, delay, deadline)
+            await asyncio.sleep(delay + random.uniform(0, 0.05))
+
+def record_tokens(provider, tokens):
+    """Charges tokens that were only known after the call (e.g. the reply's) to the bucket."""
+    per_minute = settings.AI_RATE_LIMITS[provider]['tokens_per_minute']
+    if settings.AI_RATE_LIMITING and tokens and per_minute:
+        _bucket_take(f"{provider}:tokens", tokens, per_minute, wait=False)
+
+
+# --- CONCURRENCY SLOTS ---
+
+def _claim_slot(provider, lease_seconds):
+    """Claims a free slot for the provider and returns its id, or None if all are busy."""
+    cap = settings.AI_RATE_LIMITS[provider]['max_concurrency']
+    now = time.time()
+    free = list(ConcurrencySlot.objects.filter(provider=provider, number__lt=cap, held_until__lt=now)
+                .values_list('id', flat=True)[:cap])
+    if not free and ConcurrencySlot.objects.filter(provider=provider, number__lt=cap).count() < cap:
+        ConcurrencySlot.objects.bulk_create(
+            [ConcurrencySlot(provider=provider, number=number) for number in range(cap)],
+            ignore_conflicts=True,
+        )
+        return _claim_slot(provider, lease_seconds)
+    random.shuffle(free)
+    for slot_id in free:
+        # A conditional UPDATE is atomic, so only one caller wins each slot.
+        if ConcurrencySlot.objects.filter(pk=slot_id, held_until__lt=now).update(held_until=now + lease_seconds):
+            return slot_id
+    return None
+
+def _release_slot(slot_id):
+    ConcurrencySlot.objects.filter(pk=slot_id).update(held_until=0)
+
+def acquire_slot(provider, lease_seconds, deadline=None):
+    while (slot_id := _claim_slot(provider, lease_seconds)) is None:
+        _check_wait(provider, SLOT_POLL_INTERVAL, deadline)
+        time.sleep(SLOT_POLL_INTERVAL + random.uniform(0, SLOT_POLL_INTERVAL))
+    return slot_id
+
+async def aacquire_slot(provider, lease_seconds, deadline=None):
+    """acquire_slot for async callers."""
+    while (slot_id := await sync_to_async(_claim_slot)(provider, lease_seconds)) is None:
+        _check_wait(provider, SLOT_POLL_INTERVAL, deadline)
+        await asyncio.sleep(SLOT_POLL_INTERVAL + random.uniform(0, SLOT_POLL_INTERVAL))
+    return slot_id
+
+@contextmanager
+def provider_limits(provider, units=1, tokens=0, lease_seconds=120, deadline=None):
+    """
+    Holds the quota and a concurrency slot for one call to `provider`. Quota
+    comes first, so no slot sits idle while its holder waits for the bucket.
+    """
+    if not settings.AI_RATE_LIMITING:
+        yield
+        return
+    acquire_quota(provider, units, tokens, deadline)
+    slot_id = acquire_slot(provider, lease_seconds, deadline)
+    try:
+        yield
+    finally:
+        _release_slot(slot_id)
+
+
+# --- RETRIES ---
+
+def retry_after_seconds(error):
+    """The delay the provider asked for in a rate-limit error, if any."""
+    response = getattr(error, 'response', None)
+    header = getattr(response, 'headers', {}).get('Retry-After') if response is not None else None
+    if header:
+        try:
+            return float(header)
+        except ValueError:
+            pass
+    # gRPC errors carry a google.rpc.RetryInfo in their details.
+    for detail in getattr(error, 'details', None) or []:
+        delay = getattr(detail, 'retry_delay', None)
+        if delay is not None:
+            return delay.seconds + delay.nanos / 1e9
+    match = _retry_in_re.search(str(error))
+    return float(match.group(1)) if match else None
+
+def backoff_delay(attempt, error):
+    """Full-jitter exponential backoff, never shorter than the provider's Retry-After."""
+    delay = random.uniform(0, min(settings.AI_RETRY_MAX_DELAY, settings.AI_RETRY_BASE_DELAY * 2 ** attempt))
+    retry_after = retry_after_seconds(error)
+    if retry_after is not None:
+        delay = max(delay, retry_after + random.uniform(0, settings.AI_RETRY_BASE_DELAY))
+    return delay
+
+def _out_of_time(deadline, delay):
+    # Another attempt is only worth starting if it can begin before the budget runs out.
+    return deadline is not None and time.monotonic() + delay >= deadline
+
+def _attempt(provider, call, units, tokens, lease_seconds, probe, deadline):
+    """One request within the provider's limits, reporting its outcome to the circuit breaker."""
+    with provider_limits(provider, units, tokens, lease_seconds, deadline):
+        started = time.perf_counter()
+        try:
+            result = call()
+        except RETRYABLE_ERRORS:
+            record_failure(provider, probe)
+            raise
+        except Exception:
+            # The provider answered (e.g. rejected the request), so it is up.
+            record_success(provider, time.perf_counter() - started, probe)
+            raise
+        seconds = time.perf_counter() - started
+    observe_latency(provider, seconds)
+    record_success(provider, seconds, probe)
+    return result
+
+async def _aattempt(provider, call, units, tokens, lease_seconds, probe, deadline):
+    """_attempt for async callers."""
+    if settings.AI_RATE_LIMITING:
+        await aacquire_quota(provider, units, tokens, deadline)
+    slot_id = await aacquire_slot(provider, lease_seconds, deadline) if settings.AI_RATE_LIMITING else None
+    try:
+        started = time.perf_counter()
+        try:
+            result = await call()
+        except RETRYABLE_ERRORS:
+            await sync_to_async(record_failure)(provider, probe)
+            raise
+        except Exception:
+            await sync_to_async(record_success)(provider, time.perf_counter() - started, probe)
+            raise
+        seconds = time.perf_counter() - started
+    finally:
+        if slot_id is not None:
+            await sync_to_async(_release_slot)(slot_id)
+    observe_latency(provider, seconds)
+    await sync_to_async(record_success)(provider, seconds, probe)
+    return result
+
+def call_with_limits(provider, call, units=1, tokens=0, lease_seconds=120, hedge=False):
+    """
+    Runs call() within the provider's limits. Retryable errors are retried up
+    to AI_RETRY_ATTEMPTS times, or while the request's retry budget lasts;
+    the last error is raised for the caller to handle, as is CircuitOpenError
+    while the provider's circuit is open. With hedge=True (and AI_HEDGING on)
+    a slow call is duplicated, so call() must be idempotent.
+    """
+    deadline = _deadline.get()
+    for attempt in range(settings.AI_RETRY_ATTEMPTS):
+        probe = before_call(provider, lease_seconds)
+        run = lambda: _attempt(provider, call, units, tokens, lease_seconds, probe, deadline)
+        try:
+            # The half-open probe is never hedged: exactly one call tests the provider.
+            return hedged_call(provider, run) if hedge and settings.AI_HEDGING and not probe else run()
+        except RETRYABLE_ERRORS as e:
+            delay = backoff_delay(attempt, e)
+            if attempt + 1 >= settings.AI_RETRY_ATTEMPTS or _out_of_time(deadline, delay):
+                raise
+            logger.warning("%s call failed (%s), retrying in %.1fs", provider, e.__class__.__name__, delay)
+            time.sleep(delay)
+
+async def acall_with_limits(provider, call, units=1, tokens=0, lease_seconds=120, hedge=False):
+    """Async call_with_limits; `call` returns an awaitable. Waits never block the event loop."""
+    deadline = _deadline.get()
+    for attempt in range(settings.AI_RETRY_ATTEMPTS):
+        probe = await sync_to_async(before_call)(provider, lease_seconds)
+        run = lambda: _aattempt(provider, call, units, tokens, lease_seconds, probe, deadline)
+        try:
+            if hedge and settings.AI_HEDGING and not probe:
+                return await ahedged_call(provider, run)
+            return await run()
+        except RETRYABLE_ERRORS as e:
+            delay = backoff_delay(attempt, e)
+            if attempt + 1 >= settings.AI_RETRY_ATTEMPTS or _out_of_time(deadline, delay):
+                raise
+            logger.warning("%s call failed (%s), retrying in %.1fs", provider, e.__class__.__name__, delay)
+            await asyncio.sleep(delay)
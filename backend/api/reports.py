@@ -0,0 +1,119 @@
+# backend/api/reports.py
+
+import math
+import statistics
+from collections import defaultdict
+
+from django.db.models import Count, FloatField, Max, Q, Sum, Value
+from django.db.models.functions import Coalesce
+
+from core.models import Student, StudentAnswer
+
+
+def mark_column(question):
+    """Name of the annotation holding a student's mark for one question."""
+    return f"q_{question.id}_mark"
+
+def student_results_queryset(test, questions):
+    """
+    Every student in the test's class, annotated in a single query with their
+    total, answer counts and one mark column per question.
+    """
+    in_test = Q(studentanswer__question__test=test)
+    evaluated = in_test & Q(studentanswer__is_evaluated=True)
+    question_columns = {
+        mark_column(question): Max(
+            'studentanswer__mark_gained',
+            filter=evaluated & Q(studentanswer__question_id=question.id),
+        )
+        for question in questions
+    }
+    return Student.objects.filter(class_group_id=test.class_group_id).annotate(
+        total_mark_gained=Coalesce(Sum('studentanswer__mark_gained', filter=in_test),
+                                   Value(0.0), output_field=FloatField()),
+        answered_count=Count('studentanswer', filter=in_test),
+        evaluated_count=Count('studentanswer', filter=evaluated),
+        **question_columns,
+    ).order_by('name', 'id')
+
+def summarise(values):
+    """Mean, median, standard deviation, min and max of a list of marks (None when empty)."""
+    if not values:
+        return {'count': 0, 'mean': None, 'median': None, 'std_dev': None, 'min': None, 'max': None}
+    return {
+        'count': len(values),
+        'mean': round(statistics.fmean(values), 2),
+        'median': round(statistics.median(values), 2),
+        'std_dev': round(statistics.pstdev(values), 2),
+        'min': min(values),
+        'max': max(values),
+    }
+
+def question_summaries(questions, students):
+    """Per-question class statistics, built from the already-loaded mark columns."""
+    summaries = []
+    for question in questions:
+        marks = [getattr(student, mark_column(question)) for student in students]
+        marks = [mark for mark in marks if mark is not None]
+        summaries.append({
+            'id': question.id,
+            'q_number': question.q_number,
+            'max_mark': question.max_mark,
+            'statistics': summarise(marks),
+        })
+    return summaries
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers, or None when it is empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(1, math.ceil(pct / 100 * len(ordered))) - 1]
+
+def latency_summary(latencies):
+    return {
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'max': max(latencies) if latencies else None,
+    }
+
+def ai_usage_report(test):
+    """
+    Token spend and AI latency for a test's evaluated answers, overall and per
+    question. Latency percentiles leave out evaluations served from the cache.
+    """
+    answers = StudentAnswer.objects.filter(question__test=test, input_tokens__isnull=False)
+    per_question = {
+        row['question_id']: row for row in answers.values('question_id', 'question__q_number').annotate(
+            evaluations=Count('id'),
+            cached=Count('id', filter=Q(input_tokens=0)),
+            input_tokens=Sum('input_tokens'),
+            output_tokens=Sum('output_tokens'),
+        ).order_by('question__q_number')
+    }
+    latencies = defaultdict(list)
+    for question_id, latency in answers.filter(input_tokens__gt=0, evaluation_latency_ms__isnull=False) \
+            .values_list('question_id', 'evaluation_latency_ms'):
+        latencies[question_id].append(latency)
+
+    questions = [{
+        'id': question_id,
+        'q_number': row['question__q_number'],
+        'evaluations': row['evaluations'],
+        'cached': row['cached'],
+        'input_tokens': row['input_tokens'],
+        'output_tokens': row['output_tokens'],
+        'latency_ms': latency_summary(latencies[question_id]),
+    } for question_id, row in per_question.items()]
+    input_tokens = sum(q['input_tokens'] for q in questions)
+    output_tokens = sum(q['output_tokens'] for q in questions)
+    return {
+        'test': test.id,
+        'evaluations': sum(q['evaluations'] for q in questions),
+        'cached': sum(q['cached'] for q in questions),
+        'input_tokens': input_tokens,
+        'output_tokens': output_tokens,
+        'total_tokens': input_tokens + output_tokens,
+        'latency_ms': latency_summary([value for values in latencies.values() for value in values]),
+        'questions': questions,
+    }
@@ -0,0 +1,210 @@
+# backend/api/resilience.py
+
+import asyncio
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FutureTimeout, wait
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, connection
+from django.db.models import F
+
+from core.models import ProviderCircuit, ConcurrencySlot
+from .reports import percentile
+
+logger = logging.getLogger(__name__)
+
+# Circuit breaker and hedged requests for the AI providers, used by
+# api/ratelimit.py. When a provider keeps failing or timing out its circuit
+# opens and calls fail at once instead of each waiting out the timeout; after
+# a pause a single probe call decides whether it closes again. Breaker state
+# and counters are shared through the database; the latencies used to time
+# hedges are this process's own recent calls.
+
+# Recent successful call durations kept per provider, in seconds.
+LATENCY_SAMPLES = 200
+# Threads running hedged calls (each hedged call uses two while it is hedging).
+HEDGE_THREADS = 32
+
+_latencies = defaultdict(lambda: deque(maxlen=LATENCY_SAMPLES))
+_latencies_lock = threading.Lock()
+_hedge_pool = ThreadPoolExecutor(max_workers=HEDGE_THREADS, thread_name_prefix='ai-hedge')
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a provider whose circuit is open."""
+
+    def __init__(self, provider, retry_in):
+        self.provider = provider
+        self.retry_in = retry_in
+        super().__init__(f"{provider} is unavailable (circuit open); try again in {retry_in:.1f}s")
+
+
+# --- CIRCUIT BREAKER ---
+
+def _circuit(provider):
+    while True:
+        circuit = ProviderCircuit.objects.filter(provider=provider).first()
+        if circuit is not None:
+            return circuit
+        try:
+            ProviderCircuit.objects.create(provider=provider)
+        except IntegrityError:
+            pass  # Another process created it first.
+
+def before_call(provider, lease_seconds):
+    """
+    Raises CircuitOpenError if the provider's circuit is open. Returns True
+    when this call is the half-open probe whose outcome closes or re-opens it.
+    """
+    if not settings.AI_BREAKER_ENABLED:
+        return False
+    circuit = _circuit(provider)
+    if circuit.state == 'closed':
+        return False
+    now = time.time()
+    if circuit.blocked_until <= now:
+        # The pause is over (or the last probe never reported back): one caller
+        # wins this conditional UPDATE and becomes the probe.
+        if ProviderCircuit.objects.filter(pk=circuit.pk, state=circuit.state,
+                                          blocked_until=circuit.blocked_until) \
+                .update(state='half_open', blocked_until=now + lease_seconds):
+            logger.info("%s circuit half open, sending a probe call", provider)
+            return True
+    ProviderCircuit.objects.filter(pk=circuit.pk).update(short_circuits=F('short_circuits') + 1)
+    raise CircuitOpenError(provider, max(circuit.blocked_until - now, 0))
+
+def record_success(provider, seconds, probe=False):
+    """Records a call the provider answered; a call slower than the slow-call limit counts as failed."""
+    if not settings.AI_BREAKER_ENABLED:
+        return
+    slow_after = settings.AI_BREAKER_SLOW_CALL_SECONDS
+    if slow_after and seconds > slow_after:
+        record_failure(provider, probe)
+        return
+    circuits = ProviderCircuit.objects.filter(provider=provider)
+    if probe:
+        circuits.update(state='closed', blocked_until=0, consecutive_failures=0, calls=F('calls') + 1)
+        logger.info("%s circuit closed", provider)
+    else:
+        circuits.update(consecutive_failures=0, calls=F('calls') + 1)
+
+def record_failure(provider, probe=False):
+    if not settings.AI_BREAKER_ENABLED:
+        return
+    circuits = ProviderCircuit.objects.filter(provider=provider)
+    circuits.update(consecutive_failures=F('consecutive_failures') + 1, calls=F('calls') + 1,
+                    failures=F('failures') + 1)
+    if probe:
+        tripped = circuits.filter(state='half_open')
+    else:
+        tripped = circuits.filter(state='closed', consecutive_failures__gte=settings.AI_BREAKER_FAILURES)
+    if tripped.update(state='open', blocked_until=time.time() + settings.AI_BREAKER_RESET_SECONDS,
+                      times_opened=F('times_opened') + 1):
+        logger.warning("%s circuit opened for %gs", provider, settings.AI_BREAKER_RESET_SECONDS)
+
+
+# --- HEDGED REQUESTS ---
+
+def observe_latency(provider, seconds):
+    with _latencies_lock:
+        _latencies[provider].append(seconds)
+
+def hedge_delay(provider):
+    """Seconds to wait for a reply before hedging: this process's recent p95 (by default) latency."""
+    with _latencies_lock:
+        samples = list(_latencies[provider])
+    if len(samples) < settings.AI_HEDGE_MIN_SAMPLES:
+        return settings.AI_HEDGE_DEFAULT_DELAY
+    return percentile(samples, settings.AI_HEDGE_PERCENTILE)
+
+def count_hedge(provider, won=False):
+    field = 'hedges_won' if won else 'hedges_sent'
+    ProviderCircuit.objects.filter(provider=provider).update(**{field: F(field) + 1})
+
+def _in_thread(run):
+    try:
+        return run()
+    finally:
+        connection.close()
+
+def hedged_call(provider, run):
+    """
+    Runs run() and, if it hasn't returned within hedge_delay, runs it a second
+    time; the first successful result wins. The slower request is left to
+    finish in the background (a blocking call can't be cancelled).
+    """
+    primary = _hedge_pool.submit(_in_thread, run)
+    try:
+        return primary.result(timeout=hedge_delay(provider))
+    except FutureTimeout:
+        pass
+    count_hedge(provider)
+    hedge = _hedge_pool.submit(_in_thread, run)
+    pending, error = {primary, hedge}, None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is hedge:
+                    count_hedge(provider, won=True)
+                return future.result()
+            error = future.exception()
+    raise error
+
+async def ahedged_call(provider, run):
+    """hedged_call for async callers; run() returns an awaitable and the slower request is cancelled."""
+    primary = asyncio.ensure_future(run())
+    pending = {primary}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=hedge_delay(provider))
+        if done:
+            return primary.result()
+        await sync_to_async(count_hedge)(provider)
+        hedge = asyncio.ensure_future(run())
+        pending, error = {primary, hedge}, None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        await sync_to_async(count_hedge)(provider, won=True)
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+# --- METRICS ---
+
+def provider_metrics():
+    """Breaker state, call and hedge counters, slots in use and hedge timing for each provider."""
+    now = time.time()
+    circuits = {circuit.provider: circuit for circuit in ProviderCircuit.objects.all()}
+    metrics = {}
+    for provider in settings.AI_RATE_LIMITS:
+        circuit = circuits.get(provider) or ProviderCircuit(provider=provider)
+        with _latencies_lock:
+            samples = list(_latencies[provider])
+        metrics[provider] = {
+            'state': circuit.state,
+            'retry_in_seconds': round(max(circuit.blocked_until - now, 0), 1) if circuit.state == 'open' else 0,
+            'consecutive_failures': circuit.consecutive_failures,
+            'times_opened': circuit.times_opened,
+            'calls': circuit.calls,
+            'failures': circuit.failures,
+            'short_circuits': circuit.short_circuits,
+            'hedges_sent': circuit.hedges_sent,
+            'hedges_won': circuit.hedges_won,
+            'slots_in_use': ConcurrencySlot.objects.filter(provider=provider, held_until__gt=now).count(),
+            # The rest are for this process only.
+            'latency_p50_seconds': percentile(samples, 50),
+            'latency_p95_seconds': percentile(samples, 95),
+            'hedge_delay_seconds': hedge_delay(provider),
+        }
+    return metrics
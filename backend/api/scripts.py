@@ -0,0 +1,256 @@
+# backend/api/scripts.py
+
+import hashlib
+import io
+import re
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.utils import timezone
+from PIL import Image
+from PyPDF2 import PdfReader
+
+from core.models import StudentAnswer, OcrCacheEntry
+from core.renditions import delete_renditions, generate_renditions
+from .imaging import preprocess_image
+from .ocr_engines import get_ocr_engine
+from .tasks import store_ocr_texts
+
+# Whole answer scripts: a student's pages (a scanned PDF or several photos)
+# are OCR'd once each, cut into answers at the question markers ("Q3",
+# "Question 3:") and stored as that student's StudentAnswers in one go.
+
+# A marker at the start of a line: "Q3", "Q.3", "Q 3)", "Question 3:", "Ans 3".
+QUESTION_MARKER = re.compile(r"^[ \t]*(?:q(?:uestion)?|ans(?:wer)?)[ \t]*\.?[ \t]*(\d{1,3})(?!\d)[ \t]*[.):\-]?",
+                             re.IGNORECASE | re.MULTILINE)
+
+
+class ScriptError(Exception):
+    """An answer script that can't be stored; the message is safe to show the user."""
+
+
+class ScriptOcrError(ScriptError):
+    """The OCR engine couldn't read some of the pages (numbered from 1 in `pages`)."""
+
+    def __init__(self, message, pages):
+        super().__init__(message)
+        self.pages = pages
+
+
+# --- PAGES ---
+
+def script_pages(files):
+    """
+    Page images, in order, from the uploaded files: every page of a PDF
+    (its scanned image) and every other file as one page. Returns the image
+    bytes and the numbers of PDF pages with no scanned image to read.
+    """
+    pages, skipped = [], []
+    for upload in files:
+        upload.seek(0)
+        data = upload.read()
+        if not data.startswith(b'%PDF'):
+            pages.append(data)
+            continue
+        for page in PdfReader(io.BytesIO(data)).pages:
+            # A scanner or phone app stores each page as one image; take the largest if there are several.
+            images = [image.data for image in page.images]
+            if images:
+                pages.append(max(images, key=len))
+            else:
+                skipped.append(len(pages) + len(skipped) + 1)
+    return pages, skipped
+
+def prepare_page(data):
+    """The page as it will be OCR'd and stored, preprocessed like a single answer upload."""
+    if settings.PREPROCESS_UPLOADS:
+        try:
+            return preprocess_image(data)
+        except Exception as e:
+            print(f"Image preprocessing failed, keeping the original page: {e}")
+    image_format = Image.open(io.BytesIO(data)).format or 'PNG'
+    return data, {'JPEG': 'jpg', 'MPO': 'jpg'}.get(image_format, image_format.lower())
+
+def stitch_pages(contents):
+    """Stacks the pages of an answer that runs over several pages into one image."""
+    images = [Image.open(io.BytesIO(content)).convert('L') for content in contents]
+    stitched = Image.new('L', (max(image.width for image in images), sum(image.height for image in images)), 255)
+    top = 0
+    for image in images:
+        stitched.paste(image, (0, top))
+        top += image.height
+    output = io.BytesIO()
+    stitched.save(output, format='JPEG', quality=settings.OCR_IMAGE_QUALITY, optimize=True)
+    return output.getvalue()
+
+
+# --- SPLITTING ---
+
+def split_script(page_texts, q_numbers):
+    """
+    Cuts the pages' OCR text into answers at question markers. Only markers
+    naming one of q_numbers count, so a numbered list inside an answer is
+    left alone; an answer runs on until the next marker, across pages.
+    Returns {q_number: {'text', 'pages'}} with 0-based page indexes.
+    """
+    answers = {}
+    current = None
+
+    def add(q_number, page_index, text):
+        answer = answers.setdefault(q_number, {'parts': [], 'pages': []})
+        if page_index not in answer['pages']:
+            answer['pages'].append(page_index)
+        if text.strip():
+            answer['parts'].append(text.strip())
+
+    for page_index, text in enumerate(page_texts):
+        position = 0
+        for match in QUESTION_MARKER.finditer(text):
+            q_number = int(match.group(1))
+            if q_number not in q_numbers:
+                continue
+            if current is not None:
+                add(current, page_index, text[position:match.start()])
+            # Writing above the first marker (name, candidate number) belongs to no answer.
+            current, position = q_number, match.end()
+            add(current, page_index, "")
+        if current is not None:
+            add(current, page_index, text[position:])
+    return {q_number: {'text': "\n".join(answer['parts']), 'pages': answer['pages']}
+            for q_number, answer in answers.items()}
+
+
+# --- STORING ANSWERS ---
+# Shared with the bulk archive upload. Answers are saved with bulk_create /
+# bulk_update, which skip the model's save() and signals, so these helpers do
+# the image handling the upload serializer and signals would have done.
+
+# Everything a new image makes stale, written along with it.
+NEW_IMAGE_FIELDS = [
+    'uploaded_image', 'image_sha256', 'ocr_text', 'mark_gained', 'is_evaluated',
+    'ai_evaluation_summary', 'ai_strength_points', 'ai_improvement_points',
+    'input_tokens', 'output_tokens', 'evaluation_latency_ms',
+]
+
+def store_answer_image(file_name, content):
+    """Writes an answer image straight to the configured storage and returns its stored name."""
+    field = StudentAnswer._meta.get_field('uploaded_image')
+    return field.storage.save(field.generate_filename(None, file_name), ContentFile(content))
+
+def delete_stored_images(names):
+    storage = StudentAnswer._meta.get_field('uploaded_image').storage
+    for name in names:
+        storage.delete(name)
+
+def set_new_image(answer, image_name, image_sha256, ocr_text=None):
+    """Points the answer at a stored image, clearing the text and marks that came from the old one."""
+    if answer.pk and answer.uploaded_image and answer.uploaded_image.name != image_name:
+        answer._replaced_image_name = answer.uploaded_image.name
+    answer.uploaded_image = image_name
+    answer.image_sha256 = image_sha256
+    answer.ocr_text = ocr_text
+    answer.mark_gained = 0
+    answer.is_evaluated = False
+    answer.ai_evaluation_summary = answer.ai_strength_points = answer.ai_improvement_points = None
+    answer.input_tokens = answer.output_tokens = answer.evaluation_latency_ms = None
+
+def save_answers(new, updated, renditions=None, batch_size=None):
+    """
+    Saves new and updated answers in one transaction. Their images are
+    already stored; if the save fails they are deleted again. renditions
+    defaults to the RENDITIONS_ON_UPLOAD setting.
+    """
+    try:
+        with transaction.atomic():
+            StudentAnswer.objects.bulk_create(new, batch_size=batch_size)
+            StudentAnswer.objects.bulk_update(updated, NEW_IMAGE_FIELDS, batch_size=batch_size)
+    except Exception:
+        delete_stored_images([answer.uploaded_image.name for answer in new + updated])
+        raise
+    # What the post_save rendition signals would have done for each answer.
+    storage = StudentAnswer._meta.get_field('uploaded_image').storage
+    for answer in updated:
+        if getattr(answer, '_replaced_image_name', None):
+            delete_renditions(storage, answer._replaced_image_name)
+    if settings.RENDITIONS_ON_UPLOAD if renditions is None else renditions:
+        for answer in new + updated:
+            generate_renditions(answer.uploaded_image)
+
+
+# --- INGEST ---
+
+def read_pages(contents, engine):
+    """OCR text for each page, from the OCR cache where the engine read the page before."""
+    hashes = [hashlib.sha256(content).hexdigest() for content in contents]
+    entries = OcrCacheEntry.objects.filter(engine=engine.name)
+    cached = dict(entries.filter(image_sha256__in=hashes).values_list('image_sha256', 'text'))
+    entries.filter(image_sha256__in=cached).update(last_used_at=timezone.now())
+    to_read = {}
+    for image_sha256, content in zip(hashes, contents):
+        if image_sha256 not in cached:
+            to_read.setdefault(image_sha256, content)
+    texts = dict(zip(to_read, engine.read_many(list(to_read.values())))) if to_read else {}
+    store_ocr_texts(texts, engine.name)
+    return [cached.get(image_sha256, texts.get(image_sha256)) for image_sha256 in hashes]
+
+def ingest_script(test, student, files, engine=None):
+    """
+    Stores one student's answer script for a test. Every page is OCR'd once,
+    split into answers by question marker, and all of the student's answers
+    are created or replaced in a single transaction (replaced answers need
+    marking again). engine defaults to the test's OCR engine.
+    Returns the answers plus the questions and pages nothing was found for.
+    """
+    raw_pages, skipped_pages = script_pages(files)
+    if not raw_pages:
+        raise ScriptError("The script has no pages to read.")
+    if len(raw_pages) > settings.SCRIPT_MAX_PAGES:
+        raise ScriptError(f"A script can have at most {settings.SCRIPT_MAX_PAGES} pages.")
+    try:
+        pages = [prepare_page(data) for data in raw_pages]
+    except Exception as e:
+        raise ScriptError(f"Could not open a page image: {e}")
+
+    page_texts = read_pages([content for content, _ in pages], get_ocr_engine(engine or test.ocr_engine))
+    failed = [index for index, text in enumerate(page_texts) if text.startswith("OCR Failed")]
+    if failed:
+        # Storing the rest would silently lose whatever was on the unread pages.
+        pages = [index + 1 for index in failed]
+        page_list = ", ".join(map(str, pages))
+        raise ScriptOcrError(f"OCR failed on page(s) {page_list}: {page_texts[failed[0]]}", pages)
+
+    questions = {question.q_number: question for question in test.questions.all()}
+    found = split_script(page_texts, set(questions))
+    existing = {answer.question_id: answer for answer in
+                StudentAnswer.objects.filter(student=student, question__test=test)}
+
+    new, updated, stored_names = [], [], []
+    try:
+        for q_number, section in sorted(found.items()):
+            question = questions[q_number]
+            if len(section['pages']) == 1:
+                content, extension = pages[section['pages'][0]]
+            else:
+                content, extension = stitch_pages([pages[index][0] for index in section['pages']]), 'jpg'
+            stored_names.append(store_answer_image(f"script_{student.id}_q{q_number}.{extension}", content))
+            answer = existing.get(question.id)
+            if answer is None:
+                answer = StudentAnswer(question=question, student=student)
+                new.append(answer)
+            else:
+                updated.append(answer)
+            set_new_image(answer, stored_names[-1], hashlib.sha256(content).hexdigest(), section['text'])
+    except Exception:
+        delete_stored_images(stored_names)
+        raise
+    save_answers(new, updated)
+
+    used_pages = {index for section in found.values() for index in section['pages']}
+    return {
+        'answers': new + updated,
+        'pages': len(pages),
+        'questions_not_found': sorted(set(questions) - set(found)),
+        'pages_without_answers': [index + 1 for index in range(len(pages)) if index not in used_pages],
+        'skipped_pdf_pages': skipped_pages,
+    }
@@ -1,8 +1,24 @@
 # backend/api/serializers.py
 
+import hashlib
+from django.conf import settings
+from django.urls import reverse
 from rest_framework import serializers
-from django.db import models
-from core.models import Class, Student, Test, Question, StudentAnswer, MarkingPrinciple
+from core.models import Class, Student, Test, Question, StudentAnswer, MarkingPrinciple, MarkingJob, GradingJob
+from .reports import mark_column
+
+def rendition_urls(serializer, obj, field_name, kind):
+    """Rendition URLs for an image field, or None. The ?v= part changes whenever the image is replaced."""
+    image = getattr(obj, field_name)
+    if not image:
+        return None
+    version = hashlib.sha1(image.name.encode('utf-8')).hexdigest()[:10]
+    request = serializer.context.get('request')
+    urls = {}
+    for size in settings.IMAGE_RENDITIONS:
+        url = f"{reverse('image-rendition', args=[kind, obj.pk, size])}?v={version}"
+        urls[size] = request.build_absolute_uri(url) if request else url
+    return urls
 
 class ClassSerializer(serializers.ModelSerializer):
     class Meta:
@@ -19,25 +35,29 @@ class StudentSerializer(serializers.ModelSerializer):
 class MarkingPrincipleSerializer(serializers.ModelSerializer):
     class Meta:
         model = MarkingPrinciple
-        fields = ['id', 'name']
+        fields = ['id', 'name', 'extraction_status', 'page_count', 'pages_extracted']
+        read_only_fields = ('extraction_status', 'page_count', 'pages_extracted')
 
 class QuestionSerializer(serializers.ModelSerializer):
+    question_image_renditions = serializers.SerializerMethodField()
+
     class Meta:
         model = Question
-        fields = ['id', 'test', 'q_number', 'description', 'question_image', 'max_mark', 'model_answer', 'marking_scheme']
+        fields = ['id', 'test', 'q_number', 'description', 'question_image', 'question_image_renditions',
+                  'max_mark', 'model_answer', 'marking_scheme']
         read_only_fields = ('id','test',)
 
+    def get_question_image_renditions(self, obj):
+        return rendition_urls(self, obj, 'question_image', 'question')
+
 class TestSerializer(serializers.ModelSerializer):
-    # This will calculate the total max mark for all questions in a test
-    total_max_mark = serializers.SerializerMethodField()
-    
+    # total_max_mark and question_count are stored on the test and kept in
+    # sync by the Question signals, so listing tests adds no queries.
     class Meta:
         model = Test
-        fields = ['id', 'name', 'class_group', 'date_created', 'marking_principle', 'total_max_mark']
-
-    def get_total_max_mark(self, obj):
-        # Sums the max_mark of all questions related to this test
-        return obj.questions.aggregate(total=models.Sum('max_mark'))['total'] or 0
+        fields = ['id', 'name', 'class_group', 'date_created', 'marking_principle',
+                  'ocr_engine', 'total_max_mark', 'question_count']
+        read_only_fields = ('total_max_mark', 'question_count')
 
 class StudentAnswerUploadSerializer(serializers.ModelSerializer):
     """Serializer just for handling the initial image upload."""
@@ -51,31 +71,87 @@ class StudentAnswerEvaluationSerializer(serializers.ModelSerializer):
     # We nest other serializers to show related object details
     question = QuestionSerializer(read_only=True)
     student = StudentSerializer(read_only=True)
+    uploaded_image_renditions = serializers.SerializerMethodField()
 
     class Meta:
         model = StudentAnswer
         fields = (
-            'id', 'student', 'question', 'uploaded_image', 
+            'id', 'student', 'question', 'uploaded_image', 'uploaded_image_renditions',
             'ocr_text', 'mark_gained', 'ai_evaluation_summary', 
             'ai_strength_points', 'ai_improvement_points', 'is_evaluated'
         )
 
+    def get_uploaded_image_renditions(self, obj):
+        return rendition_urls(self, obj, 'uploaded_image', 'answer')
+
+class StudentAnswerSlimSerializer(serializers.ModelSerializer):
+    """
+    Compact answer rows for grids and lists. Leaves out the nested question
+    (model answer and marking scheme can be long) and needs no extra queries
+    beyond select_related('question', 'student').
+    """
+    student_name = serializers.CharField(source='student.name', read_only=True)
+    q_number = serializers.IntegerField(source='question.q_number', read_only=True)
+    uploaded_image_renditions = serializers.SerializerMethodField()
+
+    class Meta:
+        model = StudentAnswer
+        fields = (
+            'id', 'student', 'student_name', 'question', 'q_number', 'uploaded_image', 'uploaded_image_renditions',
+            'ocr_text', 'mark_gained', 'ai_evaluation_summary',
+            'ai_strength_points', 'ai_improvement_points', 'is_evaluated'
+        )
+        read_only_fields = fields
+
+    def get_uploaded_image_renditions(self, obj):
+        return rendition_urls(self, obj, 'uploaded_image', 'answer')
+
 class StudentTestResultSerializer(serializers.ModelSerializer):
-    """Serializer for the final report view."""
-    total_mark_gained = serializers.SerializerMethodField()
+    """
+    Serializer for the final report view. Reads the annotations added by
+    api.reports.student_results_queryset, so it runs no queries of its own.
+    """
+    total_mark_gained = serializers.FloatField(read_only=True)
+    evaluated_count = serializers.IntegerField(read_only=True)
+    pending_count = serializers.SerializerMethodField()
+    missing_count = serializers.SerializerMethodField()
+    question_marks = serializers.SerializerMethodField()
 
     class Meta:
         model = Student
-        fields = ('id', 'name', 'total_mark_gained')
-    
-    def get_total_mark_gained(self, obj):
-        test_id = self.context.get('test_id')
-        if not test_id:
-            return 0
-        
-        total = StudentAnswer.objects.filter(
-            student=obj,
-            question__test_id=test_id
-        ).aggregate(total=models.Sum('mark_gained'))['total']
-        
-        return total if total is not None else 0
\ No newline at end of file
+        fields = ('id', 'name', 'total_mark_gained', 'evaluated_count', 'pending_count',
+                  'missing_count', 'question_marks')
+
+    def get_pending_count(self, obj):
+        # Uploaded but not marked yet
+        return obj.answered_count - obj.evaluated_count
+
+    def get_missing_count(self, obj):
+        # Questions the student has no uploaded answer for
+        return len(self.context['questions']) - obj.answered_count
+
+    def get_question_marks(self, obj):
+        # Keyed by question id; None until that answer has been evaluated
+        return {str(q.id): getattr(obj, mark_column(q)) for q in self.context['questions']}
+
+class MarkingJobSerializer(serializers.ModelSerializer):
+    """Progress report for a bulk marking job."""
+    pending = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = MarkingJob
+        fields = ('id', 'test', 'status', 'concurrency', 'batched', 'total', 'done', 'failed',
+                  'pending', 'error', 'created_at', 'heartbeat_at', 'finished_at')
+        read_only_fields = fields
+
+class GradingJobSerializer(serializers.ModelSerializer):
+    """Status of a queued OCR or marking job."""
+    queue_seconds = serializers.FloatField(read_only=True)
+    run_seconds = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = GradingJob
+        fields = ('id', 'answer', 'kind', 'status', 'attempts', 'max_attempts', 'error',
+                  'created_at', 'run_after', 'started_at', 'lease_until', 'finished_at',
+                  'queue_seconds', 'run_seconds')
+        read_only_fields = fields
\ No newline at end of file
@@ -1,11 +1,33 @@
 # backend/api/services.py
 
+import asyncio
+import contextvars
+import io
 import os
 import json
+import logging
+import tempfile
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import google.generativeai as genai
+from google.generativeai import client as genai_client
 from google.cloud import vision
+from google.cloud.vision_v1.services.image_annotator.transports import (
+    ImageAnnotatorGrpcAsyncIOTransport, ImageAnnotatorGrpcTransport
+)
 from dotenv import load_dotenv
 import PIL.Image
+from asgiref.sync import sync_to_async
+
+from google.api_core import exceptions as google_exceptions
+
+from .ratelimit import RETRYABLE_ERRORS, acall_with_limits, call_with_limits, record_tokens
+from .resilience import CircuitOpenError
+
+logger = logging.getLogger(__name__)
 
 # Load environment variables from .env file
 load_dotenv()
@@ -18,31 +40,360 @@ if not GOOGLE_API_KEY:
     raise ValueError("GOOGLE_API_KEY not found. Please set it in your .env file.")
 genai.configure(api_key=GOOGLE_API_KEY)
 
+# The Gemini model used for every AI call. Part of the evaluation cache key.
+GEMINI_MODEL_NAME = os.getenv('GEMINI_MODEL_NAME', 'gemini-1.5-flash')
+
+# Per-call deadlines (seconds) so a slow provider can't hold a worker forever.
+VISION_TIMEOUT = float(os.getenv('VISION_TIMEOUT', '60'))
+GEMINI_TIMEOUT = float(os.getenv('GEMINI_TIMEOUT', '120'))
+# How long a call may hold a rate limiter concurrency slot before it counts as abandoned.
+VISION_SLOT_LEASE = VISION_TIMEOUT + 30
+GEMINI_SLOT_LEASE = GEMINI_TIMEOUT + 30
+
+# gRPC options for the shared Vision channel. Keepalive pings stop idle
+# connections from being dropped by load balancers between classes.
+VISION_CHANNEL_OPTIONS = [
+    ('grpc.keepalive_time_ms', int(os.getenv('VISION_KEEPALIVE_MS', '30000'))),
+    ('grpc.keepalive_timeout_ms', 10000),
+    ('grpc.max_send_message_length', 32 * 1024 * 1024),
+    ('grpc.max_receive_message_length', 32 * 1024 * 1024),
+]
+
+
+# --- CLIENT REGISTRY ---
+# Building a client means a new gRPC channel, auth and TLS handshake, so each
+# process builds its clients once, on first use, and reuses them. A forked
+# child (gunicorn/Celery prefork) must not share its parent's channels, so the
+# registry is emptied after fork and also checks the PID on every lookup.
+
+_clients = {}
+# asyncio gRPC channels belong to the event loop they were made on, so async
+# clients are cached per loop.
+_async_clients = weakref.WeakKeyDictionary()
+_clients_pid = os.getpid()
+_clients_lock = threading.Lock()
+
+def reset_clients():
+    """Drops every cached client. The next call builds fresh ones."""
+    global _clients_pid
+    _clients.clear()
+    _async_clients.clear()
+    _clients_pid = os.getpid()
+    # genai keeps its own per-process gRPC clients; re-configuring clears them.
+    genai.configure(api_key=GOOGLE_API_KEY)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_clients)
+
+def get_client(name, factory):
+    """Returns the cached client called `name`, building it with `factory` on first use."""
+    if _clients_pid != os.getpid():
+        reset_clients()
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = factory()
+    return client
+
+def get_async_client(name, factory):
+    """Like get_client, for clients that must be used on the running event loop."""
+    if _clients_pid != os.getpid():
+        reset_clients()
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    if name not in clients:
+        clients[name] = factory()
+    return clients[name]
+
+def build_vision_client():
+    channel = ImageAnnotatorGrpcTransport.create_channel(options=VISION_CHANNEL_OPTIONS)
+    return vision.ImageAnnotatorClient(transport=ImageAnnotatorGrpcTransport(channel=channel))
+
+def get_vision_client():
+    return get_client('vision', build_vision_client)
+
+def build_async_vision_client():
+    transport = ImageAnnotatorGrpcAsyncIOTransport(
+        channel=ImageAnnotatorGrpcAsyncIOTransport.create_channel(options=VISION_CHANNEL_OPTIONS)
+    )
+    return vision.ImageAnnotatorAsyncClient(transport=transport)
+
+def get_async_vision_client():
+    return get_async_client('vision', build_async_vision_client)
+
+def get_gemini_model():
+    return get_client('gemini', lambda: genai.GenerativeModel(GEMINI_MODEL_NAME))
+
+# build_async_gemini_model() sets genai internals that have no public
+# equivalent. They were checked against this release, which requirements.txt
+# pins; AsyncGeminiClientTests fails if an upgrade changes them.
+GENAI_TESTED_VERSION = '0.8.5'
+
+def build_async_gemini_model():
+    # genai keeps one async client per process, made on the first loop that
+    # used it. Under WSGI every async view runs on a new loop, so each loop's
+    # model gets a client of its own (genai has no public option for this).
+    model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+    model._async_client = genai_client._client_manager.make_client('generative_async')
+    return model
+
+def get_async_gemini_model():
+    return get_async_client('gemini', build_async_gemini_model)
+
+
+# --- READING IMAGES ---
+# The AI functions take an image as bytes, a local path, or any file-like
+# object: an UploadedFile, a file opened from a storage backend, or a stream.
+# Nothing needs a path on local disk, so they work the same with S3 storage.
+# Each image is opened as one seekable file: files and uploads are used as
+# they are, and streams that can't seek are spooled to a temporary file once
+# they pass IMAGE_SPOOL_MAX_MEMORY. Pillow reads from that file. Vision and
+# Gemini only take images inline, so the bytes they are sent are read from it
+# in one piece, once; the size checks made before reading
+# (MODEL_ANSWER_IMAGE_MAX_BYTES, DIRECT_UPLOAD_MAX_BYTES) bound that.
+
+IMAGE_READ_CHUNK_SIZE = 1024 * 1024
+IMAGE_SPOOL_MAX_MEMORY = 1024 * 1024
+# Formats Gemini accepts as they are; anything else is re-encoded.
+GEMINI_IMAGE_TYPES = {'image/png', 'image/jpeg', 'image/webp', 'image/heic', 'image/heif'}
+
+@contextmanager
+def open_image(image):
+    """A seekable binary file, at its start, for an image given as bytes, a path or a file-like object."""
+    if isinstance(image, (bytes, bytearray)):
+        yield io.BytesIO(image)
+    elif isinstance(image, (str, os.PathLike)):
+        with open(image, 'rb') as f:
+            yield f
+    elif getattr(image, 'seekable', lambda: False)():
+        image.seek(0)
+        yield image
+    else:
+        with tempfile.SpooledTemporaryFile(max_size=IMAGE_SPOOL_MAX_MEMORY) as spool:
+            chunks = image.chunks(IMAGE_READ_CHUNK_SIZE) if hasattr(image, 'chunks') else \
+                iter(lambda: image.read(IMAGE_READ_CHUNK_SIZE), b'')
+            for chunk in chunks:
+                spool.write(chunk)
+            spool.seek(0)
+            yield spool
+
+def read_image(image):
+    """All the bytes of an image given as bytes, a path or a file-like object, as one bytes object."""
+    if isinstance(image, (bytes, bytearray)):
+        return bytes(image)
+    with open_image(image) as f:
+        return f.read()
+
+def gemini_image_part(image):
+    """
+    A Gemini content part for the image. The original bytes are sent when
+    Gemini accepts the format, so a JPEG isn't decoded and re-encoded;
+    Pillow only reads the header to check what it is. Other formats are
+    decoded by Pillow straight from the file and never held as bytes.
+    """
+    with open_image(image) as f:
+        img = PIL.Image.open(f)
+        mime_type = img.get_format_mimetype()
+        if mime_type in GEMINI_IMAGE_TYPES:
+            f.seek(0)
+            return {'mime_type': mime_type, 'data': f.read()}
+        # Decoded now, while the file is still open.
+        img.load()
+        return img
+
 
 # --- OCR FUNCTION ---
-def perform_ocr(image_path):
-    """Reads handwriting from an image using Google Vision API."""
-    client_vision = vision.ImageAnnotatorClient()
+def perform_ocr(image):
+    """Reads handwriting from an image (bytes, a path or a file-like object) using Google Vision API."""
+    try:
+        content = read_image(image)
+    except Exception as e:
+        print(f"OCR Error: {e}")
+        return f"OCR Failed: {str(e)}"
+    return perform_ocr_content(content)
+
+def perform_ocr_content(content, client=None):
+    """Same as perform_ocr, for image bytes that are already in memory."""
+    client_vision = client or get_vision_client()
 
     try:
-        with open(image_path, 'rb') as image_file:
-            content = image_file.read()
-        
         image = vision.Image(content=content)
-        response = client_vision.document_text_detection(image=image)
+        response = call_with_limits(
+            'vision', lambda: client_vision.document_text_detection(image=image, timeout=VISION_TIMEOUT),
+            lease_seconds=VISION_SLOT_LEASE, hedge=True
+        )
         
         return response.full_text_annotation.text if response.full_text_annotation else ""
     except Exception as e:
         print(f"OCR Error: {e}")
         return f"OCR Failed: {str(e)}"
 
+# --- BATCH OCR ---
+# Vision accepts up to 16 images per batch_annotate_images call. Larger sets
+# are split into several requests that run in parallel.
+
+VISION_MAX_IMAGES_PER_REQUEST = 16
+# Keep each request comfortably under Vision's request size limit.
+VISION_MAX_BYTES_PER_REQUEST = 8 * 1024 * 1024
+VISION_BATCH_CONCURRENCY = int(os.getenv('VISION_BATCH_CONCURRENCY', '4'))
+
+def split_ocr_batches(contents):
+    """Groups image indexes into batches that respect Vision's per-request limits."""
+    batches, current, current_bytes = [], [], 0
+    for index, content in enumerate(contents):
+        too_many = len(current) >= VISION_MAX_IMAGES_PER_REQUEST
+        too_big = current_bytes + len(content) > VISION_MAX_BYTES_PER_REQUEST
+        if current and (too_many or too_big):
+            batches.append(current)
+            current, current_bytes = [], 0
+        current.append(index)
+        current_bytes += len(content)
+    if current:
+        batches.append(current)
+    return batches
+
+def _ocr_one_batch(client, contents):
+    requests = [
+        vision.AnnotateImageRequest(
+            image=vision.Image(content=content),
+            features=[vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)],
+        )
+        for content in contents
+    ]
+    try:
+        response = call_with_limits(
+            'vision', lambda: client.batch_annotate_images(requests=requests, timeout=VISION_TIMEOUT),
+            units=len(contents), lease_seconds=VISION_SLOT_LEASE
+        )
+    except Exception as e:
+        print(f"Batch OCR Error: {e}")
+        return [f"OCR Failed: {str(e)}"] * len(contents)
+
+    texts = []
+    for image_response in response.responses:
+        if image_response.error.code:
+            texts.append(f"OCR Failed: {image_response.error.message}")
+        else:
+            texts.append(image_response.full_text_annotation.text if image_response.full_text_annotation else "")
+    # Vision answers every image, but never let a short reply shift results onto the wrong answer.
+    texts += ["OCR Failed: no response for this image"] * (len(contents) - len(texts))
+    return texts
+
+def perform_ocr_batch(contents, client=None):
+    """
+    Reads handwriting from many images (a list of bytes) using as few Vision
+    requests as possible. Returns the texts in the same order; failed images
+    get an "OCR Failed: ..." string, just like perform_ocr.
+    """
+    client = client or get_vision_client()
+    batches = split_ocr_batches(contents)
+    texts = [None] * len(contents)
+    # Each batch runs in the caller's context, so a request's retry budget applies to it.
+    contexts = [contextvars.copy_context() for _ in batches]
+    with ThreadPoolExecutor(max_workers=max(1, min(VISION_BATCH_CONCURRENCY, len(batches)))) as pool:
+        batch_texts = pool.map(
+            lambda context, indexes: context.run(_ocr_one_batch, client, [contents[i] for i in indexes]),
+            contexts, batches,
+        )
+        for indexes, results in zip(batches, batch_texts):
+            for index, text in zip(indexes, results):
+                texts[index] = text
+    return texts
+
 # --- AI EVALUATION FUNCTION ---
-def evaluate_answer_with_ai(student_answer_text, model_answer, marking_scheme, max_mark, marking_principles=""):
+def estimate_tokens(text):
+    """Rough token count for Gemini (about four characters per token)."""
+    return len(text) // 4 + 1
+
+# --- PROMPT BUDGETS ---
+# Upper bounds (in estimated tokens) for the free-text parts of every prompt,
+# so a runaway OCR text or principles document can't make a request huge.
+PROMPT_FIELD_BUDGETS = {
+    'marking_principles': int(os.getenv('PROMPT_PRINCIPLES_TOKENS', '2000')),
+    'model_answer': int(os.getenv('PROMPT_MODEL_ANSWER_TOKENS', '1500')),
+    'marking_scheme': int(os.getenv('PROMPT_MARKING_SCHEME_TOKENS', '1500')),
+    'student_answer_text': int(os.getenv('PROMPT_STUDENT_ANSWER_TOKENS', '2500')),
+    'question_description': int(os.getenv('PROMPT_QUESTION_TOKENS', '1000')),
+}
+
+def truncate_to_tokens(text, budget):
     """
-    Uses Google Gemini to evaluate a student's answer.
+    Shortens text to about `budget` tokens. Keeps the start and the end (a
+    student's conclusion or a scheme's totals are often at the end), cuts at
+    spaces where possible, and marks what was left out.
     """
-    
-    prompt = f"""
+    text = text or ""
+    if estimate_tokens(text) <= budget:
+        return text
+    # Leave room for the omission marker.
+    max_chars = max(budget * 4 - 60, 0)
+    head_chars = int(max_chars * 0.7)
+    tail_chars = max_chars - head_chars
+    head = text[:head_chars]
+    tail = text[len(text) - tail_chars:] if tail_chars else ""
+    cut = head.rfind(" ")
+    if cut > head_chars * 0.8:
+        head = head[:cut]
+    cut = tail.find(" ")
+    if 0 <= cut < tail_chars * 0.2:
+        tail = tail[cut + 1:]
+    omitted = len(text) - len(head) - len(tail)
+    return f"{head}\n[... {omitted} characters omitted ...]\n{tail}"
+
+def fit_prompt_field(field, text):
+    """Applies the PROMPT_FIELD_BUDGETS budget for `field` to text."""
+    return truncate_to_tokens(text, PROMPT_FIELD_BUDGETS[field])
+
+def warn_truncated_fields(**fields):
+    # Called once per AI request; the builders truncate silently because the
+    # cache key and batch sizing build the same prompts again.
+    for field, text in fields.items():
+        if text and estimate_tokens(text) > PROMPT_FIELD_BUDGETS[field]:
+            logger.warning("Prompt budget: %s truncated from about %d to %d tokens",
+                           field, estimate_tokens(text), PROMPT_FIELD_BUDGETS[field])
+
+def response_usage(response, prompt_tokens, started):
+    """Token counts (Gemini's own when it reports them, else estimates) and latency of one call."""
+    usage = getattr(response, 'usage_metadata', None) if response is not None else None
+    output_tokens = getattr(usage, 'candidates_token_count', 0)
+    if not output_tokens and response is not None:
+        try:
+            output_tokens = estimate_tokens(response.text)
+        except Exception:
+            output_tokens = 0
+    return {
+        'input_tokens': getattr(usage, 'prompt_token_count', 0) or prompt_tokens,
+        'output_tokens': output_tokens,
+        'latency_ms': round((time.perf_counter() - started) * 1000, 1),
+    }
+
+def parse_json_response(response_text):
+    """Strips Markdown code fences from a Gemini reply and parses the JSON inside."""
+    cleaned_json_string = response_text.strip().replace("```json", "").replace("```", "").strip()
+    return json.loads(cleaned_json_string)
+
+def normalise_evaluation(ai_output):
+    """Turns one evaluation object from Gemini into the result dict callers store."""
+    try:
+        mark = float(ai_output.get('mark_gained', 0))
+    except (ValueError, TypeError):
+        mark = 0
+
+    return {
+        'mark_gained': mark,
+        'summary': ai_output.get('summary', 'Evaluation complete.'),
+        'strengths': ai_output.get('strengths', 'Answer shows general understanding.'),
+        'improvements': ai_output.get('improvements', 'Review the model answer for details.')
+    }
+
+def build_evaluation_prompt(student_answer_text, model_answer, marking_scheme, max_mark, marking_principles=""):
+    """Builds the Gemini prompt used to grade a single answer, within PROMPT_FIELD_BUDGETS."""
+    student_answer_text = fit_prompt_field('student_answer_text', student_answer_text)
+    model_answer = fit_prompt_field('model_answer', model_answer)
+    marking_scheme = fit_prompt_field('marking_scheme', marking_scheme)
+    marking_principles = fit_prompt_field('marking_principles', marking_principles)
+    return f"""
     You are an expert academic evaluator. Your task is to grade a student's answer based on a strict marking scheme and overall principles.
 
     --- CONTEXT ---
@@ -72,43 +423,200 @@ def evaluate_answer_with_ai(student_answer_text, model_answer, marking_scheme, m
         "improvements": "The answer did not mention the long-term economic impact, which was worth 2 marks according to the scheme."
     }}
     """
-    
+
+def evaluation_failure(error):
+    return {
+        'mark_gained': 0, 
+        'summary': f"An error occurred during AI evaluation: {str(error)}",
+        'strengths': "N/A",
+        'improvements': "N/A",
+        # Lets callers (e.g. the evaluation cache) tell a real mark of 0 from a failure.
+        'failed': True
+    }
+
+def evaluate_answer_with_ai(student_answer_text, model_answer, marking_scheme, max_mark, marking_principles=""):
+    """
+    Uses Google Gemini to evaluate a student's answer.
+    The result's 'usage' holds the call's input/output tokens and latency.
+    """
+    warn_truncated_fields(student_answer_text=student_answer_text, model_answer=model_answer,
+                          marking_scheme=marking_scheme, marking_principles=marking_principles)
+    prompt = build_evaluation_prompt(student_answer_text, model_answer, marking_scheme,
+                                     max_mark, marking_principles)
+
+    started, response = time.perf_counter(), None
     try:
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        response = model.generate_content(prompt)
-        cleaned_json_string = response.text.strip().replace("```json", "").replace("```", "").strip()
-        ai_output = json.loads(cleaned_json_string)
-        
-        try:
-            mark = float(ai_output.get('mark_gained', 0))
-        except (ValueError, TypeError):
-            mark = 0
-            
-        return {
-            'mark_gained': mark,
-            'summary': ai_output.get('summary', 'Evaluation complete.'),
-            'strengths': ai_output.get('strengths', 'Answer shows general understanding.'),
-            'improvements': ai_output.get('improvements', 'Review the model answer for details.')
-        }
+        model = get_gemini_model()
+        response = call_with_limits(
+            'gemini', lambda: model.generate_content(prompt, request_options={'timeout': GEMINI_TIMEOUT}),
+            tokens=estimate_tokens(prompt), lease_seconds=GEMINI_SLOT_LEASE, hedge=True
+        )
+        result = normalise_evaluation(parse_json_response(response.text))
     except Exception as e:
         print(f"AI Evaluation Error: {e}")
-        return {
-            'mark_gained': 0, 
-            'summary': f"An error occurred during AI evaluation: {str(e)}",
-            'strengths': "N/A",
-            'improvements': "N/A"
-        }
-    
-def generate_model_answer_with_ai(question_description, marking_scheme, image_path=None):
+        result = evaluation_failure(e)
+    result['usage'] = response_usage(response, estimate_tokens(prompt), started)
+    record_tokens('gemini', result['usage']['output_tokens'])
+    return result
+
+# --- BATCH AI EVALUATION ---
+# Grading one question for a whole class repeats the same model answer, scheme
+# and principles in every prompt. The batch evaluator sends that shared context
+# once with many answers and asks for a JSON array back.
+
+BATCH_TOKEN_BUDGET = int(os.getenv('BATCH_EVALUATION_TOKEN_BUDGET', '24000'))
+BATCH_MAX_ANSWERS = int(os.getenv('BATCH_EVALUATION_MAX_ANSWERS', '30'))
+
+def build_batch_evaluation_prompt(answers, model_answer, marking_scheme, max_mark, marking_principles=""):
+    """Builds one prompt grading several answers to the same question. `answers` maps answer id to text."""
+    responses = json.dumps(
+        [{"answer_id": answer_id, "text": fit_prompt_field('student_answer_text', text)}
+         for answer_id, text in answers.items()],
+        ensure_ascii=False, indent=1
+    )
+    model_answer = fit_prompt_field('model_answer', model_answer)
+    marking_scheme = fit_prompt_field('marking_scheme', marking_scheme)
+    marking_principles = fit_prompt_field('marking_principles', marking_principles)
+    return f"""
+    You are an expert academic evaluator. Your task is to grade several students' answers to the same question based on a strict marking scheme and overall principles.
+
+    --- CONTEXT ---
+    Maximum Possible Mark: {max_mark}
+    Overall Marking Principles for this test: "{marking_principles}"
+    Model Answer (The ideal response for this question): "{model_answer}"
+    Marking Scheme (Specific points for this question): "{marking_scheme}"
+
+    --- STUDENTS' RESPONSES ---
+    A JSON array. Each item has the "answer_id" and the student's "text".
+    {responses}
+
+    --- INSTRUCTIONS ---
+    Grade every response on its own; do not compare students with each other. For each response:
+    1.  First, consider the "Overall Marking Principles". If the principles are empty, ignore this step.
+    2.  Then, carefully compare the response to the "Model Answer" and the "Marking Scheme".
+    3.  Calculate the "Mark Gained". This MUST be a number between 0 and {max_mark}.
+    4.  Write a brief "Summary" of the evaluation.
+    5.  Identify specific "Strengths" where the answer correctly aligns with the marking scheme.
+    6.  Identify specific "Improvement Points" where the answer is lacking or incorrect.
+
+    --- OUTPUT FORMAT ---
+    You MUST provide your response as a single, valid JSON array with exactly one object per response, in any order. Do not include any text before or after the JSON array.
+    Example JSON format:
+    [
+        {{
+            "answer_id": 12,
+            "mark_gained": 8.5,
+            "summary": "The student correctly identified the main causes but missed one key detail about the consequences.",
+            "strengths": "Good explanation of Cause A and Cause B, aligning with the model answer.",
+            "improvements": "The answer did not mention the long-term economic impact, which was worth 2 marks according to the scheme."
+        }}
+    ]
     """
-    Uses Google Gemini to generate an ideal model answer based on a question,
-    its marking scheme, and an optional image.
+
+def split_into_batches(answers, shared_tokens, token_budget=BATCH_TOKEN_BUDGET, max_answers=BATCH_MAX_ANSWERS):
+    """
+    Groups answer ids so each batch's prompt stays within the token budget.
+    A single answer that is too big on its own still gets a batch to itself.
     """
+    batches, current, current_tokens = [], [], shared_tokens
+    for answer_id, text in answers.items():
+        # Leave room for the JSON wrapper around each answer and for its reply.
+        item_tokens = estimate_tokens(fit_prompt_field('student_answer_text', text)) + 150
+        if current and (current_tokens + item_tokens > token_budget or len(current) >= max_answers):
+            batches.append(current)
+            current, current_tokens = [], shared_tokens
+        current.append(answer_id)
+        current_tokens += item_tokens
+    if current:
+        batches.append(current)
+    return batches
+
+def _valid_batch_items(ai_output, expected_ids, max_mark):
+    """Yields (answer_id, result) for every well-formed item that belongs to this batch."""
+    if not isinstance(ai_output, list):
+        return
+    for item in ai_output:
+        if not isinstance(item, dict):
+            continue
+        answer_id = item.get('answer_id')
+        if answer_id not in expected_ids:
+            continue
+        try:
+            mark = float(item.get('mark_gained'))
+        except (ValueError, TypeError):
+            continue
+        if not 0 <= mark <= max_mark:
+            continue
+        yield answer_id, normalise_evaluation(item)
+
+# Gemini can't serve requests right now: out of quota, its circuit is open,
+# or a server error outlasted the retries. Grading a failed batch's answers
+# one by one would only repeat the error once per answer.
+PROVIDER_ERRORS = RETRYABLE_ERRORS + (google_exceptions.ServerError, CircuitOpenError)
+# Gemini answered, but not with a usable batch reply: a request it rejected
+# (e.g. too long), a blocked response, or text that isn't the JSON asked for.
+# The answers are then worth grading one by one.
+BATCH_REPLY_ERRORS = (google_exceptions.InvalidArgument, ValueError)
+
+def evaluate_answers_batch_with_ai(answers, model_answer, marking_scheme, max_mark, marking_principles=""):
+    """
+    Uses Google Gemini to evaluate many answers to one question in as few
+    requests as the token budget allows. `answers` maps answer id to text.
+    Returns a dict of answer id to the same result dict evaluate_answer_with_ai
+    gives. Answers missing from, or malformed in, a batch reply are re-run one by one.
+    After a provider error (PROVIDER_ERRORS) no more requests are made: every
+    answer not graded yet gets a failed result instead.
+    A batch call's tokens are split evenly over the answers it graded.
+    """
+    warn_truncated_fields(model_answer=model_answer, marking_scheme=marking_scheme,
+                          marking_principles=marking_principles)
+    shared_tokens = estimate_tokens(
+        build_batch_evaluation_prompt({}, model_answer, marking_scheme, max_mark, marking_principles)
+    )
+    results = {}
+    for batch_ids in split_into_batches(answers, shared_tokens):
+        if len(batch_ids) == 1:
+            continue  # Nothing to share; the per-answer fallback below handles it.
+        prompt = build_batch_evaluation_prompt(
+            {answer_id: answers[answer_id] for answer_id in batch_ids},
+            model_answer, marking_scheme, max_mark, marking_principles
+        )
+        started = time.perf_counter()
+        try:
+            model = get_gemini_model()
+            response = call_with_limits(
+                'gemini', lambda: model.generate_content(prompt, request_options={'timeout': GEMINI_TIMEOUT}),
+                tokens=estimate_tokens(prompt), lease_seconds=GEMINI_SLOT_LEASE
+            )
+            batch_results = dict(_valid_batch_items(parse_json_response(response.text), set(batch_ids), max_mark))
+        except PROVIDER_ERRORS as e:
+            print(f"AI Batch Evaluation Error: {e}")
+            failure = evaluation_failure(e)
+            return {answer_id: results.get(answer_id, failure) for answer_id in answers}
+        except BATCH_REPLY_ERRORS as e:
+            print(f"AI Batch Evaluation Error: {e}")
+            continue
+        usage = response_usage(response, estimate_tokens(prompt), started)
+        record_tokens('gemini', usage['output_tokens'])
+        for result in batch_results.values():
+            result['usage'] = {
+                'input_tokens': usage['input_tokens'] // len(batch_results),
+                'output_tokens': usage['output_tokens'] // len(batch_results),
+                'latency_ms': usage['latency_ms'],
+            }
+        results.update(batch_results)
+
+    for answer_id, text in answers.items():
+        if answer_id not in results:
+            results[answer_id] = evaluate_answer_with_ai(text, model_answer, marking_scheme,
+                                                         max_mark, marking_principles)
+    return results
     
-    # Start building the content that we will send to the AI
-    # This always includes the text part of the prompt.
-    prompt_parts = [
-        f"""
+def build_model_answer_prompt(question_description, marking_scheme):
+    """Builds the text part of the model answer prompt, within PROMPT_FIELD_BUDGETS."""
+    question_description = fit_prompt_field('question_description', question_description)
+    marking_scheme = fit_prompt_field('marking_scheme', marking_scheme)
+    return f"""
         You are an expert teacher and subject matter expert. Your task is to write an ideal, comprehensive model answer for a test question.
 
         --- QUESTION DETAILS ---
@@ -124,13 +632,27 @@ def generate_model_answer_with_ai(question_description, marking_scheme, image_pa
 
         --- MODEL ANSWER ---
         """
-    ]
 
-    # If an image path was provided, open the image and add it to our content list
-    if image_path:
+# Returned instead of an answer when generation fails.
+MODEL_ANSWER_ERROR_PREFIX = "Error generating model answer"
+
+def generate_model_answer_with_ai(question_description, marking_scheme, image=None):
+    """
+    Uses Google Gemini to generate an ideal model answer based on a question,
+    its marking scheme, and an optional image (bytes, a path or a file-like
+    object, e.g. the uploaded file itself).
+    """
+    
+    warn_truncated_fields(question_description=question_description, marking_scheme=marking_scheme)
+
+    # Start building the content that we will send to the AI
+    # This always includes the text part of the prompt.
+    prompt_parts = [build_model_answer_prompt(question_description, marking_scheme)]
+
+    # If an image was provided, add it to our content list
+    if image:
         try:
-            img = PIL.Image.open(image_path)
-            prompt_parts.append(img)
+            prompt_parts.append(gemini_image_part(image))
         except Exception as e:
             print(f"Error opening image for AI Vision: {e}")
             # If the image fails to load, we can proceed with just the text
@@ -139,11 +661,84 @@ def generate_model_answer_with_ai(question_description, marking_scheme, image_pa
 
     try:
         # We use a multimodal model that can handle both text and images
-        model = genai.GenerativeModel('gemini-1.5-flash')
+        model = get_gemini_model()
         
         # We pass the list of content parts (text and optionally an image)
-        response = model.generate_content(prompt_parts)
+        response = call_with_limits(
+            'gemini', lambda: model.generate_content(prompt_parts, request_options={'timeout': GEMINI_TIMEOUT}),
+            tokens=estimate_tokens(prompt_parts[0]), lease_seconds=GEMINI_SLOT_LEASE
+        )
+        return response.text.strip()
+    except Exception as e:
+        print(f"AI Model Answer Generation Error: {e}")
+        return f"{MODEL_ANSWER_ERROR_PREFIX}: {str(e)}"
+
+
+# --- ASYNC VARIANTS ---
+# Used by the async views (api/async_views.py). They await the AI instead of
+# blocking a thread, so one ASGI worker can wait on many slow calls at once.
+
+async def perform_ocr_content_async(content):
+    """Async perform_ocr_content, using the asyncio Vision client."""
+    request = vision.AnnotateImageRequest(
+        image=vision.Image(content=content),
+        features=[vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)],
+    )
+    try:
+        client = get_async_vision_client()
+        response = await acall_with_limits(
+            'vision', lambda: client.batch_annotate_images(requests=[request], timeout=VISION_TIMEOUT),
+            lease_seconds=VISION_SLOT_LEASE, hedge=True
+        )
+        image_response = response.responses[0]
+        if image_response.error.code:
+            return f"OCR Failed: {image_response.error.message}"
+        return image_response.full_text_annotation.text if image_response.full_text_annotation else ""
+    except Exception as e:
+        print(f"OCR Error: {e}")
+        return f"OCR Failed: {str(e)}"
+
+async def evaluate_answer_with_ai_async(student_answer_text, model_answer, marking_scheme, max_mark,
+                                        marking_principles=""):
+    """Async evaluate_answer_with_ai, using generate_content_async."""
+    warn_truncated_fields(student_answer_text=student_answer_text, model_answer=model_answer,
+                          marking_scheme=marking_scheme, marking_principles=marking_principles)
+    prompt = build_evaluation_prompt(student_answer_text, model_answer, marking_scheme,
+                                     max_mark, marking_principles)
+
+    started, response = time.perf_counter(), None
+    try:
+        model = get_async_gemini_model()
+        response = await acall_with_limits(
+            'gemini', lambda: model.generate_content_async(prompt, request_options={'timeout': GEMINI_TIMEOUT}),
+            tokens=estimate_tokens(prompt), lease_seconds=GEMINI_SLOT_LEASE, hedge=True
+        )
+        result = normalise_evaluation(parse_json_response(response.text))
+    except Exception as e:
+        print(f"AI Evaluation Error: {e}")
+        result = evaluation_failure(e)
+    result['usage'] = response_usage(response, estimate_tokens(prompt), started)
+    await sync_to_async(record_tokens)('gemini', result['usage']['output_tokens'])
+    return result
+
+async def generate_model_answer_with_ai_async(question_description, marking_scheme, image_content=None):
+    """Async generate_model_answer_with_ai. The optional image is passed as bytes."""
+    warn_truncated_fields(question_description=question_description, marking_scheme=marking_scheme)
+    prompt_parts = [build_model_answer_prompt(question_description, marking_scheme)]
+    if image_content:
+        try:
+            prompt_parts.append(gemini_image_part(image_content))
+        except Exception as e:
+            print(f"Error opening image for AI Vision: {e}")
+
+    try:
+        model = get_async_gemini_model()
+        response = await acall_with_limits(
+            'gemini',
+            lambda: model.generate_content_async(prompt_parts, request_options={'timeout': GEMINI_TIMEOUT}),
+            tokens=estimate_tokens(prompt_parts[0]), lease_seconds=GEMINI_SLOT_LEASE
+        )
         return response.text.strip()
     except Exception as e:
         print(f"AI Model Answer Generation Error: {e}")
-        return f"Error generating model answer: {str(e)}"
\ No newline at end of file
+        return f"{MODEL_ANSWER_ERROR_PREFIX}: {str(e)}"
@@ -0,0 +1,81 @@
+# backend/api/storage_io.py
+
+import mimetypes
+import threading
+import weakref
+
+from botocore.exceptions import ClientError
+from storages.backends.s3 import S3Storage
+from storages.utils import clean_name, safe_join
+
+# Reads stored files by name instead of through a local path, so the same
+# code works with local media and with S3/Supabase. For S3 storage every
+# thread in the process uses the same boto3 client (clients are thread-safe),
+# so OCR workers reuse one connection pool instead of each thread opening its
+# own session the way S3Storage.connection does. The pool size is set with
+# AWS_S3_CLIENT_CONFIG, like the rest of the storage's client options.
+
+_s3_clients = weakref.WeakKeyDictionary()
+_s3_clients_lock = threading.Lock()
+
+
+def is_s3_storage(storage):
+    return isinstance(storage, S3Storage)
+
+def s3_client(storage):
+    """
+    The storage's boto3 client, made once per storage instance, so storages
+    with different credentials or endpoints never share one.
+    """
+    with _s3_clients_lock:
+        client = _s3_clients.get(storage)
+        if client is None:
+            client = _s3_clients[storage] = storage.connection.meta.client
+    return client
+
+def s3_key(storage, name):
+    """The object key S3Storage uses for a stored name (the name under the storage's location)."""
+    return safe_join(storage.location, clean_name(name))
+
+def read_file(storage, name, length=None):
+    """
+    The stored file's bytes, or only its first `length` bytes, read whole
+    into memory (from S3 with one GET). Nothing is spooled: what bounds the
+    memory used is the size limit applied when the file was uploaded.
+    """
+    if is_s3_storage(storage):
+        params = {'Range': f"bytes=0-{length - 1}"} if length else {}
+        body = s3_client(storage).get_object(Bucket=storage.bucket_name, Key=s3_key(storage, name), **params)['Body']
+        with body:
+            return body.read()
+    with storage.open(name, 'rb') as f:
+        return f.read(length) if length else f.read()
+
+def file_info(storage, name):
+    """{'size', 'content_type'} of a stored file, or None if there is no such file."""
+    if is_s3_storage(storage):
+        try:
+            head = s3_client(storage).head_object(Bucket=storage.bucket_name, Key=s3_key(storage, name))
+        except ClientError as e:
+            if e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 404:
+                return None
+            raise
+        return {'size': head['ContentLength'], 'content_type': head.get('ContentType', '')}
+    if not storage.exists(name):
+        return None
+    return {'size': storage.size(name), 'content_type': mimetypes.guess_type(name)[0] or ''}
+
+def presigned_put(storage, name, content_type, expires_in):
+    """
+    A URL the client can PUT the file to directly, with the headers it must
+    send, or None when the storage can't sign uploads (local media).
+    """
+    if not is_s3_storage(storage):
+        return None
+    params = {'Bucket': storage.bucket_name, 'Key': s3_key(storage, name), 'ContentType': content_type}
+    params.update({key: value for key, value in storage.get_object_parameters(name).items() if key == 'CacheControl'})
+    url = s3_client(storage).generate_presigned_url('put_object', Params=params, ExpiresIn=expires_in)
+    headers = {'Content-Type': content_type}
+    if 'CacheControl' in params:
+        headers['Cache-Control'] = params['CacheControl']
+    return {'url': url, 'method': 'PUT', 'headers': headers}
@@ -0,0 +1,545 @@
+# backend/api/tasks.py
+
+import hashlib
+import threading
+import traceback
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from core.models import Test, StudentAnswer, MarkingJob, GradingJob, OcrCacheEntry
+from core.retrieval import build_index, format_sections, select_sections, split_sections
+from .services import VISION_MAX_IMAGES_PER_REQUEST, perform_ocr_content_async
+from .ocr_engines import get_ocr_engine
+from .evaluation_cache import evaluate_answer_cached, evaluate_answer_cached_async, evaluate_answers_batch_cached
+from .storage_io import read_file
+
+
+# --- SINGLE ANSWER HELPERS ---
+# These are shared by the per-answer endpoints and the bulk marking job.
+
+def get_principles_text(test, question=None):
+    """
+    Returns the extracted marking principles for a test, or an empty string
+    (also while extraction is pending or running, or if it failed). Given a
+    question, a document over PRINCIPLES_TOKEN_BUDGET is cut down to the
+    sections most relevant to the question's marking scheme.
+    """
+    principle = test.marking_principle
+    if not principle or principle.extraction_status != 'finished':
+        return ""
+    # Measured in the database (at estimate_tokens' four characters a token),
+    # so the pages are only loaded when the whole document is sent.
+    if (question is None or not settings.PRINCIPLES_RETRIEVAL
+            or principle.text_length() // 4 + 1 <= settings.PRINCIPLES_TOKEN_BUDGET):
+        return principle.full_text()
+    # Principles extracted before indexing existed are indexed on the fly.
+    index = principle.retrieval_index or build_index(split_sections([(None, principle.full_text())]))
+    query = f"{question.description or ''}\n{question.marking_scheme}"
+    return format_sections(select_sections(index, query, settings.PRINCIPLES_TOP_K,
+                                           settings.PRINCIPLES_TOKEN_BUDGET))
+
+def store_ocr_text(image_sha256, text, engine):
+    # update-then-insert rather than update_or_create: on SQLite the latter's
+    # locking transaction fails outright when parallel workers hit the same image.
+    now = timezone.now()
+    entries = OcrCacheEntry.objects.filter(image_sha256=image_sha256, engine=engine)
+    if not entries.update(text=text, last_used_at=now):
+        try:
+            OcrCacheEntry.objects.create(image_sha256=image_sha256, engine=engine, text=text, last_used_at=now)
+        except IntegrityError:
+            pass  # Another worker stored the same image first.
+
+def store_ocr_texts(texts, engine):
+    """Caches many {image_sha256: text} results of one engine at once, skipping failed reads."""
+    recognised = {h: text for h, text in texts.items() if not text.startswith("OCR Failed")}
+    existing = set(OcrCacheEntry.objects.filter(image_sha256__in=recognised, engine=engine)
+                   .values_list('image_sha256', flat=True))
+    for image_sha256 in existing:
+        store_ocr_text(image_sha256, recognised[image_sha256], engine)
+    OcrCacheEntry.objects.bulk_create(
+        [OcrCacheEntry(image_sha256=h, engine=engine, text=text) for h, text in recognised.items() if h not in existing],
+        ignore_conflicts=True,
+    )
+
+# Answers with no text yet, or whose last read failed (the error is stored as the text).
+NEEDS_OCR = models.Q(ocr_text__isnull=True) | models.Q(ocr_text="") | models.Q(ocr_text__startswith="OCR Failed")
+
+def needs_ocr(answer):
+    return not answer.ocr_text or answer.ocr_text.startswith("OCR Failed")
+
+# Images held in memory at once by ocr_answers_batch: one full Vision request.
+OCR_BATCH_SIZE = VISION_MAX_IMAGES_PER_REQUEST
+
+def read_answer_image(answer):
+    # Through the shared storage client, so it works the same on local media and S3.
+    return read_file(answer.uploaded_image.storage, answer.uploaded_image.name)
+
+def hash_image(content):
+    return hashlib.sha256(content).hexdigest()
+
+def ocr_answer(answer, force=False, engine=None):
+    """
+    Runs OCR on the answer's uploaded image and stores the recognised text.
+    An image the same engine read before is answered from the OCR cache unless force is True.
+    engine names the OCR engine; by default the test's, else the OCR_ENGINE setting.
+    """
+    ocr_engine = get_ocr_engine(engine or answer.question.test.ocr_engine)
+    content = None
+    if not answer.image_sha256:
+        # Answers uploaded before hashing existed, or straight to storage, get
+        # their hash on first OCR; the image read for it is reused below.
+        content = read_answer_image(answer)
+        answer.image_sha256 = hash_image(content)
+        answer.save(update_fields=['image_sha256'])
+
+    entry = None
+    if not force:
+        entry = OcrCacheEntry.objects.filter(image_sha256=answer.image_sha256, engine=ocr_engine.name).first()
+
+    if entry is not None:
+        OcrCacheEntry.objects.filter(pk=entry.pk).update(last_used_at=timezone.now())
+        answer.ocr_text = entry.text
+    else:
+        try:
+            if content is None:
+                content = read_answer_image(answer)
+        except Exception as e:
+            print(f"OCR Error: {e}")
+            answer.ocr_text = f"OCR Failed: {str(e)}"
+        else:
+            answer.ocr_text = ocr_engine.read_many([content])[0]
+        if not answer.ocr_text.startswith("OCR Failed"):
+            store_ocr_text(answer.image_sha256, answer.ocr_text, ocr_engine.name)
+    answer.save(update_fields=['ocr_text'])
+    return answer
+
+def ocr_answers_batch(answers, force=False, client=None, engine=None):
+    """
+    OCRs many answers in batches of the OCR engine (Vision requests, or
+    parallel Tesseract processes) and saves all the texts with a single
+    bulk_update. Images the engine read before (unless force) and duplicate
+    scans are only read once. Images are read one batch at a time, so memory
+    holds one batch of scans however many answers there are. engine defaults to the
+    OCR_ENGINE setting. Returns counts of cached, recognised and failed answers.
+    """
+    ocr_engine = get_ocr_engine(engine, vision_client=client)
+    answers = [answer for answer in answers if answer.uploaded_image]
+    cached, texts, pending = {}, {}, {}
+
+    def look_up(hashes):
+        if force or not hashes:
+            return
+        entries = OcrCacheEntry.objects.filter(engine=ocr_engine.name)
+        found = dict(entries.filter(image_sha256__in=hashes).values_list('image_sha256', 'text'))
+        entries.filter(image_sha256__in=found).update(last_used_at=timezone.now())
+        cached.update(found)
+
+    def read_pending():
+        texts.update(zip(pending, ocr_engine.read_many(list(pending.values()))))
+        store_ocr_texts({image_sha256: texts[image_sha256] for image_sha256 in pending}, ocr_engine.name)
+        pending.clear()
+
+    look_up({answer.image_sha256 for answer in answers if answer.image_sha256})
+    for answer in answers:
+        content = None
+        if not answer.image_sha256:
+            # Answers uploaded before hashing existed, or straight to storage, get
+            # their hash here; the image read for it is reused for the OCR.
+            content = read_answer_image(answer)
+            answer.image_sha256 = hash_image(content)
+            if answer.image_sha256 not in texts and answer.image_sha256 not in pending:
+                look_up({answer.image_sha256} - cached.keys())
+        # One OCR slot per distinct image that isn't cached.
+        if answer.image_sha256 in cached or answer.image_sha256 in texts or answer.image_sha256 in pending:
+            continue
+        pending[answer.image_sha256] = content if content is not None else read_answer_image(answer)
+        if len(pending) >= OCR_BATCH_SIZE:
+            read_pending()
+    if pending:
+        read_pending()
+
+    counts = {'cached': 0, 'recognised': 0, 'failed': 0}
+    for answer in answers:
+        if answer.image_sha256 in cached:
+            answer.ocr_text = cached[answer.image_sha256]
+            counts['cached'] += 1
+        else:
+            answer.ocr_text = texts[answer.image_sha256]
+            counts['failed' if answer.ocr_text.startswith("OCR Failed") else 'recognised'] += 1
+    StudentAnswer.objects.bulk_update(answers, ['ocr_text', 'image_sha256'])
+    return counts
+
+def _ocr_or_raise(answer, force=False, engine=None):
+    # OCR engines report errors in the returned text; background jobs need them raised.
+    ocr_answer(answer, force=force, engine=engine)
+    if answer.ocr_text.startswith("OCR Failed"):
+        raise RuntimeError(answer.ocr_text)
+
+def mark_answer(answer, student_answer_text=None, use_cache=True):
+    """
+    Evaluates the answer text with the AI and stores the result on the answer.
+    Unchanged inputs are answered from the evaluation cache unless use_cache is False.
+    """
+    if student_answer_text is None:
+        student_answer_text = answer.ocr_text
+    question = answer.question
+
+    evaluation_result = evaluate_answer_cached(
+        student_answer_text=student_answer_text, model_answer=question.model_answer,
+        marking_scheme=question.marking_scheme, max_mark=question.max_mark,
+        marking_principles=get_principles_text(question.test, question), use_cache=use_cache
+    )
+    raise_if_failed(evaluation_result)
+    return save_evaluation(answer, student_answer_text, evaluation_result)
+
+def raise_if_failed(evaluation_result):
+    # A failed AI call must not be stored as a mark of 0; the answer stays
+    # unevaluated and the caller reports (or retries) the error.
+    if evaluation_result.get('failed'):
+        raise RuntimeError(evaluation_result['summary'])
+
+def save_evaluation(answer, student_answer_text, evaluation_result):
+    """Stores an AI evaluation result on the answer and marks it evaluated."""
+    answer.ocr_text = student_answer_text
+    answer.mark_gained = evaluation_result['mark_gained']
+    answer.ai_evaluation_summary = evaluation_result['summary']
+    answer.ai_strength_points = evaluation_result['strengths']
+    answer.ai_improvement_points = evaluation_result['improvements']
+    answer.is_evaluated = True
+    usage = evaluation_result.get('usage') or {}
+    # A cache hit costs nothing, so it must not wipe out the tokens recorded for
+    # the answer's earlier paid call; it's only recorded (as 0) on a first evaluation.
+    if not usage.get('cached') or answer.input_tokens is None:
+        answer.input_tokens = usage.get('input_tokens')
+        answer.output_tokens = usage.get('output_tokens')
+        answer.evaluation_latency_ms = usage.get('latency_ms')
+    answer.save()
+    return answer
+
+
+
+# --- ASYNC VARIANTS ---
+# For the async views. The answer must come with question__test (and, for
+# marking, the test's marking_principle) already loaded.
+
+async def ocr_answer_async(answer, force=False, engine=None):
+    """
+    Async ocr_answer. Vision is awaited on the event loop; the local engines
+    are CPU-bound, so they run in a worker thread.
+    """
+    ocr_engine = get_ocr_engine(engine or answer.question.test.ocr_engine)
+    content = None
+    if not answer.image_sha256:
+        content = await sync_to_async(read_answer_image)(answer)
+        answer.image_sha256 = hash_image(content)
+        await answer.asave(update_fields=['image_sha256'])
+
+    entry = None
+    if not force:
+        entry = await OcrCacheEntry.objects.filter(image_sha256=answer.image_sha256,
+                                                   engine=ocr_engine.name).afirst()
+
+    if entry is not None:
+        await OcrCacheEntry.objects.filter(pk=entry.pk).aupdate(last_used_at=timezone.now())
+        answer.ocr_text = entry.text
+    else:
+        try:
+            if content is None:
+                content = await sync_to_async(read_answer_image)(answer)
+        except Exception as e:
+            print(f"OCR Error: {e}")
+            answer.ocr_text = f"OCR Failed: {str(e)}"
+        else:
+            if ocr_engine.name == 'vision':
+                answer.ocr_text = await perform_ocr_content_async(content)
+            else:
+                texts = await sync_to_async(ocr_engine.read_many, thread_sensitive=False)([content])
+                answer.ocr_text = texts[0]
+        if not answer.ocr_text.startswith("OCR Failed"):
+            await sync_to_async(store_ocr_text)(answer.image_sha256, answer.ocr_text, ocr_engine.name)
+    await answer.asave(update_fields=['ocr_text'])
+    return answer
+
+async def mark_answer_async(answer, student_answer_text=None, use_cache=True):
+    """Async mark_answer."""
+    if student_answer_text is None:
+        student_answer_text = answer.ocr_text
+    question = answer.question
+
+    evaluation_result = await evaluate_answer_cached_async(
+        student_answer_text=student_answer_text, model_answer=question.model_answer,
+        marking_scheme=question.marking_scheme, max_mark=question.max_mark,
+        marking_principles=get_principles_text(question.test, question), use_cache=use_cache
+    )
+    raise_if_failed(evaluation_result)
+    return await sync_to_async(save_evaluation)(answer, student_answer_text, evaluation_result)
+
+# --- BULK MARKING ---
+
+def start_marking_job(test, concurrency=None, batched=None):
+    """
+    Creates a MarkingJob for every unevaluated answer of the test and grades
+    them on a background thread. Returns (job, created) straight away.
+    In batched mode all answers to a question are graded in shared Gemini requests.
+    A test has at most one queued or running job; while it does, that job is
+    returned with created=False and nothing new starts.
+    """
+    if concurrency is None:
+        concurrency = settings.GRADING_CONCURRENCY
+    concurrency = max(1, min(int(concurrency), settings.GRADING_CONCURRENCY))
+    if batched is None:
+        batched = settings.MARK_ALL_BATCHED
+    fail_stale_marking_jobs()
+
+    with transaction.atomic():
+        # Locking the test row makes a second request wait here until the
+        # first one's job is committed, so it finds that job below.
+        Test.objects.select_for_update().get(pk=test.pk)
+        active = MarkingJob.objects.filter(test=test, status__in=('queued', 'running')).first()
+        if active is not None:
+            return active, False
+
+        answer_ids = list(
+            StudentAnswer.objects.filter(question__test=test, is_evaluated=False)
+            .values_list('id', flat=True)
+        )
+        job = MarkingJob.objects.create(test=test, concurrency=concurrency, batched=batched,
+                                        total=len(answer_ids))
+
+        thread = threading.Thread(
+            target=run_marking_job, args=(job.id, answer_ids, concurrency, batched),
+            name=f"marking-job-{job.id}", daemon=True
+        )
+        # Only start once the job row is visible to the worker's own connection.
+        transaction.on_commit(thread.start)
+    return job, True
+
+def fail_stale_marking_jobs():
+    """Marks queued and running jobs whose worker stopped sending heartbeats as failed. Returns how many."""
+    now = timezone.now()
+    cutoff = now - timedelta(seconds=settings.MARKING_JOB_STALE_SECONDS)
+    return MarkingJob.objects.filter(status__in=('queued', 'running')).filter(
+        models.Q(heartbeat_at__lt=cutoff) | models.Q(heartbeat_at__isnull=True, created_at__lt=cutoff)
+    ).update(status='failed', finished_at=now,
+             error="The job's worker stopped before it finished (the server may have restarted).")
+
+def _send_heartbeats(job_id, stop):
+    try:
+        while not stop.wait(settings.MARKING_JOB_HEARTBEAT_SECONDS):
+            MarkingJob.objects.filter(pk=job_id, status='running').update(heartbeat_at=timezone.now())
+    finally:
+        connection.close()
+
+def run_marking_job(job_id, answer_ids, concurrency, batched=False):
+    """Grades the given answers in parallel, recording progress (and a heartbeat) on the job."""
+    MarkingJob.objects.filter(pk=job_id).update(status='running', heartbeat_at=timezone.now())
+    stop = threading.Event()
+    threading.Thread(target=_send_heartbeats, args=(job_id, stop),
+                     name=f"marking-job-{job_id}-heartbeat", daemon=True).start()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"marking-{job_id}") as pool:
+            if not batched:
+                for answer_id in answer_ids:
+                    pool.submit(_grade_answer_for_job, job_id, answer_id)
+                return
+
+            # OCR every answer that still needs it, then grade one batch per question.
+            unread = list(StudentAnswer.objects.filter(pk__in=answer_ids).filter(NEEDS_OCR)
+                          .values_list('id', flat=True))
+            ocr_failed = set(filter(None, pool.map(_ocr_for_job, [job_id] * len(unread), unread)))
+
+            by_question = defaultdict(list)
+            for answer_id, question_id in StudentAnswer.objects.filter(
+                pk__in=set(answer_ids) - ocr_failed
+            ).values_list('id', 'question_id'):
+                by_question[question_id].append(answer_id)
+            for question_answer_ids in by_question.values():
+                pool.submit(_grade_question_for_job, job_id, question_answer_ids)
+    finally:
+        stop.set()
+        MarkingJob.objects.filter(pk=job_id).update(status='finished', finished_at=timezone.now())
+        connection.close()
+
+def _count_for_job(job_id, outcome, count=1):
+    MarkingJob.objects.filter(pk=job_id).update(**{outcome: F(outcome) + count})
+
+def _grade_answer_for_job(job_id, answer_id):
+    try:
+        answer = StudentAnswer.objects.select_related(
+            'question__test__marking_principle'
+        ).get(pk=answer_id)
+        if needs_ocr(answer):
+            _ocr_or_raise(answer)
+        mark_answer(answer)
+        _count_for_job(job_id, 'done')
+    except Exception:
+        traceback.print_exc()
+        _count_for_job(job_id, 'failed')
+    finally:
+        # Each pool thread has its own DB connection; don't leak it.
+        connection.close()
+
+def _ocr_for_job(job_id, answer_id):
+    """Batched mode: OCRs one answer. Returns the answer id if it failed, else None."""
+    try:
+        _ocr_or_raise(StudentAnswer.objects.select_related('question__test').get(pk=answer_id))
+        return None
+    except Exception:
+        traceback.print_exc()
+        _count_for_job(job_id, 'failed')
+        return answer_id
+    finally:
+        connection.close()
+
+def _grade_question_for_job(job_id, answer_ids):
+    """Batched mode: grades all the given answers (to one question) together."""
+    answers = {
+        answer.id: answer for answer in StudentAnswer.objects.select_related(
+            'question__test__marking_principle'
+        ).filter(pk__in=answer_ids)
+    }
+    counted = set()
+    try:
+        question = next(iter(answers.values())).question
+        results = evaluate_answers_batch_cached(
+            {answer_id: answer.ocr_text for answer_id, answer in answers.items()},
+            model_answer=question.model_answer, marking_scheme=question.marking_scheme,
+            max_mark=question.max_mark, marking_principles=get_principles_text(question.test, question)
+        )
+        for answer_id, answer in answers.items():
+            result = results[answer_id]
+            if result.get('failed'):
+                _count_for_job(job_id, 'failed')
+            else:
+                save_evaluation(answer, answer.ocr_text, result)
+                _count_for_job(job_id, 'done')
+            counted.add(answer_id)
+    except Exception:
+        traceback.print_exc()
+        _count_for_job(job_id, 'failed', len(answers) - len(counted))
+    finally:
+        connection.close()
+
+
+# --- PERSISTENT JOB QUEUE ---
+# Jobs are rows in GradingJob; `manage.py grading_worker` claims and runs them.
+# A claimed job is leased to its worker, which renews the lease while it runs.
+
+CLAIMABLE_STATUSES = ('queued', 'retried')
+
+def claimable_jobs(now):
+    """Queued jobs, retries whose delay is over, and running jobs whose worker's lease ran out."""
+    return GradingJob.objects.filter(
+        models.Q(status__in=CLAIMABLE_STATUSES) & (models.Q(run_after__isnull=True) | models.Q(run_after__lte=now))
+        | models.Q(status='running', lease_until__lt=now, attempts__lt=F('max_attempts'))
+    )
+
+def fail_abandoned_grading_jobs(now):
+    """Fails running jobs whose lease ran out on their last attempt. Returns how many."""
+    return GradingJob.objects.filter(
+        status='running', lease_until__lt=now, attempts__gte=F('max_attempts')
+    ).update(status='failed', finished_at=now,
+             error="The worker running the job stopped before it finished.")
+
+def enqueue_grading_job(answer, kind, **payload):
+    """Queues an OCR or marking job for the answer and returns it."""
+    return GradingJob.objects.create(answer=answer, kind=kind, payload=payload)
+
+def enqueue_grading_jobs(answers, kind, **payload):
+    """Queues the same kind of job for many answers in one INSERT per batch. Returns how many."""
+    jobs = GradingJob.objects.bulk_create(
+        [GradingJob(answer=answer, kind=kind, payload=payload) for answer in answers], batch_size=500
+    )
+    return len(jobs)
+
+def claim_next_grading_job():
+    """
+    Atomically moves the oldest claimable job to 'running', leases it to the
+    caller and returns it, or returns None when there is nothing to run.
+    Safe to call from many workers.
+    """
+    now = timezone.now()
+    fail_abandoned_grading_jobs(now)
+    claimable = claimable_jobs(now).order_by('created_at')
+    claim = dict(status='running', started_at=now, attempts=F('attempts') + 1,
+                 lease_until=now + timedelta(seconds=settings.GRADING_JOB_LEASE_SECONDS))
+
+    if connection.features.has_select_for_update_skip_locked:
+        # Postgres: SELECT ... FOR UPDATE SKIP LOCKED lets workers pass over
+        # rows another worker is busy claiming instead of waiting on them.
+        with transaction.atomic():
+            job = claimable.select_for_update(skip_locked=True).first()
+            if job is None:
+                return None
+            GradingJob.objects.filter(pk=job.pk).update(**claim)
+    else:
+        # SQLite has no row locks. A conditional UPDATE is atomic, so only
+        # one worker sees a row count of 1 for a given job.
+        for job_id in claimable.values_list('id', flat=True)[:20]:
+            if claimable_jobs(now).filter(pk=job_id).update(**claim):
+                break
+        else:
+            return None
+        job = GradingJob(pk=job_id)
+
+    job.refresh_from_db()
+    return job
+
+def _renew_lease(job, stop):
+    lease = settings.GRADING_JOB_LEASE_SECONDS
+    try:
+        while not stop.wait(lease / 3):
+            # attempts identifies this claim: if the job was reclaimed, it's no longer ours to renew.
+            GradingJob.objects.filter(pk=job.pk, status='running', attempts=job.attempts).update(
+                lease_until=timezone.now() + timedelta(seconds=lease))
+    finally:
+        connection.close()
+
+def retry_delay(attempts):
+    """Seconds before a job that failed its nth attempt is run again."""
+    delay = settings.GRADING_JOB_RETRY_DELAY_SECONDS * 2 ** max(attempts - 1, 0)
+    return min(delay, settings.GRADING_JOB_RETRY_MAX_DELAY_SECONDS)
+
+def run_grading_job(job):
+    """
+    Runs a claimed job and records the outcome, requeueing it with a delay if
+    attempts remain. The outcome isn't saved if another worker reclaimed the
+    job after this one's lease ran out.
+    """
+    stop = threading.Event()
+    threading.Thread(target=_renew_lease, args=(job, stop), name=f"grading-job-{job.pk}-lease",
+                     daemon=True).start()
+    try:
+        answer = StudentAnswer.objects.select_related(
+            'question__test__marking_principle'
+        ).get(pk=job.answer_id)
+        if job.kind == 'ocr':
+            _ocr_or_raise(answer, force=job.payload.get('force', False), engine=job.payload.get('engine'))
+        elif job.kind == 'marking':
+            if not job.payload.get('corrected_text') and needs_ocr(answer):
+                _ocr_or_raise(answer)
+            mark_answer(answer, job.payload.get('corrected_text'),
+                        use_cache=not job.payload.get('force', False))
+        else:
+            raise ValueError(f"Unknown job kind: {job.kind}")
+    except Exception as e:
+        traceback.print_exc()
+        job.status = 'retried' if job.attempts < job.max_attempts else 'failed'
+        job.error = str(e)
+    else:
+        job.status = 'succeeded'
+        job.error = ""
+    finally:
+        stop.set()
+    job.finished_at = timezone.now()
+    job.run_after = job.finished_at + timedelta(seconds=retry_delay(job.attempts)) if job.status == 'retried' else None
+    GradingJob.objects.filter(pk=job.pk, status='running', attempts=job.attempts).update(
+        status=job.status, error=job.error, finished_at=job.finished_at, run_after=job.run_after, lease_until=None)
+    return job
@@ -1,3 +1,917 @@
-from django.test import TestCase
+import asyncio
+import io
+import itertools
+import json
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock, skipIf
+
+import boto3
+import google.generativeai as genai
+import requests
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from google.api_core import exceptions as google_exceptions
+from google.cloud import vision
+from google.generativeai import client as genai_client, protos
+from PIL import Image
+from rest_framework.test import APIClient
+
+from core.models import (Class, Student, Test, Question, StudentAnswer, CacheLookupStats, ConcurrencySlot,
+                         EvaluationCacheEntry, GradingJob, IndexVersion, MarkingJob, MarkingPrinciple,
+                         MarkingPrincipleChunk, OcrCacheEntry)
+from core.principles import extract_principle
+from core import question_index
+from core.question_index import QuestionIndex
+from . import evaluation_cache, model_answers, ocr_engines, ratelimit, scripts, services, tasks
+from .imaging import crop_to_content
+from .resilience import CircuitOpenError
+from .services import gemini_image_part, get_async_gemini_model, read_image
+from .storage_io import s3_key
+from .tasks import OCR_BATCH_SIZE, hash_image, mark_answer, ocr_answers_batch
+
+
+def seed_test(student_count, question_count=3):
+    """A test with every student's answers already marked. Images are names only; nothing is read from storage."""
+    class_group = Class.objects.create(name="Class")
+    test = Test.objects.create(class_group=class_group, name="Test")
+    questions = [
+        Question.objects.create(test=test, q_number=number, model_answer="-", marking_scheme="-")
+        for number in range(1, question_count + 1)
+    ]
+    students = Student.objects.bulk_create([
+        Student(class_group=class_group, name=f"Student {i}") for i in range(student_count)
+    ])
+    StudentAnswer.objects.bulk_create([
+        StudentAnswer(student=student, question=question,
+                      uploaded_image=f"student_answers/{student.id}_{question.id}.png",
+                      ocr_text="answer", mark_gained=question.q_number, is_evaluated=True)
+        for student in students for question in questions
+    ])
+    return test
+
+
+try:
+    from moto import mock_aws
+except ImportError:  # moto is only needed for the S3 tests.
+    mock_aws = None
+
+
+class ResultsQueryCountTests(TestCase):
+    # /api/tests/<id>/results/ must cost the same number of queries whatever the class size:
+    # the test, its questions, and the students with their answers annotated in one query.
+    QUERIES = 3
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def assert_results_queries(self, student_count):
+        test = seed_test(student_count)
+        with self.assertNumQueries(self.QUERIES):
+            response = self.client.get(f'/api/tests/{test.id}/results/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['students']), student_count)
+        return response
+
+    def test_one_student(self):
+        response = self.assert_results_queries(1)
+        self.assertEqual(response.data['students'][0]['total_mark_gained'], 6)
+
+    def test_many_students(self):
+        self.assert_results_queries(40)
+
+
+class FakeVisionClient:
+    """
+    Stands in for the Vision client: each image's "text" is its bytes, and
+    images whose bytes start with b'unreadable' come back with an error.
+    Records the images sent in each request.
+    """
+
+    def __init__(self):
+        self.requests = []
+
+    def batch_annotate_images(self, requests, timeout=None):
+        contents = [request.image.content for request in requests]
+        self.requests.append(contents)
+        return vision.BatchAnnotateImagesResponse(responses=[self.annotate(content) for content in contents])
+
+    def document_text_detection(self, image, timeout=None):
+        self.requests.append([image.content])
+        return self.annotate(image.content)
+
+    def annotate(self, content):
+        if content.startswith(b'unreadable'):
+            return vision.AnnotateImageResponse(error={'code': 3, 'message': "Bad image data."})
+        return vision.AnnotateImageResponse(full_text_annotation={'text': content.decode()})
+
+    def images_sent(self):
+        return [content for request in self.requests for content in request]
+
+
+class BatchOcrTests(TransactionTestCase):
+    # Vision batches run on worker threads whose rate limit and circuit writes
+    # need the data committed, hence TransactionTestCase.
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        media = override_settings(MEDIA_ROOT=self.media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        self.client_vision = FakeVisionClient()
+        self.class_group = Class.objects.create(name="Class")
+        self.test = Test.objects.create(class_group=self.class_group, name="Test")
+        self.question = Question.objects.create(test=self.test, q_number=1, model_answer="-", marking_scheme="-")
+
+    def answers(self, *contents, hashed=True):
+        """One stored answer per image. hashed=False leaves image_sha256 empty, as for direct uploads."""
+        answers = []
+        for index, content in enumerate(contents):
+            name = default_storage.save(f"student_answers/scan_{index}.png", ContentFile(content))
+            student = Student.objects.create(class_group=self.class_group, name=f"Student {index}")
+            answers.append(StudentAnswer(student=student, question=self.question, uploaded_image=name,
+                                         image_sha256=hash_image(content) if hashed else ""))
+        return StudentAnswer.objects.bulk_create(answers)
+
+    def run_batch(self, answers, **kwargs):
+        return ocr_answers_batch(answers, client=self.client_vision, engine='vision', **kwargs)
+
+    def test_cached_and_duplicate_scans_are_read_once(self):
+        answers = self.answers(b'seen before', b'same scan', b'same scan', b'new scan')
+        OcrCacheEntry.objects.create(image_sha256=hash_image(b'seen before'), engine='vision', text="cached text")
+
+        counts = self.run_batch(answers)
+
+        self.assertEqual(counts, {'cached': 1, 'recognised': 3, 'failed': 0})
+        self.assertEqual(sorted(self.client_vision.images_sent()), [b'new scan', b'same scan'])
+        texts = dict(StudentAnswer.objects.values_list('id', 'ocr_text'))
+        self.assertEqual([texts[answer.id] for answer in answers],
+                         ["cached text", "same scan", "same scan", "new scan"])
+        self.assertEqual(OcrCacheEntry.objects.get(image_sha256=hash_image(b'new scan')).text, "new scan")
+
+    def test_force_ignores_the_cache(self):
+        answers = self.answers(b'seen before')
+        OcrCacheEntry.objects.create(image_sha256=hash_image(b'seen before'), engine='vision', text="cached text")
+
+        counts = self.run_batch(answers, force=True)
+
+        self.assertEqual(counts, {'cached': 0, 'recognised': 1, 'failed': 0})
+        self.assertEqual(OcrCacheEntry.objects.get().text, "seen before")
+
+    def test_failed_items_are_reported_and_not_cached(self):
+        answers = self.answers(b'good scan', b'unreadable scan')
+
+        counts = self.run_batch(answers)
+
+        self.assertEqual(counts, {'cached': 0, 'recognised': 1, 'failed': 1})
+        failed = StudentAnswer.objects.get(pk=answers[1].pk)
+        self.assertEqual(failed.ocr_text, "OCR Failed: Bad image data.")
+        self.assertEqual(list(OcrCacheEntry.objects.values_list('text', flat=True)), ["good scan"])
+
+    def test_unhashed_answers_are_hashed_from_the_same_read(self):
+        answers = self.answers(b'direct upload', b'seen before', hashed=False)
+        OcrCacheEntry.objects.create(image_sha256=hash_image(b'seen before'), engine='vision', text="cached text")
+
+        with mock.patch.object(tasks, 'read_answer_image', wraps=tasks.read_answer_image) as read:
+            counts = self.run_batch(answers)
+
+        self.assertEqual(read.call_count, 2)
+        self.assertEqual(counts, {'cached': 1, 'recognised': 1, 'failed': 0})
+        self.assertEqual(StudentAnswer.objects.get(pk=answers[0].pk).image_sha256, hash_image(b'direct upload'))
+
+    def test_results_are_saved_with_one_bulk_update(self):
+        answers = self.answers(b'first scan', b'second scan', b'third scan')
+
+        with mock.patch.object(StudentAnswer, 'save', side_effect=AssertionError("saved one at a time")), \
+                mock.patch.object(StudentAnswer.objects, 'bulk_update',
+                                  wraps=StudentAnswer.objects.bulk_update) as bulk_update:
+            self.run_batch(answers)
+
+        bulk_update.assert_called_once()
+        self.assertEqual(StudentAnswer.objects.filter(ocr_text__endswith="scan").count(), 3)
+
+    def test_the_cache_is_kept_per_engine(self):
+        answers = self.answers(b'scan')
+        tesseract_read = mock.patch.object(ocr_engines.TesseractEngine, 'read_with_confidence',
+                                           return_value=[("tesseract text", 90.0)])
+        with tesseract_read:
+            ocr_answers_batch(answers, engine='tesseract')
+        counts = self.run_batch(answers)
+
+        self.assertEqual(counts, {'cached': 0, 'recognised': 1, 'failed': 0})
+        self.assertEqual(StudentAnswer.objects.get(pk=answers[0].pk).ocr_text, "scan")
+        self.assertEqual(dict(OcrCacheEntry.objects.values_list('engine', 'text')),
+                         {'tesseract': "tesseract text", 'vision': "scan"})
+        with tesseract_read as read:
+            counts = ocr_answers_batch(answers, engine='tesseract')
+        read.assert_not_called()
+        self.assertEqual(counts['cached'], 1)
+
+    def test_images_are_read_one_batch_at_a_time(self):
+        answers = self.answers(*[f"scan {index}".encode() for index in range(OCR_BATCH_SIZE * 2 + 3)])
+        reads_before_request = []
+        send = self.client_vision.batch_annotate_images
+
+        def batch_annotate_images(requests, timeout=None):
+            reads_before_request.append(read.call_count)
+            return send(requests, timeout)
+
+        with mock.patch.object(tasks, 'read_answer_image', wraps=tasks.read_answer_image) as read, \
+                mock.patch.object(self.client_vision, 'batch_annotate_images', batch_annotate_images):
+            counts = self.run_batch(answers)
+
+        self.assertEqual(counts['recognised'], len(answers))
+        self.assertEqual(reads_before_request, [OCR_BATCH_SIZE, OCR_BATCH_SIZE * 2, len(answers)])
+
+
+class FakeProcessPool:
+    """A ProcessPoolExecutor that runs everything in this process."""
+    created = 0
+
+    def __init__(self, max_workers=None, initializer=None, initargs=()):
+        FakeProcessPool.created += 1
+        self.initializer, self.initargs = initializer, initargs
+
+    def map(self, fn, *iterables):
+        return map(fn, *iterables)
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
+
+
+@override_settings(OCR_LOCAL_WORKERS=4, TESSERACT_CMD='/opt/tesseract/bin/tesseract')
+class TesseractPoolTests(SimpleTestCase):
+    def setUp(self):
+        FakeProcessPool.created = 0
+        for patch in (mock.patch.object(ocr_engines, 'ProcessPoolExecutor', FakeProcessPool),
+                      mock.patch.object(ocr_engines, '_pool', None),
+                      mock.patch.object(ocr_engines, 'tesseract_read', return_value=("text", 90.0))):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_one_pool_serves_every_read(self):
+        engine = ocr_engines.TesseractEngine()
+        for _ in range(3):
+            self.assertEqual(engine.read_many([b'page 1', b'page 2']), ["text", "text"])
+        self.assertEqual(FakeProcessPool.created, 1)
+        # Workers set the Tesseract path once, as they start, not on every read.
+        self.assertEqual((ocr_engines._pool.initializer, ocr_engines._pool.initargs),
+                         (ocr_engines.configure_tesseract, ('/opt/tesseract/bin/tesseract',)))
+
+    def test_a_broken_pool_is_replaced(self):
+        engine = ocr_engines.TesseractEngine()
+        with mock.patch.object(FakeProcessPool, 'map', side_effect=ocr_engines.BrokenProcessPool):
+            self.assertEqual(engine.read_many([b'page 1', b'page 2']), ["text", "text"])
+        engine.read_many([b'page 1', b'page 2'])
+        self.assertEqual(FakeProcessPool.created, 2)
+
+
+S3_STORAGES = {
+    'default': {
+        'BACKEND': 'storages.backends.s3.S3Storage',
+        'OPTIONS': {'bucket_name': 'answers', 'location': 'media', 'access_key': 'test', 'secret_key': 'test',
+                    'region_name': 'us-east-1'},
+    },
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+
+
+@skipIf(mock_aws is None, "moto is not installed")
+class DirectUploadS3Tests(TestCase):
+    def setUp(self):
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='answers')
+        storages = override_settings(STORAGES=S3_STORAGES)
+        storages.enable()
+        self.addCleanup(storages.disable)
+        self.client = APIClient()
+        class_group = Class.objects.create(name="Class")
+        test = Test.objects.create(class_group=class_group, name="Test")
+        self.question = Question.objects.create(test=test, q_number=1, model_answer="-", marking_scheme="-")
+        self.student = Student.objects.create(class_group=class_group, name="Student")
+
+    def upload_url(self):
+        response = self.client.post('/api/answers/upload-url/', {
+            'student': self.student.id, 'question': self.question.id, 'content_type': 'image/jpeg',
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def put(self, upload, data):
+        response = requests.put(upload['url'], data=data, headers=upload['headers'])
+        self.assertEqual(response.status_code, 200)
+
+    def stored_keys(self):
+        bucket = boto3.client('s3', region_name='us-east-1').list_objects_v2(Bucket='answers')
+        return [item['Key'] for item in bucket.get('Contents', [])]
+
+    def test_presign_put_and_confirm(self):
+        upload = self.upload_url()
+        self.assertTrue(upload['url'].startswith('https://answers.s3.amazonaws.com/media/student_answers/direct/'))
+        image = io.BytesIO()
+        Image.new('RGB', (120, 90), 'red').save(image, format='JPEG')
+        self.put(upload, image.getvalue())
+
+        response = self.client.post('/api/answers/confirm-upload/', {'upload_token': upload['upload_token']},
+                                    format='json')
+
+        self.assertEqual(response.status_code, 200)
+        answer = StudentAnswer.objects.get(student=self.student, question=self.question)
+        self.assertTrue(answer.uploaded_image.name.startswith('student_answers/direct/'))
+        self.assertEqual(self.stored_keys(), [s3_key(answer.uploaded_image.storage, answer.uploaded_image.name)])
+        # Confirming again is harmless.
+        again = self.client.post('/api/answers/confirm-upload/', {'upload_token': upload['upload_token']},
+                                 format='json')
+        self.assertEqual(again.status_code, 200)
+        self.assertEqual(StudentAnswer.objects.count(), 1)
+
+    def test_confirm_rejects_and_deletes_a_non_image(self):
+        upload = self.upload_url()
+        self.put(upload, b'not an image')
+
+        response = self.client.post('/api/answers/confirm-upload/', {'upload_token': upload['upload_token']},
+                                    format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(StudentAnswer.objects.exists())
+        self.assertEqual(self.stored_keys(), [])
+
+    def test_confirm_before_upload(self):
+        upload = self.upload_url()
+        response = self.client.post('/api/answers/confirm-upload/', {'upload_token': upload['upload_token']},
+                                    format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class AsyncGeminiClientTests(SimpleTestCase):
+    def test_each_event_loop_gets_its_own_client(self):
+        # Async views under WSGI each run on a new loop; a gRPC client made on
+        # an earlier loop can't be used on the next one.
+        async def clients():
+            return get_async_gemini_model()._async_client, get_async_gemini_model()._async_client
+
+        first, same_loop = asyncio.run(clients())
+        second, _ = asyncio.run(clients())
+        self.assertIs(first, same_loop)
+        self.assertIsNot(first, second)
+
+    def test_genai_internals_are_still_there(self):
+        # The per-loop client relies on genai internals; an upgrade from the
+        # pinned release has to be checked again.
+        self.assertEqual(genai.__version__, services.GENAI_TESTED_VERSION)
+        sent = []
+
+        class FakeAsyncClient:
+            async def generate_content(self, request, **kwargs):
+                sent.append(request)
+                return protos.GenerateContentResponse()
+
+        with mock.patch.object(genai_client._client_manager, 'make_client', return_value=FakeAsyncClient()) as make:
+            asyncio.run(services.build_async_gemini_model().generate_content_async("Mark this."))
+        make.assert_called_once_with('generative_async')
+        self.assertEqual(len(sent), 1)
+
+
+@override_settings(EVALUATION_CACHE_BACKEND='db')
+class EvaluationUsageTests(TestCase):
+    def setUp(self):
+        test = seed_test(2, question_count=1)
+        self.test = test
+        self.answers = list(StudentAnswer.objects.filter(question__test=test).select_related('question__test'))
+
+    def evaluate(self, *args, **kwargs):
+        return {'mark_gained': 4, 'summary': "Good.", 'strengths': "-", 'improvements': "-",
+                'usage': {'input_tokens': 500, 'output_tokens': 80, 'latency_ms': 900.0}}
+
+    def test_cache_hit_keeps_the_tokens_of_the_paid_call(self):
+        with mock.patch.object(evaluation_cache, 'evaluate_answer_with_ai', side_effect=self.evaluate) as ai:
+            first, second = self.answers
+            mark_answer(first)
+            mark_answer(first)  # Re-marked with the same text: served from the cache.
+            mark_answer(second)  # Same text as the first answer: also a hit, never paid for.
+
+        self.assertEqual(ai.call_count, 1)
+        first.refresh_from_db()
+        self.assertEqual((first.input_tokens, first.output_tokens), (500, 80))
+        report = APIClient().get(f'/api/tests/{self.test.id}/ai-usage/').data
+        self.assertEqual((report['input_tokens'], report['output_tokens']), (500, 80))
+        self.assertEqual((report['evaluations'], report['cached']), (2, 1))
+
+
+
+class BatchEvaluationTests(TestCase):
+    ANSWERS = {1: "Photosynthesis makes sugar.", 2: "Plants eat soil.", 3: "Light is absorbed."}
+
+    def setUp(self):
+        for name in ('get_gemini_model', 'record_tokens'):
+            patch = mock.patch.object(services, name)
+            patch.start()
+            self.addCleanup(patch.stop)
+        gemini = mock.patch.object(services, 'call_with_limits')
+        self.gemini = gemini.start()
+        self.addCleanup(gemini.stop)
+        one_by_one = mock.patch.object(services, 'evaluate_answer_with_ai', return_value={
+            'mark_gained': 1, 'summary': "-", 'strengths': "-", 'improvements': "-",
+            'usage': {'input_tokens': 10, 'output_tokens': 5, 'latency_ms': 1.0},
+        })
+        self.one_by_one = one_by_one.start()
+        self.addCleanup(one_by_one.stop)
+
+    def reply(self, answer_ids):
+        items = [{'answer_id': answer_id, 'mark_gained': 2, 'summary': "Good."} for answer_id in answer_ids]
+        return mock.Mock(text=json.dumps(items), usage_metadata=None)
+
+    def evaluate(self, answers, cached=False):
+        evaluate = evaluation_cache.evaluate_answers_batch_cached if cached else services.evaluate_answers_batch_with_ai
+        return evaluate(answers, model_answer="-", marking_scheme="-", max_mark=4)
+
+    def test_provider_errors_fail_the_batch_without_grading_one_by_one(self):
+        for error in (google_exceptions.TooManyRequests("Quota exceeded"),
+                      google_exceptions.ServiceUnavailable("Unavailable"),
+                      CircuitOpenError('gemini', 30)):
+            self.gemini.side_effect = error
+            results = self.evaluate(self.ANSWERS)
+            self.assertTrue(all(result['failed'] for result in results.values()), error)
+            self.assertEqual(sorted(results), [1, 2, 3])
+        self.assertEqual(self.gemini.call_count, 3)
+        self.one_by_one.assert_not_called()
+
+    def test_unusable_replies_are_graded_one_by_one(self):
+        self.gemini.return_value = mock.Mock(text="Sorry, I can't help with that.", usage_metadata=None)
+        results = self.evaluate(self.ANSWERS)
+        self.assertEqual(self.one_by_one.call_count, 3)
+        self.assertEqual({result['mark_gained'] for result in results.values()}, {1})
+
+    @override_settings(EVALUATION_CACHE_BACKEND='db')
+    def test_cached_answers_are_left_out_of_the_batch(self):
+        self.gemini.return_value = self.reply([1, 2])
+        self.evaluate({1: self.ANSWERS[1], 2: self.ANSWERS[2]}, cached=True)
+
+        self.gemini.return_value = self.reply([3])
+        results = self.evaluate(self.ANSWERS, cached=True)
+        self.assertEqual(self.gemini.call_count, 1)
+        # Answer 3 alone has nothing to share a request with.
+        self.one_by_one.assert_called_once()
+        self.assertEqual(self.one_by_one.call_args.args[0], self.ANSWERS[3])
+        self.assertTrue(results[1]['usage']['cached'] and results[2]['usage']['cached'])
+        self.assertEqual(EvaluationCacheEntry.objects.count(), 3)
+
+class PrinciplesTextTests(TestCase):
+    def setUp(self):
+        self.test = seed_test(1, question_count=1)
+        # The upload's extraction is queued on commit, which never comes inside a TestCase.
+        self.principle = MarkingPrinciple.objects.create(name="Principles", pdf_file="marking_principles/missing.pdf")
+        self.test.marking_principle = self.principle
+        self.test.save()
+
+    def test_only_finished_extractions_reach_the_ai(self):
+        for status, text in (('pending', ""), ('running', "Page one"), ('failed', "Error: bad PDF")):
+            MarkingPrinciple.objects.filter(pk=self.principle.pk).update(extraction_status=status, extracted_text=text)
+            self.test.marking_principle.refresh_from_db()
+            self.assertEqual(tasks.get_principles_text(self.test), "", status)
+
+        MarkingPrinciple.objects.filter(pk=self.principle.pk).update(extraction_status='finished',
+                                                                     extracted_text="Award method marks.")
+        self.test.marking_principle.refresh_from_db()
+        self.assertEqual(tasks.get_principles_text(self.test), "Award method marks.")
+
+    def test_text_is_joined_from_the_pages(self):
+        MarkingPrincipleChunk.objects.bulk_create([
+            MarkingPrincipleChunk(principle=self.principle, page_number=number, text=text)
+            for number, text in ((1, "Award method marks."), (2, "Accept equivalent units."))
+        ])
+        MarkingPrinciple.objects.filter(pk=self.principle.pk).update(extraction_status='finished')
+        self.test.marking_principle.refresh_from_db()
+
+        text = tasks.get_principles_text(self.test, self.test.questions.get())
+        self.assertEqual(text, "Award method marks.\nAccept equivalent units.\n")
+        self.assertEqual(self.principle.text_length(), len(text))
+        self.assertIsNone(self.test.marking_principle.extracted_text)
+
+    def test_failed_extraction_is_logged(self):
+        with self.assertLogs('core.principles', 'ERROR') as logs:
+            extract_principle(self.principle.pk)
+
+        self.assertIn("Principles", logs.output[0])
+        self.principle.refresh_from_db()
+        self.assertEqual(self.principle.extraction_status, 'failed')
+        self.assertTrue(self.principle.extraction_error)
+
+
+class MarkingJobTests(TransactionTestCase):
+    def setUp(self):
+        self.test = seed_test(1, question_count=2)
+        StudentAnswer.objects.update(ocr_text="OCR Failed: Deadline exceeded", is_evaluated=False)
+        self.answer_ids = list(StudentAnswer.objects.values_list('id', flat=True))
+        self.marked_texts = []
+
+    def read_again(self, answer, force=False, engine=None):
+        answer.ocr_text = f"read again {answer.id}"
+        answer.save(update_fields=['ocr_text'])
+        return answer
+
+    def evaluate(self, student_answer_text, *args, **kwargs):
+        self.marked_texts.append(student_answer_text)
+        return {'mark_gained': 1, 'summary': "-", 'strengths': "-", 'improvements': "-"}
+
+    def evaluate_batch(self, answers, *args, **kwargs):
+        return {answer_id: self.evaluate(text) for answer_id, text in answers.items()}
+
+    def run_job(self, batched):
+        job = MarkingJob.objects.create(test=self.test, total=len(self.answer_ids), batched=batched)
+        with mock.patch.object(tasks, 'ocr_answer', side_effect=self.read_again), \
+                mock.patch.object(evaluation_cache, 'evaluate_answer_with_ai', side_effect=self.evaluate), \
+                mock.patch.object(evaluation_cache, 'evaluate_answers_batch_with_ai', side_effect=self.evaluate_batch):
+            tasks.run_marking_job(job.id, self.answer_ids, 1, batched=batched)
+        job.refresh_from_db()
+        return job
+
+    def test_failed_ocr_is_read_again_before_marking(self):
+        job = self.run_job(batched=False)
+        self.assertEqual((job.status, job.done, job.failed), ('finished', 2, 0))
+        self.assertEqual(sorted(self.marked_texts), [f"read again {answer_id}" for answer_id in sorted(self.answer_ids)])
+
+    def test_failed_ocr_is_read_again_before_batched_marking(self):
+        job = self.run_job(batched=True)
+        self.assertEqual((job.status, job.done, job.failed), ('finished', 2, 0))
+        self.assertEqual(sorted(self.marked_texts), [f"read again {answer_id}" for answer_id in sorted(self.answer_ids)])
+
+    def test_mark_all_twice_returns_the_running_job(self):
+        client = APIClient()
+        with mock.patch.object(tasks, 'run_marking_job'):
+            first = client.post(f'/api/tests/{self.test.id}/mark-all/')
+            second = client.post(f'/api/tests/{self.test.id}/mark-all/')
+        self.assertEqual((first.status_code, second.status_code), (202, 200))
+        self.assertEqual(second.data['id'], first.data['id'])
+        self.assertEqual(MarkingJob.objects.filter(test=self.test).count(), 1)
+
+    @override_settings(MARKING_JOB_STALE_SECONDS=60)
+    def test_jobs_without_a_recent_heartbeat_are_failed(self):
+        long_ago = timezone.now() - timedelta(minutes=10)
+        orphaned = MarkingJob.objects.create(test=self.test, status='running', heartbeat_at=long_ago)
+        never_started = MarkingJob.objects.create(test=self.test)
+        MarkingJob.objects.filter(pk=never_started.pk).update(created_at=long_ago)
+        alive = MarkingJob.objects.create(test=self.test, status='running', heartbeat_at=timezone.now())
+        just_queued = MarkingJob.objects.create(test=self.test)
+
+        response = APIClient().get('/api/marking-jobs/')
+        statuses = {job['id']: job['status'] for job in response.data}
+        self.assertEqual(statuses, {orphaned.id: 'failed', never_started.id: 'failed',
+                                    alive.id: 'running', just_queued.id: 'queued'})
+        orphaned.refresh_from_db()
+        self.assertTrue(orphaned.error)
+        self.assertIsNotNone(orphaned.finished_at)
+
+
+@override_settings(GRADING_JOB_LEASE_SECONDS=60, GRADING_JOB_RETRY_DELAY_SECONDS=30)
+class GradingJobQueueTests(TransactionTestCase):
+    def setUp(self):
+        self.answer = StudentAnswer.objects.get(question__test=seed_test(1, question_count=1))
+
+    def enqueue(self, **fields):
+        job = tasks.enqueue_grading_job(self.answer, 'marking')
+        GradingJob.objects.filter(pk=job.pk).update(**fields)
+        return job
+
+    def test_claiming_leases_the_job(self):
+        job = self.enqueue()
+        claimed = tasks.claim_next_grading_job()
+        self.assertEqual((claimed.pk, claimed.status, claimed.attempts), (job.pk, 'running', 1))
+        self.assertAlmostEqual((claimed.lease_until - timezone.now()).total_seconds(), 60, delta=5)
+        self.assertIsNone(tasks.claim_next_grading_job())
+
+    def test_jobs_whose_lease_ran_out_are_reclaimed(self):
+        expired = self.enqueue(status='running', attempts=1, lease_until=timezone.now() - timedelta(seconds=1))
+        self.enqueue(status='running', attempts=1, lease_until=timezone.now() + timedelta(seconds=30))
+        claimed = tasks.claim_next_grading_job()
+        self.assertEqual((claimed.pk, claimed.attempts), (expired.pk, 2))
+        self.assertIsNone(tasks.claim_next_grading_job())
+
+    def test_a_lost_last_attempt_fails_the_job(self):
+        job = self.enqueue(status='running', attempts=3, lease_until=timezone.now() - timedelta(seconds=1))
+        self.assertIsNone(tasks.claim_next_grading_job())
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        self.assertTrue(job.error)
+
+    def test_retries_wait_before_they_can_be_claimed(self):
+        job = self.enqueue()
+        with mock.patch.object(tasks, 'mark_answer', side_effect=RuntimeError("Gemini is down")):
+            tasks.run_grading_job(tasks.claim_next_grading_job())
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'retried')
+        self.assertAlmostEqual((job.run_after - timezone.now()).total_seconds(), 30, delta=5)
+        self.assertIsNone(tasks.claim_next_grading_job())
+
+        GradingJob.objects.filter(pk=job.pk).update(run_after=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(tasks.claim_next_grading_job().pk, job.pk)
+        self.assertEqual(tasks.retry_delay(2), 60)
+
+    def test_a_reclaimed_job_ignores_the_first_workers_result(self):
+        self.enqueue()
+        first = tasks.claim_next_grading_job()
+        GradingJob.objects.filter(pk=first.pk).update(lease_until=timezone.now() - timedelta(seconds=1))
+        second = tasks.claim_next_grading_job()
+        with mock.patch.object(tasks, 'mark_answer', side_effect=RuntimeError("too late")):
+            tasks.run_grading_job(first)
+        job = GradingJob.objects.get(pk=second.pk)
+        self.assertEqual((job.status, job.attempts, job.error), ('running', 2, ""))
+
+
+class DatabaseEvaluationStoreTests(TestCase):
+    def setUp(self):
+        patch = mock.patch.object(evaluation_cache, '_db_writes', itertools.count(1))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_eviction_runs_every_n_writes(self):
+        store = evaluation_cache.DatabaseEvaluationStore(ttl=0, max_entries=2, evict_every=3)
+        for index in range(5):
+            store.set(f"key {index}", {'mark_gained': index}, "model")
+        # Evicted once, at the third write; the two entries since are over the limit until the sixth.
+        self.assertEqual(EvaluationCacheEntry.objects.count(), 4)
+        store.set("key 5", {'mark_gained': 5}, "model")
+        self.assertEqual(sorted(EvaluationCacheEntry.objects.values_list('key', flat=True)), ["key 4", "key 5"])
+
+    def test_rewriting_an_entry_restarts_its_ttl(self):
+        store = evaluation_cache.DatabaseEvaluationStore(ttl=60, max_entries=0)
+        store.set("key", {'mark_gained': 1}, "model")
+        EvaluationCacheEntry.objects.update(created_at=timezone.now() - timedelta(seconds=120))
+        self.assertIsNone(store.get("key"))
+
+        store.set("key", {'mark_gained': 1}, "model")
+        EvaluationCacheEntry.objects.update(created_at=F('created_at') - timedelta(seconds=30))
+        store.set("key", {'mark_gained': 2}, "model")
+        self.assertEqual(store.get("key"), {'mark_gained': 2})
+
+    @override_settings(EVALUATION_CACHE_TTL=60, EVALUATION_CACHE_MAX_ENTRIES=1)
+    def test_prune_command(self):
+        store = evaluation_cache.DatabaseEvaluationStore(ttl=60, max_entries=1)
+        for key in ("expired", "old", "new"):
+            store.set(key, {}, "model")
+        EvaluationCacheEntry.objects.filter(key="expired").update(created_at=timezone.now() - timedelta(hours=1))
+        EvaluationCacheEntry.objects.filter(key="old").update(last_used_at=timezone.now() - timedelta(minutes=1))
+
+        out = io.StringIO()
+        call_command('prune_evaluation_cache', stdout=out)
+        self.assertIn("Removed 2", out.getvalue())
+        self.assertEqual(list(EvaluationCacheEntry.objects.values_list('key', flat=True)), ["new"])
+
+
+@override_settings(EVALUATION_CACHE_BACKEND='off', MODEL_ANSWER_CACHE_BACKEND='db')
+class ModelAnswerCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        for patch in (mock.patch.object(model_answers, 'get_question_index', return_value=QuestionIndex([])),
+                      mock.patch.object(model_answers, 'suggest_model_answers', return_value=[])):
+            patch.start()
+            self.addCleanup(patch.stop)
+        generate = mock.patch.object(model_answers, 'generate_model_answer_with_ai',
+                                     side_effect=lambda description, scheme, image: f"Answer to {description}")
+        self.generate = generate.start()
+        self.addCleanup(generate.stop)
+
+    def test_case_is_kept_and_whitespace_ignored(self):
+        self.assertEqual(model_answers.make_cache_key(" pH  of\nwater", "-"),
+                         model_answers.make_cache_key("pH of water", "-"))
+        self.assertNotEqual(model_answers.make_cache_key("pH of water", "-"),
+                            model_answers.make_cache_key("PH of water", "-"))
+
+    def test_model_answers_have_their_own_store_and_stats(self):
+        first = model_answers.generate_model_answer_cached("Define osmosis.", "-")
+        second = model_answers.generate_model_answer_cached("Define  osmosis.", "-")
+
+        self.assertEqual((first['source'], second['source']), ('generated', 'cache'))
+        self.assertEqual(self.generate.call_count, 1)
+        self.assertEqual(list(EvaluationCacheEntry.objects.values_list('namespace', flat=True)), ['model_answer'])
+        stats = evaluation_cache.get_stats()
+        self.assertEqual((stats['backend'], stats['entries'], stats['hits']), ('off', 0, 0))
+        self.assertEqual({k: stats['model_answers'][k] for k in ('backend', 'entries', 'hits', 'misses')},
+                         {'backend': 'db', 'entries': 1, 'hits': 1, 'misses': 1})
+
+    @override_settings(MODEL_ANSWER_CACHE_BACKEND='default')
+    def test_counters_outlive_a_per_process_cache(self):
+        model_answers.generate_model_answer_cached("Define osmosis.", "-")
+        model_answers.generate_model_answer_cached("Define osmosis.", "-")
+        # Another process has its own LocMemCache, but reads the same counters.
+        cache.clear()
+        stats = evaluation_cache.get_stats()['model_answers']
+        self.assertEqual((stats['backend'], stats['hits'], stats['misses']), ('default', 1, 1))
+        self.assertEqual(list(CacheLookupStats.objects.values_list('namespace', 'hits', 'misses')),
+                         [('model_answer', 1, 1)])
+
+
+class QuestionIndexRebuildTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        for patch in (mock.patch.object(question_index, '_index', None),
+                      mock.patch.object(question_index, 'MIN_REBUILD_SECONDS', 0)):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.test = Test.objects.create(class_group=Class.objects.create(name="Class"), name="Test")
+
+    def add_question(self, number, description):
+        return Question.objects.create(test=self.test, q_number=number, description=description,
+                                       marking_scheme="-", model_answer="Water moves across a membrane.")
+
+    def test_rebuilds_happen_in_the_background(self):
+        first = self.add_question(1, "Define osmosis.")
+        index = question_index.get_question_index()
+        self.assertEqual(index.find_exact("Define osmosis.", "-"), first.id)
+
+        second = self.add_question(2, "Define diffusion.")
+        self.assertIs(question_index.get_question_index(), index)  # Served stale while rebuilding.
+        for thread in threading.enumerate():
+            if thread.name == "question-index-rebuild":
+                thread.join()
+        self.assertEqual(question_index.get_question_index().find_exact("Define diffusion.", "-"), second.id)
+
+    def test_saves_of_unindexed_fields_keep_the_index(self):
+        question = self.add_question(1, "Define osmosis.")
+        version = IndexVersion.objects.get(name=question_index.VERSION_NAME).version
+        question.max_mark = 5
+        question.save(update_fields=['max_mark'])
+        self.assertEqual(IndexVersion.objects.get(name=question_index.VERSION_NAME).version, version)
+        question.save(update_fields=['description'])
+        self.assertEqual(IndexVersion.objects.get(name=question_index.VERSION_NAME).version, version + 1)
+
+    def test_other_processes_see_the_new_version(self):
+        self.add_question(1, "Define osmosis.")
+        index = question_index.get_question_index()
+        # Another process saved a question: only the database row changes.
+        IndexVersion.objects.update(version=F('version') + 1)
+        question_index.get_question_index()
+        for thread in threading.enumerate():
+            if thread.name == "question-index-rebuild":
+                thread.join()
+        self.assertIsNot(question_index.get_question_index(), index)
+
+
+class FakeClock:
+    """Stands in for the time module in api/ratelimit.py: sleeping advances monotonic() instantly."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+        self.time, self.perf_counter = time.time, time.perf_counter
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@override_settings(AI_BREAKER_ENABLED=False, AI_RETRY_ATTEMPTS=5)
+class RateLimitTests(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patch = mock.patch.object(ratelimit, 'time', self.clock)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def held_slots(self):
+        return ConcurrencySlot.objects.filter(held_until__gt=time.time()).count()
+
+    def test_quota_is_waited_for_before_a_slot_is_held(self):
+        held_while_waiting = []
+        self.clock.sleep = lambda seconds: held_while_waiting.append(self.held_slots())
+        with mock.patch.object(ratelimit, '_bucket_take', side_effect=[2.0, 0, 0]):
+            with ratelimit.provider_limits('gemini', tokens=100):
+                self.assertEqual(self.held_slots(), 1)
+        self.assertEqual(held_while_waiting, [0])
+        self.assertEqual(self.held_slots(), 0)
+
+    def test_retries_stop_when_the_request_budget_is_spent(self):
+        call = mock.Mock(side_effect=google_exceptions.ServiceUnavailable("down"))
+        with mock.patch.object(ratelimit, 'backoff_delay', return_value=4.0), ratelimit.retry_budget(10):
+            with self.assertRaises(google_exceptions.ServiceUnavailable), \
+                    self.assertLogs('api.ratelimit', 'WARNING') as logs:
+                ratelimit.call_with_limits('gemini', call)
+        # Attempts at 0s, 4s and 8s; a fourth would start at 12s, past the budget.
+        self.assertEqual(call.call_count, 3)
+        self.assertEqual(logs.output[0],
+                         "WARNING:api.ratelimit:gemini call failed (ServiceUnavailable), retrying in 4.0s")
+
+    def test_background_calls_use_every_attempt(self):
+        call = mock.Mock(side_effect=google_exceptions.ServiceUnavailable("down"))
+        with mock.patch.object(ratelimit, 'backoff_delay', return_value=4.0):
+            with self.assertRaises(google_exceptions.ServiceUnavailable):
+                ratelimit.call_with_limits('gemini', call)
+        self.assertEqual(call.call_count, 5)
+
+    def test_quota_waits_past_the_budget_fail_fast(self):
+        with mock.patch.object(ratelimit, '_bucket_take', return_value=30.0), ratelimit.retry_budget(10):
+            with self.assertRaises(ratelimit.QuotaWaitExceeded):
+                ratelimit.acquire_quota('gemini', deadline=ratelimit._deadline.get())
+        self.assertEqual(self.clock.sleeps, [])
+
+    def test_requests_get_a_retry_budget(self):
+        deadlines = []
+        with mock.patch('api.views.get_evaluation_cache_stats', side_effect=lambda: deadlines.append(
+                ratelimit._deadline.get()) or {}), override_settings(AI_REQUEST_RETRY_BUDGET=45):
+            APIClient().get('/api/evaluation-cache/stats/')
+        self.assertEqual(deadlines, [self.clock.now + 45])
+        self.assertIsNone(ratelimit._deadline.get())
+
+
+class CropToContentTests(SimpleTestCase):
+    def page(self):
+        """A 1000x800 sheet of paper with a block of dark writing on most of it."""
+        page = Image.new('L', (1000, 800), 240)
+        page.paste(30, (150, 100, 850, 700))
+        return page
+
+    def test_faint_pencil_is_kept(self):
+        page = self.page()
+        page.paste(200, (90, 400, 94, 420))  # A light pencil mark left of the ink.
+        cropped = crop_to_content(page)
+        self.assertLess(cropped.width, page.width)
+        self.assertGreaterEqual(cropped.width, 850 - 90)
+        self.assertIn(200, [level for _, level in cropped.getcolors()])
+
+    def test_dark_writing_is_cropped_to(self):
+        cropped = crop_to_content(self.page())
+        self.assertEqual(cropped.size, (700 + 2 * 20, 600 + 2 * 16))
+
+    def test_a_crop_removing_most_of_the_page_is_not_trusted(self):
+        page = Image.new('L', (1000, 800), 240)
+        page.paste(30, (450, 350, 550, 450))
+        self.assertEqual(crop_to_content(page).size, page.size)
+
+
+
+class ScriptUploadTests(TestCase):
+    def test_pages_the_ocr_engine_failed_are_reported(self):
+        test = seed_test(1, question_count=2)
+        student = Student.objects.get()
+        pages = []
+        for number in (1, 2, 3):
+            buffer = io.BytesIO()
+            Image.new('L', (200, 100), 255).save(buffer, format='PNG')
+            pages.append(SimpleUploadedFile(f"page{number}.png", buffer.getvalue(), content_type='image/png'))
+        page_texts = ["Q1 Leaves", "OCR Failed: 503 Service Unavailable", "OCR Failed: 503 Service Unavailable"]
+
+        with mock.patch.object(scripts, 'read_pages', return_value=page_texts):
+            response = APIClient().post(f'/api/tests/{test.id}/upload-script/',
+                                        {'student': student.id, 'pages': pages}, format='multipart')
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(response.data['failed_pages'], [2, 3])
+        self.assertIn("page(s) 2, 3", response.data['error'])
+        self.assertFalse(StudentAnswer.objects.filter(ocr_text="Q1 Leaves").exists())
+
+class Unseekable(io.RawIOBase):
+    """A stream that can only be read forwards, like a socket."""
+
+    def __init__(self, content):
+        self.source = io.BytesIO(content)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        return self.source.readinto(buffer)
+
+
+@mock.patch.object(services, 'IMAGE_SPOOL_MAX_MEMORY', 100)
+class ReadImageTests(SimpleTestCase):
+    def image(self, format):
+        buffer = io.BytesIO()
+        Image.new('L', (64, 64), 200).save(buffer, format=format)
+        return buffer.getvalue()
+
+    def test_streams_are_spooled_to_disk(self):
+        content = self.image('BMP')
+        with services.open_image(Unseekable(content)) as f:
+            self.assertTrue(f._rolled)
+            self.assertEqual(f.read(), content)
+
+    def test_files_are_read_where_they_are(self):
+        upload = ContentFile(self.image('PNG'))
+        upload.read(10)
+        with services.open_image(upload) as f:
+            self.assertIs(f, upload)
+        self.assertEqual(read_image(upload), upload.file.getvalue())
+
+    def test_gemini_gets_accepted_formats_as_they_are(self):
+        content = self.image('PNG')
+        self.assertEqual(gemini_image_part(Unseekable(content)), {'mime_type': 'image/png', 'data': content})
+
+    def test_other_formats_are_decoded_from_the_file(self):
+        part = gemini_image_part(Unseekable(self.image('BMP')))
+        self.assertIsInstance(part, Image.Image)
+        self.assertEqual(part.size, (64, 64))
 
-# Create your tests here.
@@ -2,6 +2,11 @@
 
 from django.urls import path
 from rest_framework.routers import DefaultRouter
+from .async_views import (
+    run_ocr_async_view,
+    run_marking_async_view,
+    generate_model_answer_async_view
+)
 from .views import (
     ClassViewSet, 
     StudentViewSet,
@@ -9,7 +14,14 @@ from .views import (
     TestViewSet, 
     QuestionViewSet, 
     StudentAnswerViewSet,
-    generate_model_answer_view
+    MarkingJobViewSet,
+    GradingJobViewSet,
+    generate_model_answer_view,
+    model_answer_suggestions_view,
+    evaluation_cache_stats_view,
+    ai_metrics_view,
+    image_rendition_view,
+    direct_upload_view
 )
 
 # The router handles all the standard URLs (list, create, retrieve, update, delete)
@@ -20,6 +32,8 @@ router.register(r'tests', TestViewSet, basename='test')
 router.register(r'questions', QuestionViewSet, basename='question')
 router.register(r'marking-principles', MarkingPrincipleViewSet, basename='markingprinciple')
 router.register(r'answers', StudentAnswerViewSet, basename='studentanswer')
+router.register(r'marking-jobs', MarkingJobViewSet, basename='markingjob')
+router.register(r'grading-jobs', GradingJobViewSet, basename='gradingjob')
 
 # We start with the router's default URLs
 urlpatterns = router.urls
@@ -29,6 +43,10 @@ urlpatterns = router.urls
 # This bypasses the router's magic and explicitly tells Django what to do.
 urlpatterns += [
     path('generate-model-answer/', generate_model_answer_view, name='generate-model-answer'),
+    path('model-answer-suggestions/', model_answer_suggestions_view, name='model-answer-suggestions'),
+    path('evaluation-cache/stats/', evaluation_cache_stats_view, name='evaluation-cache-stats'),
+    path('ai-metrics/', ai_metrics_view, name='ai-metrics'),
+    path('renditions/<str:kind>/<int:pk>/<str:size>/', image_rendition_view, name='image-rendition'),
     
     # This line creates the URL: /api/answers/<id>/run-ocr/
     # It maps a POST request to the 'run_ocr' method inside StudentAnswerViewSet.
@@ -46,6 +64,20 @@ urlpatterns += [
         name='studentanswer-run-marking'
     ),
     
+    # Async versions of the AI endpoints, for ASGI deployments (see async_views.py).
+    path('async/answers/<int:pk>/run-ocr/', run_ocr_async_view, name='studentanswer-run-ocr-async'),
+    path('async/answers/<int:pk>/run-marking/', run_marking_async_view, name='studentanswer-run-marking-async'),
+    path('async/generate-model-answer/', generate_model_answer_async_view, name='generate-model-answer-async'),
+
+    # Direct-to-storage uploads: ask for a URL, PUT the image, then confirm.
+    path('answers/upload-url/', StudentAnswerViewSet.as_view({'post': 'upload_url'}), name='studentanswer-upload-url'),
+    path(
+        'answers/confirm-upload/',
+        StudentAnswerViewSet.as_view({'post': 'confirm_upload'}),
+        name='studentanswer-confirm-upload'
+    ),
+    path('answers/direct-upload/<str:token>/', direct_upload_view, name='direct-upload'),
+
     path(
         'answers/find/',
         StudentAnswerViewSet.as_view({'get': 'find'}),
@@ -1,20 +1,64 @@
 # backend/api/views.py
 
 import traceback
-from django.core.files.storage import default_storage
+from django.conf import settings
+from django.db import models
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
 from rest_framework import viewsets, status
 from rest_framework.decorators import action, api_view
 from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 
 from core.models import (Class, Student, Test, Question, StudentAnswer,
-                         MarkingPrinciple)
+                         MarkingPrinciple, MarkingJob, GradingJob)
+from core.renditions import get_or_create_rendition_url
+from .ocr_engines import OCR_ENGINES
 from .serializers import (ClassSerializer, StudentSerializer, MarkingPrincipleSerializer,
                           TestSerializer, QuestionSerializer, StudentAnswerUploadSerializer,
-                          StudentAnswerEvaluationSerializer, StudentTestResultSerializer)
-from .services import (perform_ocr, evaluate_answer_with_ai,
-                       generate_model_answer_with_ai)
+                          StudentAnswerEvaluationSerializer, StudentTestResultSerializer,
+                          StudentAnswerSlimSerializer, MarkingJobSerializer, GradingJobSerializer)
+from .filters import StudentAnswerFilter
+from .imaging import prepare_uploaded_image
+from .pagination import OptionalCursorPagination
+from .model_answers import generate_model_answer_cached, suggest_model_answers
+from .evaluation_cache import get_stats as get_evaluation_cache_stats
+from .resilience import provider_metrics
+from .scripts import ScriptError, ScriptOcrError, ingest_script
+from .bulk_upload import BulkUploadError, ingest_archive
+from .direct_uploads import DirectUploadError, start_upload, confirm_upload, store_local_upload
+from .reports import student_results_queryset, question_summaries, summarise, ai_usage_report
+from .tasks import (ocr_answer, ocr_answers_batch, mark_answer, start_marking_job,
+                    enqueue_grading_job, fail_stale_marking_jobs, NEEDS_OCR)
+
+
+def query_flag(request, name):
+    # True for ?<name>=true (or "<name>": true in the body).
+    value = request.query_params.get(name, request.data.get(name, ''))
+    return str(value).lower() in ('1', 'true', 'yes')
+
+def id_param(request, name):
+    # The integer id sent as <name> in the body, or None if it's missing or not a number.
+    value = str(request.data.get(name, ''))
+    return int(value) if value.isdigit() else None
+
+def requested_ocr_engine(request):
+    # ?engine= (or "engine" in the body) picks the OCR engine for this request only.
+    name = request.query_params.get('engine', request.data.get('engine', ''))
+    if name and name not in OCR_ENGINES:
+        raise ValueError(f"Unknown OCR engine '{name}'. Choose one of: {', '.join(OCR_ENGINES)}.")
+    return name or None
+
+def wants_async(request):
+    return query_flag(request, 'async')
+
+def queued_job_response(request, job):
+    data = GradingJobSerializer(job).data
+    data['job_url'] = request.build_absolute_uri(reverse('gradingjob-detail', args=[job.id]))
+    return Response(data, status=status.HTTP_202_ACCEPTED)
 
 
 class ClassViewSet(viewsets.ModelViewSet):
@@ -49,10 +93,161 @@ class TestViewSet(viewsets.ModelViewSet):
     
     @action(detail=True, methods=['get'])
     def results(self, request, pk=None):
+        # The whole report costs a fixed number of queries, however big the class is.
         test = self.get_object()
-        students = test.class_group.students.all()
-        serializer = StudentTestResultSerializer(students, many=True, context={'test_id': test.id})
-        return Response(serializer.data)
+        questions = list(test.questions.only('id', 'test_id', 'q_number', 'max_mark'))
+        students = list(student_results_queryset(test, questions))
+        serializer = StudentTestResultSerializer(students, many=True, context={'questions': questions})
+        # Class statistics only cover students who have at least one marked answer.
+        totals = [student.total_mark_gained for student in students if student.evaluated_count]
+        return Response({
+            'test': test.id,
+            'total_max_mark': sum(question.max_mark for question in questions),
+            'questions': question_summaries(questions, students),
+            'students': serializer.data,
+            'statistics': summarise(totals),
+        })
+
+    @action(detail=True, methods=['post'], url_path='mark-all')
+    def mark_all(self, request, pk=None):
+        # Queues every unevaluated answer for this test and returns immediately.
+        # Poll the progress URL for done/failed/pending counts. While a job is
+        # queued or running, mark-all returns that job instead of starting another.
+        test = self.get_object()
+        concurrency = request.data.get('concurrency')
+        # Leave batched as None so the MARK_ALL_BATCHED setting applies unless the client chose.
+        batched = None
+        if 'batched' in request.data or 'batched' in request.query_params:
+            batched = query_flag(request, 'batched')
+        try:
+            job, created = start_marking_job(test, concurrency=concurrency, batched=batched)
+        except (TypeError, ValueError):
+            return Response({"error": "concurrency must be a whole number."}, status=status.HTTP_400_BAD_REQUEST)
+        data = MarkingJobSerializer(job).data
+        data['progress_url'] = request.build_absolute_uri(reverse('markingjob-detail', args=[job.id]))
+        return Response(data, status=status.HTTP_202_ACCEPTED if created else status.HTTP_200_OK)
+
+    @action(detail=True, methods=['get'], url_path='grid-status')
+    def grid_status(self, request, pk=None):
+        # Just enough per answer to draw the marking grid: ids, mark and flags.
+        test = self.get_object()
+        rows = StudentAnswer.objects.filter(question__test=test).annotate(
+            has_ocr_text=models.Case(
+                models.When(models.Q(ocr_text__isnull=True) | models.Q(ocr_text=""), then=models.Value(False)),
+                default=models.Value(True),
+                output_field=models.BooleanField(),
+            )
+        ).values('id', 'student_id', 'question_id', 'mark_gained', 'is_evaluated', 'has_ocr_text')
+        return Response(list(rows))
+
+    @action(detail=True, methods=['get'], url_path='ai-usage')
+    def ai_usage(self, request, pk=None):
+        # Gemini tokens spent and p50/p95 evaluation latency, per test and per question.
+        return Response(ai_usage_report(self.get_object()))
+
+    @action(detail=True, methods=['post'], url_path='ocr-all')
+    def ocr_all(self, request, pk=None):
+        # OCRs every answer of the test (optionally one question) in batched
+        # Vision requests. By default only answers without text (or whose OCR failed) are read;
+        # force=true re-reads all of them and bypasses the OCR cache.
+        # ?engine= overrides the test's OCR engine for this run.
+        test = self.get_object()
+        try:
+            engine = requested_ocr_engine(request) or test.ocr_engine
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        answers = StudentAnswer.objects.filter(question__test=test).exclude(uploaded_image="")
+        question_id = request.data.get('question', request.query_params.get('question'))
+        if question_id:
+            answers = answers.filter(question_id=question_id)
+        force = query_flag(request, 'force')
+        if not force:
+            answers = answers.filter(NEEDS_OCR)
+        try:
+            counts = ocr_answers_batch(list(answers), force=force, engine=engine)
+        except Exception as e:
+            traceback.print_exc()
+            return Response({"detail": f"OCR failed: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return Response({'total': sum(counts.values()), **counts})
+
+    @action(detail=True, methods=['post'], url_path='upload-script')
+    def upload_script(self, request, pk=None):
+        # One student's whole answer script: a PDF and/or page photos sent as
+        # "pages" files, in order. Each page is OCR'd once and cut into answers
+        # at its "Q<n>" markers; all of the student's answers are created or
+        # replaced together. ?engine= overrides the test's OCR engine.
+        test = self.get_object()
+        student = Student.objects.filter(pk=id_param(request, 'student'), class_group_id=test.class_group_id).first()
+        if student is None:
+            return Response({"error": "student must be a student in this test's class."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        files = request.FILES.getlist('pages')
+        if not files:
+            return Response({"error": "Upload the script's pages as 'pages' files."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            engine = requested_ocr_engine(request)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            result = ingest_script(test, student, files, engine=engine)
+        except ScriptOcrError as e:
+            # The pages were fine; the OCR provider failed them. Nothing was stored.
+            return Response({"error": str(e), "failed_pages": e.pages}, status=status.HTTP_502_BAD_GATEWAY)
+        except ScriptError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            traceback.print_exc()
+            return Response({"detail": f"Script upload failed: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        answers = StudentAnswer.objects.select_related('question', 'student').filter(
+            pk__in=[answer.pk for answer in result.pop('answers')]
+        ).order_by('question__q_number')
+        return Response({
+            'student': student.id,
+            **result,
+            'answers': StudentAnswerSlimSerializer(answers, many=True, context={'request': request}).data,
+        })
+
+    @action(detail=True, methods=['post'], url_path='bulk-upload')
+    def bulk_upload(self, request, pk=None):
+        # A ZIP or tar of scans for the whole class, as the "archive" file. Scans
+        # are matched to students and questions by a "manifest" CSV file (or
+        # manifest.csv in the archive), else by "<student>/Q<n>.jpg" names.
+        # ocr=true queues an OCR job for every stored answer; ?engine= picks its engine.
+        test = self.get_object()
+        archive = request.FILES.get('archive')
+        if archive is None:
+            return Response({"error": "Upload the scans as an 'archive' file."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            engine = requested_ocr_engine(request)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        manifest = request.FILES.get('manifest')
+        try:
+            result = ingest_archive(
+                test, archive, manifest=manifest.read().decode('utf-8-sig') if manifest else None,
+                queue_ocr=query_flag(request, 'ocr'), engine=engine
+            )
+        except (BulkUploadError, UnicodeDecodeError) as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            traceback.print_exc()
+            return Response({"detail": f"Bulk upload failed: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return Response(result)
+
+class MarkingJobViewSet(viewsets.ReadOnlyModelViewSet):
+    queryset = MarkingJob.objects.all()
+    serializer_class = MarkingJobSerializer
+    filterset_fields = ['test', 'status']
+
+    def get_queryset(self):
+        # Clients poll here for progress, so jobs orphaned by a restart are failed here.
+        fail_stale_marking_jobs()
+        return super().get_queryset()
+
+class GradingJobViewSet(viewsets.ReadOnlyModelViewSet):
+    queryset = GradingJob.objects.all()
+    serializer_class = GradingJobSerializer
+    filterset_fields = ['answer', 'kind', 'status']
 
 class QuestionViewSet(viewsets.ModelViewSet):
     queryset = Question.objects.all()
@@ -68,13 +263,27 @@ class QuestionViewSet(viewsets.ModelViewSet):
         serializer.save(test=test_instance)
 
 class StudentAnswerViewSet(viewsets.ModelViewSet):
-    queryset = StudentAnswer.objects.all()
+    # The evaluation serializer nests the question and the student (with its
+    # class name), so load them in the same query.
+    queryset = StudentAnswer.objects.select_related('question', 'student__class_group')
+    filterset_class = StudentAnswerFilter
+    # Opt-in: only paginates when the client sends ?page_size=N
+    pagination_class = OptionalCursorPagination
     
     def get_serializer_class(self):
         if self.action in ['create', 'update', 'partial_update']:
             return StudentAnswerUploadSerializer
+        if self.request.query_params.get('view') == 'slim':
+            return StudentAnswerSlimSerializer
         return StudentAnswerEvaluationSerializer
 
+    def perform_create(self, serializer):
+        serializer.save(**prepare_uploaded_image(serializer.validated_data.get('uploaded_image')))
+
+    def perform_update(self, serializer):
+        # Only a PATCH/PUT that carries a new image is preprocessed.
+        serializer.save(**prepare_uploaded_image(serializer.validated_data.get('uploaded_image')))
+
     def create(self, request, *args, **kwargs):
         try:
             return super().create(request, *args, **kwargs)
@@ -91,20 +300,55 @@ class StudentAnswerViewSet(viewsets.ModelViewSet):
         question_id = request.query_params.get('question')
         if not student_id or not question_id:
             return Response({"error": "Student and question parameters are required."}, status=status.HTTP_400_BAD_REQUEST)
-        answer = get_object_or_404(StudentAnswer, student_id=student_id, question_id=question_id)
-        serializer = StudentAnswerEvaluationSerializer(answer, context={'request': request})
+        answer = get_object_or_404(self.get_queryset(), student_id=student_id, question_id=question_id)
+        serializer = self.get_serializer(answer)
         return Response(serializer.data)
 
+    @action(detail=False, methods=['post'], url_path='upload-url')
+    def upload_url(self, request):
+        # Direct upload, step 1: returns a URL to PUT the image to (a presigned
+        # bucket URL in production) and an upload_token for step 2.
+        question = Question.objects.select_related('test').filter(pk=id_param(request, 'question')).first()
+        student = Student.objects.filter(pk=id_param(request, 'student')).first()
+        if question is None or student is None or student.class_group_id != question.test.class_group_id:
+            return Response({"error": "student and question must exist and belong to the same class."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            upload = start_upload(student, question, request.data.get('content_type', ''),
+                                  lambda token: request.build_absolute_uri(reverse('direct-upload', args=[token])))
+        except DirectUploadError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(upload)
+
+    @action(detail=False, methods=['post'], url_path='confirm-upload')
+    def confirm_upload(self, request):
+        # Direct upload, step 2: after the PUT, checks the stored image and
+        # creates or updates the answer. ocr=true also queues its OCR.
+        try:
+            answer = confirm_upload(request.data.get('upload_token', ''))
+        except DirectUploadError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        data = StudentAnswerEvaluationSerializer(answer, context={'request': request}).data
+        if query_flag(request, 'ocr'):
+            job = enqueue_grading_job(answer, 'ocr', force=False, engine=None)
+            data['ocr_job_url'] = request.build_absolute_uri(reverse('gradingjob-detail', args=[job.id]))
+        return Response(data)
+
     @action(detail=True, methods=['post'])
     def run_ocr(self, request, pk=None):
         answer = self.get_object()
         if not answer.uploaded_image:
             return Response({"detail": "No image found for this answer."}, status=status.HTTP_400_BAD_REQUEST)
+        # force=true skips the OCR cache and always calls the OCR service.
+        force = query_flag(request, 'force')
+        try:
+            engine = requested_ocr_engine(request)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if wants_async(request):
+            return queued_job_response(request, enqueue_grading_job(answer, 'ocr', force=force, engine=engine))
         try:
-            image_path = answer.uploaded_image.path
-            ocr_output = perform_ocr(image_path)
-            answer.ocr_text = ocr_output
-            answer.save(update_fields=['ocr_text'])
+            ocr_answer(answer, force=force, engine=engine)
             serializer = StudentAnswerEvaluationSerializer(answer, context={'request': request})
             return Response(serializer.data)
         except Exception as e:
@@ -115,30 +359,13 @@ class StudentAnswerViewSet(viewsets.ModelViewSet):
     def run_marking(self, request, pk=None):
         answer = self.get_object()
         corrected_text = request.data.get('corrected_text', answer.ocr_text)
+        # force=true skips the evaluation cache and always asks the AI again.
+        force = query_flag(request, 'force')
+        if wants_async(request):
+            job = enqueue_grading_job(answer, 'marking', corrected_text=corrected_text, force=force)
+            return queued_job_response(request, job)
         try:
-            question = answer.question
-            test = question.test
-            
-            # --- LOGIC FIXED ---
-            # Initialize principles_text to an empty string first
-            principles_text = ""
-            if test.marking_principle:
-                principles_text = test.marking_principle.extracted_text or ""
-
-            evaluation_result = evaluate_answer_with_ai(
-                student_answer_text=corrected_text, model_answer=question.model_answer,
-                marking_scheme=question.marking_scheme, max_mark=question.max_mark,
-                marking_principles=principles_text
-            )
-            
-            answer.ocr_text = corrected_text
-            answer.mark_gained = evaluation_result['mark_gained']
-            answer.ai_evaluation_summary = evaluation_result['summary']
-            answer.ai_strength_points = evaluation_result['strengths']
-            answer.ai_improvement_points = evaluation_result['improvements']
-            answer.is_evaluated = True
-            answer.save()
-            
+            mark_answer(answer, corrected_text, use_cache=not force)
             serializer = StudentAnswerEvaluationSerializer(answer, context={'request': request})
             return Response(serializer.data, status=status.HTTP_200_OK)
         except Exception as e:
@@ -150,16 +377,74 @@ def generate_model_answer_view(request):
     description = request.data.get('description', '')
     marking_scheme = request.data.get('marking_scheme', '')
     question_image = request.FILES.get('question_image', None)
-    image_path = None
     if not description or not marking_scheme:
         return Response({"error": "Description and marking scheme are required."}, status=status.HTTP_400_BAD_REQUEST)
-    if question_image:
-        try:
-            file_name = default_storage.save(question_image.name, question_image)
-            image_path = default_storage.path(file_name)
-        except Exception as e:
-            return Response({"error": f"Failed to handle image upload: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-    model_answer = generate_model_answer_with_ai(description, marking_scheme, image_path)
-    if image_path:
-        default_storage.delete(file_name)
-    return Response({"model_answer": model_answer})
\ No newline at end of file
+    if question_image and question_image.size > settings.MODEL_ANSWER_IMAGE_MAX_BYTES:
+        return Response({"error": f"The image is larger than {settings.MODEL_ANSWER_IMAGE_MAX_BYTES} bytes."},
+                        status=status.HTTP_400_BAD_REQUEST)
+    # A repeated question is answered from the cache or a saved question; force=true always generates.
+    # The upload goes to Gemini as it is; nothing is written to storage.
+    result = generate_model_answer_cached(description, marking_scheme, question_image,
+                                          use_cache=not query_flag(request, 'force'))
+    return Response(result)
+
+@api_view(['GET'])
+def model_answer_suggestions_view(request):
+    # Model answers of saved questions similar to ?description=&marking_scheme=,
+    # straight from the index, for showing while a question is being written.
+    description = request.query_params.get('description', '')
+    marking_scheme = request.query_params.get('marking_scheme', '')
+    if not description.strip() and not marking_scheme.strip():
+        return Response({"error": "description or marking_scheme is required."}, status=status.HTTP_400_BAD_REQUEST)
+    # ?exclude=<question id> leaves out the question being edited.
+    exclude = request.query_params.get('exclude', '')
+    exclude = [int(exclude)] if exclude.isdigit() else []
+    return Response({"suggestions": suggest_model_answers(description, marking_scheme, exclude=exclude)})
+
+@csrf_exempt
+@require_http_methods(['PUT'])
+def direct_upload_view(request, token):
+    # The upload URL handed out when media is stored locally, standing in for
+    # a presigned bucket URL. The body is streamed to storage as it arrives.
+    try:
+        size = int(request.META.get('CONTENT_LENGTH') or 0)
+        store_local_upload(token, request, size)
+    except DirectUploadError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    except ValueError:
+        return JsonResponse({"error": "Invalid Content-Length."}, status=400)
+    return HttpResponse(status=200)
+
+@api_view(['GET'])
+def evaluation_cache_stats_view(request):
+    return Response(get_evaluation_cache_stats())
+
+@api_view(['GET'])
+def ai_metrics_view(request):
+    # Circuit breaker state, call/hedge counters and latencies for each AI provider.
+    return Response(provider_metrics())
+
+RENDITION_SOURCES = {
+    'answer': (StudentAnswer, 'uploaded_image'),
+    'question': (Question, 'question_image'),
+}
+
+@api_view(['GET'])
+def image_rendition_view(request, kind, pk, size):
+    # Redirects to a thumbnail/preview of an answer or question image, making
+    # it on first request. The URL carries ?v=<version>, so it is safe to cache.
+    if kind not in RENDITION_SOURCES or size not in settings.IMAGE_RENDITIONS:
+        return Response({"error": "Unknown rendition."}, status=status.HTTP_404_NOT_FOUND)
+    model, field_name = RENDITION_SOURCES[kind]
+    obj = get_object_or_404(model.objects.only('id', field_name), pk=pk)
+    image = getattr(obj, field_name)
+    if not image:
+        return Response({"error": "This item has no image."}, status=status.HTTP_404_NOT_FOUND)
+    try:
+        url = get_or_create_rendition_url(image, size)
+    except Exception as e:
+        traceback.print_exc()
+        return Response({"error": f"Could not create rendition: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    response = HttpResponseRedirect(request.build_absolute_uri(url))
+    response['Cache-Control'] = f"public, max-age={settings.RENDITION_CACHE_SECONDS}"
+    return response
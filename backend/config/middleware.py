@@ -0,0 +1,62 @@
+# backend/config/middleware.py
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+from api.ratelimit import retry_budget
+
+
+class AsyncWhiteNoiseMiddleware(WhiteNoiseMiddleware):
+    """
+    WhiteNoise is sync-only, and one sync middleware makes Django run every
+    request under ASGI through a single thread, which serialises the async
+    views. Looking up a static file never waits on I/O in production (no
+    autorefresh), so it is safe to do on the event loop.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, *args, **kwargs):
+        super().__init__(get_response, *args, **kwargs)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = self.find_file(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return self.serve(static_file, request)
+        return await self.get_response(request)
+
+
+class AIRetryBudgetMiddleware:
+    """
+    Limits how long one request can spend waiting for AI quota and retrying
+    AI calls to AI_REQUEST_RETRY_BUDGET seconds, so a provider outage can't
+    hold a worker for minutes. Background jobs keep the full retry schedule.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with retry_budget(settings.AI_REQUEST_RETRY_BUDGET):
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        with retry_budget(settings.AI_REQUEST_RETRY_BUDGET):
+            return await self.get_response(request)
@@ -49,7 +49,8 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     # Whitenoise middleware should be placed right after the security middleware.
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    # The async-capable subclass keeps the async AI views concurrent under ASGI.
+    'config.middleware.AsyncWhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -57,6 +58,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'config.middleware.AIRetryBudgetMiddleware',
 ]
 
 ROOT_URLCONF = 'config.urls'
@@ -87,6 +89,19 @@ DATABASES = {
     )
 }
 
+# --- LOGGING ---
+# The app's own loggers (background extraction and the like) write to the
+# console alongside Django's.
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {'console': {'class': 'logging.StreamHandler'}},
+    'loggers': {
+        'core': {'handlers': ['console'], 'level': os.environ.get('APP_LOG_LEVEL', 'INFO')},
+        'api': {'handlers': ['console'], 'level': os.environ.get('APP_LOG_LEVEL', 'INFO')},
+    },
+}
+
 # --- PASSWORD VALIDATION ---
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
@@ -122,6 +137,163 @@ CORS_ALLOWED_ORIGIN_REGEXES = [
     r"^https://.*\.pages\.dev$",
 ]
 
+# --- BACKGROUND GRADING ---
+# How many answers a bulk "mark all" job grades in parallel. Requests may ask
+# for fewer workers but never more than this.
+GRADING_CONCURRENCY = int(os.environ.get('GRADING_CONCURRENCY', '4'))
+# Whether "mark all" grades each question's answers in shared batch requests
+# by default. Requests can override this with "batched": true/false.
+MARK_ALL_BATCHED = os.environ.get('MARK_ALL_BATCHED', 'True') == 'True'
+# Running jobs record a heartbeat this often. A queued or running job with no
+# heartbeat for MARKING_JOB_STALE_SECONDS lost its worker (e.g. to a restart)
+# and is marked failed the next time jobs are listed or started.
+MARKING_JOB_HEARTBEAT_SECONDS = float(os.environ.get('MARKING_JOB_HEARTBEAT_SECONDS', '15'))
+MARKING_JOB_STALE_SECONDS = float(os.environ.get('MARKING_JOB_STALE_SECONDS', '120'))
+# A grading worker leases each job it claims for GRADING_JOB_LEASE_SECONDS and
+# renews the lease while it runs, so a job whose worker died is claimed again
+# once the lease runs out. A failed attempt is retried after
+# GRADING_JOB_RETRY_DELAY_SECONDS, doubling with each attempt up to
+# GRADING_JOB_RETRY_MAX_DELAY_SECONDS.
+GRADING_JOB_LEASE_SECONDS = float(os.environ.get('GRADING_JOB_LEASE_SECONDS', '300'))
+GRADING_JOB_RETRY_DELAY_SECONDS = float(os.environ.get('GRADING_JOB_RETRY_DELAY_SECONDS', '30'))
+GRADING_JOB_RETRY_MAX_DELAY_SECONDS = float(os.environ.get('GRADING_JOB_RETRY_MAX_DELAY_SECONDS', '900'))
+
+# --- AI RATE LIMITS ---
+# Outbound Gemini and Vision calls share per-minute token buckets and
+# concurrency caps across every process (state is kept in the database), and
+# rate-limit or transient errors are retried with jittered exponential backoff.
+AI_RATE_LIMITING = os.environ.get('AI_RATE_LIMITING', 'True') == 'True'
+AI_RATE_LIMITS = {
+    'gemini': {
+        'requests_per_minute': int(os.environ.get('GEMINI_REQUESTS_PER_MINUTE', '60')),
+        'tokens_per_minute': int(os.environ.get('GEMINI_TOKENS_PER_MINUTE', '1000000')),
+        'max_concurrency': int(os.environ.get('GEMINI_MAX_CONCURRENCY', '8')),
+    },
+    'vision': {
+        # Vision's quota counts images, so a batch request uses one unit per image.
+        'requests_per_minute': int(os.environ.get('VISION_REQUESTS_PER_MINUTE', '1800')),
+        'tokens_per_minute': 0,  # No token quota
+        'max_concurrency': int(os.environ.get('VISION_MAX_CONCURRENCY', '16')),
+    },
+}
+AI_RETRY_ATTEMPTS = int(os.environ.get('AI_RETRY_ATTEMPTS', '5'))
+AI_RETRY_BASE_DELAY = float(os.environ.get('AI_RETRY_BASE_DELAY', '1.0'))
+AI_RETRY_MAX_DELAY = float(os.environ.get('AI_RETRY_MAX_DELAY', '60.0'))
+# Seconds a web request may spend waiting for quota and retrying AI calls in
+# total; no new attempt starts after that. 0 means no limit. Background jobs
+# (the grading worker, "mark all") are never limited.
+AI_REQUEST_RETRY_BUDGET = float(os.environ.get('AI_REQUEST_RETRY_BUDGET', '60'))
+
+# --- AI CIRCUIT BREAKER & HEDGING ---
+# After AI_BREAKER_FAILURES consecutive failed (or too slow) calls a provider's
+# circuit opens and calls fail at once for AI_BREAKER_RESET_SECONDS; then one
+# probe call is let through and its outcome closes or re-opens the circuit.
+AI_BREAKER_ENABLED = os.environ.get('AI_BREAKER_ENABLED', 'True') == 'True'
+AI_BREAKER_FAILURES = int(os.environ.get('AI_BREAKER_FAILURES', '5'))
+AI_BREAKER_RESET_SECONDS = float(os.environ.get('AI_BREAKER_RESET_SECONDS', '30'))
+# Calls slower than this count as failures (0 turns it off).
+AI_BREAKER_SLOW_CALL_SECONDS = float(os.environ.get('AI_BREAKER_SLOW_CALL_SECONDS', '60'))
+# Hedged requests: if a single-answer call hasn't replied by the provider's
+# recent p95 latency, a second identical request is sent and the first reply wins.
+AI_HEDGING = os.environ.get('AI_HEDGING', 'False') == 'True'
+AI_HEDGE_PERCENTILE = float(os.environ.get('AI_HEDGE_PERCENTILE', '95'))
+# Used until enough calls have been timed to estimate the percentile.
+AI_HEDGE_DEFAULT_DELAY = float(os.environ.get('AI_HEDGE_DEFAULT_DELAY', '10.0'))
+AI_HEDGE_MIN_SAMPLES = int(os.environ.get('AI_HEDGE_MIN_SAMPLES', '20'))
+
+# --- AI EVALUATION CACHE ---
+# Where cached evaluations live: 'db' for the EvaluationCacheEntry table, the
+# name of an entry in CACHES to use a Django cache backend, or 'off'.
+EVALUATION_CACHE_BACKEND = os.environ.get('EVALUATION_CACHE_BACKEND', 'db')
+# Entries older than this are treated as misses and removed.
+EVALUATION_CACHE_TTL = int(os.environ.get('EVALUATION_CACHE_TTL', str(30 * 24 * 60 * 60)))
+# The 'db' store evicts the least recently used entries above this size.
+EVALUATION_CACHE_MAX_ENTRIES = int(os.environ.get('EVALUATION_CACHE_MAX_ENTRIES', '10000'))
+# The 'db' store evicts once every this many writes per process; 0 leaves it
+# to `manage.py prune_evaluation_cache` (e.g. from cron).
+EVALUATION_CACHE_EVICT_EVERY = int(os.environ.get('EVALUATION_CACHE_EVICT_EVERY', '200'))
+
+# --- ANSWER IMAGE PREPROCESSING ---
+# New answer uploads are oriented, straightened, cropped, converted to
+# grayscale, downscaled and recompressed before they are stored and OCR'd.
+PREPROCESS_UPLOADS = os.environ.get('PREPROCESS_UPLOADS', 'True') == 'True'
+# Longest side in pixels. Larger than this doesn't improve handwriting OCR.
+OCR_MAX_DIMENSION = int(os.environ.get('OCR_MAX_DIMENSION', '2400'))
+OCR_IMAGE_FORMAT = os.environ.get('OCR_IMAGE_FORMAT', 'JPEG')  # or 'WEBP'
+OCR_IMAGE_QUALITY = int(os.environ.get('OCR_IMAGE_QUALITY', '85'))
+# Also store the untouched upload in StudentAnswer.original_image.
+KEEP_ORIGINAL_UPLOADS = os.environ.get('KEEP_ORIGINAL_UPLOADS', 'False') == 'True'
+
+# --- ANSWER SCRIPTS ---
+# A whole script (PDF or photos) uploaded at once is split into answers at
+# its question markers; see api/scripts.py.
+SCRIPT_MAX_PAGES = int(os.environ.get('SCRIPT_MAX_PAGES', '40'))
+
+# --- BULK UPLOADS ---
+# A ZIP or tar of a whole class's scans; see api/bulk_upload.py.
+BULK_UPLOAD_MAX_FILES = int(os.environ.get('BULK_UPLOAD_MAX_FILES', '2000'))
+BULK_UPLOAD_MAX_FILE_BYTES = int(os.environ.get('BULK_UPLOAD_MAX_FILE_BYTES', str(20 * 1024 * 1024)))
+# Threads preprocessing scans and writing them to storage.
+BULK_UPLOAD_WORKERS = int(os.environ.get('BULK_UPLOAD_WORKERS', '4'))
+
+# --- MARKING PRINCIPLES RETRIEVAL ---
+# Long principles documents are cut down to the sections that best match each
+# question's marking scheme (BM25) before they go into a grading prompt.
+PRINCIPLES_RETRIEVAL = os.environ.get('PRINCIPLES_RETRIEVAL', 'True') == 'True'
+PRINCIPLES_TOP_K = int(os.environ.get('PRINCIPLES_TOP_K', '5'))
+# Documents under this many (estimated) tokens are always sent whole.
+PRINCIPLES_TOKEN_BUDGET = int(os.environ.get('PRINCIPLES_TOKEN_BUDGET', '1500'))
+
+# --- OCR ENGINES ---
+# Default engine: 'vision', 'tesseract' (offline) or 'local-first' (Tesseract,
+# with Google Vision for pages it reads below OCR_LOCAL_MIN_CONFIDENCE).
+# Tests can override it, and so can a single request with ?engine=.
+OCR_ENGINE = os.environ.get('OCR_ENGINE', 'vision')
+OCR_LOCAL_MIN_CONFIDENCE = float(os.environ.get('OCR_LOCAL_MIN_CONFIDENCE', '80'))
+# Tesseract processes run at once when reading many pages.
+OCR_LOCAL_WORKERS = int(os.environ.get('OCR_LOCAL_WORKERS', str(os.cpu_count() or 1)))
+TESSERACT_LANG = os.environ.get('TESSERACT_LANG', 'eng')
+TESSERACT_CMD = os.environ.get('TESSERACT_CMD', '')  # Path to the binary if it isn't on PATH
+
+# --- IMAGE RENDITIONS ---
+# Downsized copies of answer and question images (longest side in pixels),
+# stored next to the original and served through /api/renditions/.
+IMAGE_RENDITIONS = {'thumb': 200, 'preview': 1024}
+# Generate renditions right after upload; otherwise they're made on first request.
+RENDITIONS_ON_UPLOAD = os.environ.get('RENDITIONS_ON_UPLOAD', 'True') == 'True'
+# Rendition URLs carry a version of the original's name, so they can be cached for long.
+RENDITION_CACHE_SECONDS = int(os.environ.get('RENDITION_CACHE_SECONDS', str(30 * 24 * 60 * 60)))
+
+# --- DIRECT UPLOADS ---
+# Answer images PUT straight to storage through a presigned URL; see api/direct_uploads.py.
+DIRECT_UPLOAD_EXPIRY_SECONDS = int(os.environ.get('DIRECT_UPLOAD_EXPIRY_SECONDS', '900'))
+DIRECT_UPLOAD_MAX_BYTES = int(os.environ.get('DIRECT_UPLOAD_MAX_BYTES', str(20 * 1024 * 1024)))
+# Connections in the storage client shared by OCR and upload checks (S3 only;
+# see AWS_S3_CLIENT_CONFIG below).
+STORAGE_MAX_POOL_CONNECTIONS = int(os.environ.get('STORAGE_MAX_POOL_CONNECTIONS', '50'))
+
+# --- MODEL ANSWER GENERATION ---
+# The question image is sent to Gemini from the upload itself and is never
+# written to storage. Gemini takes it inline, so it is read whole into memory
+# for the request; larger images than this are refused before reading.
+MODEL_ANSWER_IMAGE_MAX_BYTES = int(os.environ.get('MODEL_ANSWER_IMAGE_MAX_BYTES', str(20 * 1024 * 1024)))
+
+# --- MODEL ANSWER REUSE ---
+# Generated model answers are cached, and the answers of similar saved
+# questions are offered as suggestions; see api/model_answers.py. The cache
+# is separate from the evaluation cache: 'db' or the name of an entry in
+# CACHES, with its own size limit and TTL.
+MODEL_ANSWER_CACHE = os.environ.get('MODEL_ANSWER_CACHE', 'True') == 'True'
+MODEL_ANSWER_CACHE_BACKEND = os.environ.get('MODEL_ANSWER_CACHE_BACKEND', 'db')
+MODEL_ANSWER_CACHE_TTL = int(os.environ.get('MODEL_ANSWER_CACHE_TTL', str(180 * 24 * 60 * 60)))
+MODEL_ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get('MODEL_ANSWER_CACHE_MAX_ENTRIES', '5000'))
+MODEL_ANSWER_SUGGESTIONS = int(os.environ.get('MODEL_ANSWER_SUGGESTIONS', '5'))
+# Cosine similarity (0-1) of question text and marking scheme needed to be suggested.
+MODEL_ANSWER_SUGGESTION_MIN_SIMILARITY = float(os.environ.get('MODEL_ANSWER_SUGGESTION_MIN_SIMILARITY', '0.3'))
+# Seconds before a process rebuilds its question index anyway, to pick up
+# changes that send no signals (bulk updates, raw SQL).
+MODEL_ANSWER_INDEX_MAX_AGE = int(os.environ.get('MODEL_ANSWER_INDEX_MAX_AGE', '300'))
+
 # --- STORAGE CONFIGURATION (Local vs. Production) ---
 # Check if we are running on Render (production)
 if os.environ.get('RENDER'):
@@ -144,6 +316,12 @@ if os.environ.get('RENDER'):
     AWS_SECRET_ACCESS_KEY = SUPABASE_KEY
     AWS_STORAGE_BUCKET_NAME = SUPABASE_BUCKET
     AWS_S3_FILE_OVERWRITE = False
+    # Stored names never change content (new uploads get new names), so let browsers cache them.
+    AWS_S3_OBJECT_PARAMETERS = {'CacheControl': f'public, max-age={RENDITION_CACHE_SECONDS}'}
+    # django-storages' default client options, with a connection pool big
+    # enough for the OCR and upload threads sharing the client (api/storage_io.py).
+    from botocore.config import Config
+    AWS_S3_CLIENT_CONFIG = Config(s3={'addressing_style': None}, max_pool_connections=STORAGE_MAX_POOL_CONNECTIONS)
 # else: (For local development)
 # Django's default FileSystemStorage will be used automatically for media files.
 # Whitenoise's runserver_nostatic will handle static files.
@@ -1,11 +1,24 @@
 # backend/core/admin.py
 
 from django.contrib import admin
-from .models import Class, Student, Test, Question, StudentAnswer, MarkingPrinciple
+from .models import (Class, Student, Test, Question, StudentAnswer, MarkingPrinciple,
+                     MarkingPrincipleChunk, MarkingJob, GradingJob, EvaluationCacheEntry, OcrCacheEntry,
+                     RateLimitBucket, ConcurrencySlot, ProviderCircuit, IndexVersion,
+                     CacheLookupStats)
 
 admin.site.register(Class)
 admin.site.register(Student)
 admin.site.register(Test)
 admin.site.register(Question)
 admin.site.register(StudentAnswer)
-admin.site.register(MarkingPrinciple)
\ No newline at end of file
+admin.site.register(MarkingPrinciple)
+admin.site.register(MarkingPrincipleChunk)
+admin.site.register(MarkingJob)
+admin.site.register(GradingJob)
+admin.site.register(EvaluationCacheEntry)
+admin.site.register(OcrCacheEntry)
+admin.site.register(RateLimitBucket)
+admin.site.register(ConcurrencySlot)
+admin.site.register(ProviderCircuit)
+admin.site.register(IndexVersion)
+admin.site.register(CacheLookupStats)
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 20:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_ocr_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='markingjob',
+            name='batched',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.5 on 2026-10-18 20:36
+
+from django.db import migrations, models
+
+
+def backfill_question_totals(apps, schema_editor):
+    Test = apps.get_model('core', 'Test')
+    Question = apps.get_model('core', 'Question')
+    totals = (
+        Question.objects.values('test_id')
+        .annotate(total=models.Sum('max_mark'), count=models.Count('id'))
+    )
+    for row in totals:
+        Test.objects.filter(pk=row['test_id']).update(
+            total_max_mark=row['total'] or 0, question_count=row['count']
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_markingjob_batched'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='test',
+            name='question_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='test',
+            name='total_max_mark',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_question_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.5 on 2026-10-18 20:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_test_question_totals'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='studentanswer',
+            index=models.Index(fields=['question', 'is_evaluated'], name='core_studen_questio_a29900_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='studentanswer',
+            index=models.Index(fields=['student', 'question'], name='core_studen_student_87fc3a_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 20:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_studentanswer_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='studentanswer',
+            name='original_image',
+            field=models.ImageField(blank=True, null=True, upload_to='student_answers/originals/'),
+        ),
+    ]
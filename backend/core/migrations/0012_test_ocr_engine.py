@@ -0,0 +1,32 @@
+# Generated by Django 5.2.5 on 2026-10-18 20:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_studentanswer_original_image'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ocrcacheentry',
+            name='engine',
+            field=models.CharField(blank=True, max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='ocrcacheentry',
+            name='image_sha256',
+            field=models.CharField(max_length=64),
+        ),
+        migrations.AlterUniqueTogether(
+            name='ocrcacheentry',
+            unique_together={('image_sha256', 'engine')},
+        ),
+        migrations.AddField(
+            model_name='test',
+            name='ocr_engine',
+            field=models.CharField(blank=True, choices=[('vision', 'Google Vision'), ('tesseract', 'Tesseract (offline)'), ('local-first', 'Tesseract, Google Vision when unsure')], default='', max_length=20),
+        ),
+    ]
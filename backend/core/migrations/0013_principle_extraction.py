@@ -0,0 +1,53 @@
+# Generated by Django 5.2.5 on 2026-10-18 20:43
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def mark_existing_extractions(apps, schema_editor):
+    # Principles extracted before this migration keep their text; only their
+    # page chunks are missing, which `manage.py reextract_principles` fills in.
+    MarkingPrinciple = apps.get_model('core', 'MarkingPrinciple')
+    MarkingPrinciple.objects.exclude(extracted_text__isnull=True).exclude(extracted_text="").update(
+        extraction_status='finished'
+    )
+    MarkingPrinciple.objects.filter(extracted_text__startswith="Error:").update(extraction_status='failed')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_test_ocr_engine'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='markingprinciple',
+            name='extraction_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('finished', 'Finished'), ('failed', 'Failed')], default='pending', editable=False, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='markingprinciple',
+            name='page_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='markingprinciple',
+            name='pages_extracted',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.CreateModel(
+            name='MarkingPrincipleChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('page_number', models.PositiveIntegerField()),
+                ('text', models.TextField(blank=True)),
+                ('principle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='core.markingprinciple')),
+            ],
+            options={
+                'ordering': ['principle', 'page_number'],
+                'unique_together': {('principle', 'page_number')},
+            },
+        ),
+        migrations.RunPython(mark_existing_extractions, migrations.RunPython.noop),
+    ]
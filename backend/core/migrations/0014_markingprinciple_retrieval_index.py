@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 20:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_principle_extraction'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='markingprinciple',
+            name='retrieval_index',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.5 on 2026-10-18 20:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_markingprinciple_retrieval_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='studentanswer',
+            name='evaluation_latency_ms',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='studentanswer',
+            name='input_tokens',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='studentanswer',
+            name='output_tokens',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.5 on 2026-10-18 20:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_studentanswer_ai_usage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RateLimitBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=100, unique=True)),
+                ('level', models.FloatField()),
+                ('updated_at', models.FloatField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ConcurrencySlot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('provider', models.CharField(max_length=50)),
+                ('number', models.PositiveIntegerField()),
+                ('held_until', models.FloatField(default=0)),
+            ],
+            options={
+                'unique_together': {('provider', 'number')},
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.5 on 2026-10-18 20:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_ai_rate_limits'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProviderCircuit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('provider', models.CharField(max_length=50, unique=True)),
+                ('state', models.CharField(choices=[('closed', 'Closed'), ('open', 'Open'), ('half_open', 'Half open')], default='closed', max_length=20)),
+                ('consecutive_failures', models.PositiveIntegerField(default=0)),
+                ('blocked_until', models.FloatField(default=0)),
+                ('calls', models.PositiveBigIntegerField(default=0)),
+                ('failures', models.PositiveBigIntegerField(default=0)),
+                ('short_circuits', models.PositiveBigIntegerField(default=0)),
+                ('hedges_sent', models.PositiveBigIntegerField(default=0)),
+                ('hedges_won', models.PositiveBigIntegerField(default=0)),
+                ('times_opened', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.5 on 2026-10-18 21:33
+
+from django.db import migrations, models
+
+
+def move_model_answers(apps, schema_editor):
+    # Cached model answers were stored alongside evaluations; they are the
+    # only entries whose result has a model_answer.
+    EvaluationCacheEntry = apps.get_model('core', 'EvaluationCacheEntry')
+    EvaluationCacheEntry.objects.filter(result__has_key='model_answer').update(namespace='model_answer')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_provider_circuit'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='evaluationcacheentry',
+            name='namespace',
+            field=models.CharField(choices=[('evaluation', 'Evaluation'), ('model_answer', 'Model answer')], default='evaluation', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='evaluationcacheentry',
+            index=models.Index(fields=['namespace', 'last_used_at'], name='core_evalua_namespa_3022a1_idx'),
+        ),
+        migrations.RunPython(move_model_answers, migrations.RunPython.noop),
+    ]
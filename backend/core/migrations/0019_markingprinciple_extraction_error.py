@@ -0,0 +1,30 @@
+# Generated by Django 5.2.5 on 2026-10-18 22:00
+
+from django.db import migrations, models
+
+
+def drop_stored_text(apps, schema_editor):
+    # Principles whose pages are stored as chunks no longer keep the whole
+    # text; failed extractions kept their error message there.
+    MarkingPrinciple = apps.get_model('core', 'MarkingPrinciple')
+    MarkingPrinciple.objects.filter(chunks__isnull=False).distinct().update(extracted_text=None)
+    for principle in MarkingPrinciple.objects.filter(extraction_status='failed', extracted_text__startswith="Error: "):
+        principle.extraction_error = principle.extracted_text[len("Error: "):]
+        principle.extracted_text = None
+        principle.save(update_fields=['extraction_error', 'extracted_text'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_evaluation_cache_namespace'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='markingprinciple',
+            name='extraction_error',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.RunPython(drop_stored_text, migrations.RunPython.noop),
+    ]
@@ -1,6 +1,8 @@
 # backend/core/models.py
 
+import hashlib
 from django.db import models
+from django.db.models.functions import Length
 
 class Class(models.Model):
     name = models.CharField(max_length=100)
@@ -16,14 +18,56 @@ class Student(models.Model):
         return self.name
     
 class MarkingPrinciple(models.Model):
+    EXTRACTION_STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('finished', 'Finished'),
+        ('failed', 'Failed'),
+    ]
+
     name = models.CharField(max_length=200, unique=True)
     pdf_file = models.FileField(upload_to='marking_principles/')
-    # This field will store the extracted text for quick AI access
+    # Only principles extracted before pages were stored as chunks keep their
+    # text here; read it with full_text().
     extracted_text = models.TextField(blank=True, null=True, editable=False)
+    # Text extraction runs in the background after upload (see core/principles.py).
+    extraction_status = models.CharField(max_length=20, choices=EXTRACTION_STATUS_CHOICES,
+                                         default='pending', editable=False)
+    page_count = models.PositiveIntegerField(default=0, editable=False)
+    pages_extracted = models.PositiveIntegerField(default=0, editable=False)
+    # BM25 index over the extracted sections (core/retrieval.py), rebuilt with each extraction.
+    retrieval_index = models.JSONField(blank=True, null=True, editable=False)
+    # Why the last extraction failed.
+    extraction_error = models.TextField(blank=True, default='', editable=False)
 
     def __str__(self):
         return self.name
 
+    def full_text(self):
+        """The whole extracted text, joined from the page chunks when it is needed."""
+        pages = self.chunks.values_list('text', flat=True)
+        if not pages.exists():
+            return self.extracted_text or ""
+        return "".join(f"{text}\n" for text in pages.iterator())
+
+    def text_length(self):
+        """Length of full_text(), counted by the database without loading the pages."""
+        length = self.chunks.aggregate(length=models.Sum(Length('text')) + models.Count('id'))['length']
+        return length if length is not None else len(self.extracted_text or "")
+
+class MarkingPrincipleChunk(models.Model):
+    """The text of one page of a marking principle PDF."""
+    principle = models.ForeignKey(MarkingPrinciple, on_delete=models.CASCADE, related_name='chunks')
+    page_number = models.PositiveIntegerField()
+    text = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['principle', 'page_number']
+        unique_together = ('principle', 'page_number')
+
+    def __str__(self):
+        return f"{self.principle.name}, page {self.page_number}"
+
 class Test(models.Model):
     class_group = models.ForeignKey(Class, on_delete=models.CASCADE, related_name='tests')
     name = models.CharField(max_length=200)
@@ -35,10 +79,32 @@ class Test(models.Model):
         blank=True, 
         null=True
     )
+    # Kept up to date by the Question save/delete signals so listings don't
+    # need a SUM per test. `manage.py check_test_totals` verifies them.
+    total_max_mark = models.PositiveIntegerField(default=0, editable=False)
+    question_count = models.PositiveIntegerField(default=0, editable=False)
+    # Which OCR engine reads this test's answers; blank uses the OCR_ENGINE setting.
+    ocr_engine = models.CharField(max_length=20, blank=True, default="", choices=[
+        ('vision', 'Google Vision'),
+        ('tesseract', 'Tesseract (offline)'),
+        ('local-first', 'Tesseract, Google Vision when unsure'),
+    ])
     
     def __str__(self):
         return f"{self.name} ({self.class_group.name})"
 
+    @classmethod
+    def refresh_question_totals(cls, *test_ids):
+        """Recomputes total_max_mark and question_count for the given tests from their questions."""
+        totals = {
+            row['test_id']: row for row in
+            Question.objects.filter(test_id__in=test_ids).values('test_id')
+            .annotate(total=models.Sum('max_mark'), count=models.Count('id'))
+        }
+        for test_id in test_ids:
+            row = totals.get(test_id, {'total': 0, 'count': 0})
+            cls.objects.filter(pk=test_id).update(total_max_mark=row['total'] or 0, question_count=row['count'])
+
 class Question(models.Model):
     test = models.ForeignKey(Test, on_delete=models.CASCADE, related_name='questions')
     q_number = models.PositiveIntegerField()
@@ -59,15 +125,247 @@ class StudentAnswer(models.Model):
     question = models.ForeignKey(Question, on_delete=models.CASCADE)
     student = models.ForeignKey(Student, on_delete=models.CASCADE)
     uploaded_image = models.ImageField(upload_to='student_answers/')
+    # The camera upload as received, kept only when KEEP_ORIGINAL_UPLOADS is on;
+    # uploaded_image then holds the smaller preprocessed copy.
+    original_image = models.ImageField(upload_to='student_answers/originals/', blank=True, null=True)
     ocr_text = models.TextField(blank=True, null=True, help_text="AI recognized text from handwriting.")
     mark_gained = models.FloatField(default=0)
     ai_evaluation_summary = models.TextField(blank=True, null=True, help_text="AI comparison summary.")
     ai_strength_points = models.TextField(blank=True, null=True)
     ai_improvement_points = models.TextField(blank=True, null=True)
     is_evaluated = models.BooleanField(default=False)
+    # SHA-256 of uploaded_image, filled in when a new image is saved. Keys the OCR cache.
+    image_sha256 = models.CharField(max_length=64, blank=True, default="", editable=False, db_index=True)
+    # Cost of the last paid AI evaluation: Gemini tokens and how long the call
+    # took. A cache hit leaves them alone; they are 0 only when the answer's
+    # evaluation has only ever come from the evaluation cache.
+    input_tokens = models.PositiveIntegerField(blank=True, null=True, editable=False)
+    output_tokens = models.PositiveIntegerField(blank=True, null=True, editable=False)
+    evaluation_latency_ms = models.FloatField(blank=True, null=True, editable=False)
 
     class Meta:
         unique_together = ('question', 'student')
+        # Serve the grid and "what's left to mark" queries without table scans.
+        indexes = [
+            models.Index(fields=['question', 'is_evaluated']),
+            models.Index(fields=['student', 'question']),
+        ]
+
+    def __str__(self):
+        return f"{self.student.name}'s answer to Q{self.question.q_number}"
+
+    def compute_image_hash(self):
+        """Hashes the uploaded image in chunks, whether it is a fresh upload or already stored."""
+        digest = hashlib.sha256()
+        image = self.uploaded_image
+        if image._committed:
+            with image.open('rb') as f:
+                for chunk in f.chunks():
+                    digest.update(chunk)
+        else:
+            # A new upload that hasn't been written to storage yet; leave it rewound for the save.
+            for chunk in image.file.chunks():
+                digest.update(chunk)
+            image.file.seek(0)
+        return digest.hexdigest()
+
+class OcrCacheEntry(models.Model):
+    """OCR text for an image, keyed by the SHA-256 of its bytes and the engine that read it."""
+    image_sha256 = models.CharField(max_length=64)
+    # An OCR engine name. Entries cached before engines were recorded have none
+    # and are never reused; prune_ocr_cache removes them in time.
+    engine = models.CharField(max_length=20, blank=True)
+    text = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        unique_together = ('image_sha256', 'engine')
+
+    def __str__(self):
+        return f"OCR {self.image_sha256[:12]}"
+
+
+class MarkingJob(models.Model):
+    """Tracks a bulk 'mark all answers' run for a test."""
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('finished', 'Finished'),
+        # Its worker stopped (usually a restart) before the job finished.
+        ('failed', 'Failed'),
+    ]
+
+    test = models.ForeignKey(Test, on_delete=models.CASCADE, related_name='marking_jobs')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    concurrency = models.PositiveIntegerField(default=1)
+    # Batched jobs grade every answer to a question in shared AI requests.
+    batched = models.BooleanField(default=False)
+    total = models.PositiveIntegerField(default=0)
+    done = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Touched every MARKING_JOB_HEARTBEAT_SECONDS while the job runs.
+    heartbeat_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    @property
+    def pending(self):
+        return max(self.total - self.done - self.failed, 0)
+
+    def __str__(self):
+        return f"Marking job #{self.pk} for {self.test.name} ({self.status})"
+
+
+class GradingJob(models.Model):
+    """A queued OCR or marking request for one answer, run by the grading worker."""
+    KIND_CHOICES = [
+        ('ocr', 'OCR'),
+        ('marking', 'Marking'),
+    ]
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('succeeded', 'Succeeded'),
+        ('failed', 'Failed'),
+        ('retried', 'Retried'),
+    ]
+
+    answer = models.ForeignKey(StudentAnswer, on_delete=models.CASCADE, related_name='grading_jobs')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    # Extra inputs for the job, e.g. the teacher's corrected text for marking.
+    payload = models.JSONField(default=dict, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    # A retried job waits until run_after before it can be claimed again.
+    run_after = models.DateTimeField(blank=True, null=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    # A running job belongs to its worker until lease_until. The worker renews
+    # the lease while it works; another worker reclaims the job once it expires.
+    lease_until = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['created_at']
+        indexes = [models.Index(fields=['status', 'created_at'])]
+
+    @property
+    def queue_seconds(self):
+        if self.started_at:
+            return (self.started_at - self.created_at).total_seconds()
+        return None
+
+    @property
+    def run_seconds(self):
+        if self.started_at and self.finished_at:
+            return (self.finished_at - self.started_at).total_seconds()
+        return None
+
+    def __str__(self):
+        return f"{self.get_kind_display()} job #{self.pk} for answer {self.answer_id} ({self.status})"
+
+
+class EvaluationCacheEntry(models.Model):
+    """A stored AI evaluation, keyed by a hash of the exact prompt and model name."""
+    NAMESPACE_CHOICES = [
+        ('evaluation', 'Evaluation'),
+        ('model_answer', 'Model answer'),
+    ]
+
+    key = models.CharField(max_length=64, unique=True)
+    # Each namespace has its own size limit, TTL and stats.
+    namespace = models.CharField(max_length=20, choices=NAMESPACE_CHOICES, default='evaluation')
+    model_name = models.CharField(max_length=100)
+    result = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    hit_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [models.Index(fields=['namespace', 'last_used_at'])]
+
+    def __str__(self):
+        return f"Evaluation {self.key[:12]} ({self.model_name})"
+
+
+class RateLimitBucket(models.Model):
+    """A token bucket shared by every process calling an AI provider (see api/ratelimit.py)."""
+    key = models.CharField(max_length=100, unique=True)
+    level = models.FloatField()
+    # Unix time of the last change; the bucket refills from here.
+    updated_at = models.FloatField()
+
+    def __str__(self):
+        return f"{self.key}: {self.level:.1f}"
+
+
+class ConcurrencySlot(models.Model):
+    """One of a provider's concurrent-call slots. A slot is free once held_until has passed."""
+    provider = models.CharField(max_length=50)
+    number = models.PositiveIntegerField()
+    # Unix time the current holder's lease ends, so a crashed worker can't keep a slot.
+    held_until = models.FloatField(default=0)
+
+    class Meta:
+        unique_together = ('provider', 'number')
+
+    def __str__(self):
+        return f"{self.provider} slot {self.number}"
+
+
+class ProviderCircuit(models.Model):
+    """
+    Circuit breaker state and call counters for one AI provider, shared by
+    every process (see api/resilience.py).
+    """
+    STATE_CHOICES = [
+        ('closed', 'Closed'),
+        ('open', 'Open'),
+        ('half_open', 'Half open'),
+    ]
+    provider = models.CharField(max_length=50, unique=True)
+    state = models.CharField(max_length=20, choices=STATE_CHOICES, default='closed')
+    consecutive_failures = models.PositiveIntegerField(default=0)
+    # Unix time until which calls are refused (open) or the probe's lease ends (half open).
+    blocked_until = models.FloatField(default=0)
+    calls = models.PositiveBigIntegerField(default=0)
+    failures = models.PositiveBigIntegerField(default=0)
+    short_circuits = models.PositiveBigIntegerField(default=0)
+    hedges_sent = models.PositiveBigIntegerField(default=0)
+    hedges_won = models.PositiveBigIntegerField(default=0)
+    times_opened = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.provider}: {self.state}"
+
+
+class IndexVersion(models.Model):
+    """
+    A version number for an index each process builds in memory, bumped when
+    its source data changes, so every process sees the change (see core/question_index.py).
+    """
+    name = models.CharField(max_length=50, unique=True)
+    version = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name} v{self.version}"
+
+
+class CacheLookupStats(models.Model):
+    """
+    Hit/miss counters for one cache namespace (see api/evaluation_cache.py),
+    shared by every process whatever backend the cache itself uses.
+    """
+    namespace = models.CharField(max_length=50, unique=True)
+    hits = models.PositiveBigIntegerField(default=0)
+    misses = models.PositiveBigIntegerField(default=0)
 
     def __str__(self):
-        return f"{self.student.name}'s answer to Q{self.question.q_number}"
\ No newline at end of file
+        return f"{self.namespace}: {self.hits} hits, {self.misses} misses"
@@ -0,0 +1,71 @@
+# backend/core/principles.py
+
+import logging
+import threading
+
+from django.db import connection, transaction
+from PyPDF2 import PdfReader
+
+from .models import MarkingPrinciple, MarkingPrincipleChunk
+from .retrieval import build_index, split_sections
+
+logger = logging.getLogger(__name__)
+
+# Pages written (and progress reported) per round trip.
+PAGES_PER_SAVE = 20
+
+
+def extract_principle(principle_id):
+    """
+    Reads the principle's PDF one page at a time, storing each page as a
+    MarkingPrincipleChunk, then builds the retrieval index. The whole text is
+    never held or stored; MarkingPrinciple.full_text() joins the pages when
+    asked. Progress is recorded in pages_extracted as it goes.
+    """
+    principle = MarkingPrinciple.objects.get(pk=principle_id)
+    principles = MarkingPrinciple.objects.filter(pk=principle_id)
+    MarkingPrincipleChunk.objects.filter(principle_id=principle_id).delete()
+    principles.update(extraction_status='running', pages_extracted=0, page_count=0, retrieval_index=None,
+                      extracted_text=None, extraction_error='')
+
+    chunks = []
+    try:
+        with principle.pdf_file.open('rb') as f:
+            # PdfReader parses pages lazily, so only the current page is held in memory.
+            reader = PdfReader(f)
+            page_count = len(reader.pages)
+            principles.update(page_count=page_count)
+            for page_number, page in enumerate(reader.pages, start=1):
+                page_text = page.extract_text() or ""
+                chunks.append(MarkingPrincipleChunk(principle_id=principle_id, page_number=page_number,
+                                                    text=page_text))
+                if len(chunks) >= PAGES_PER_SAVE:
+                    MarkingPrincipleChunk.objects.bulk_create(chunks)
+                    principles.update(pages_extracted=page_number)
+                    chunks = []
+        MarkingPrincipleChunk.objects.bulk_create(chunks)
+        principles.update(pages_extracted=page_count,
+                          retrieval_index=build_principle_index(principle_id), extraction_status='finished')
+        logger.info("Extracted %d pages of text from %s", page_count, principle.name)
+    except Exception as e:
+        logger.exception("Error extracting text from PDF for %s", principle.name)
+        principles.update(extraction_error=str(e), extraction_status='failed')
+
+def build_principle_index(principle_id):
+    """BM25 index over the sections of the principle's stored pages."""
+    pages = MarkingPrincipleChunk.objects.filter(principle_id=principle_id).values_list('page_number', 'text')
+    return build_index(split_sections(pages.iterator()))
+
+def start_extraction(principle):
+    """Extracts the principle's PDF on a background thread once the current transaction commits."""
+    thread = threading.Thread(target=_run_extraction, args=(principle.pk,),
+                              name=f"principle-extraction-{principle.pk}", daemon=True)
+    transaction.on_commit(thread.start)
+
+def _run_extraction(principle_id):
+    try:
+        extract_principle(principle_id)
+    except Exception:
+        logger.exception("Extraction of marking principle #%s failed", principle_id)
+    finally:
+        connection.close()
@@ -0,0 +1,174 @@
+# backend/core/question_index.py
+
+import hashlib
+import logging
+import math
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import F
+
+from .models import IndexVersion, Question
+from .retrieval import STOP_WORDS
+
+logger = logging.getLogger(__name__)
+
+# A TF-IDF index over the text and marking scheme of every question that
+# already has a model answer, so a teacher writing a question can be shown
+# the answers to similar questions from other classes and years. Plain
+# Python with an inverted index: only questions sharing a word with the query
+# are scored. It holds ids and term weights, not the answers themselves.
+#
+# Each process builds its own copy on first use. Saving or deleting a
+# question bumps the 'question_index' IndexVersion row, which every process
+# reads from the database; the index is also rebuilt
+# after MODEL_ANSWER_INDEX_MAX_AGE, for changes made by other processes or by
+# bulk updates that send no signals. Only the first build happens inside a
+# request: later rebuilds run in a background thread while requests keep
+# using the previous index.
+
+VERSION_NAME = 'question_index'
+# A rebuild reads every question (about 2s for 20,000), so while a test is
+# being edited the index is rebuilt at most this often.
+MIN_REBUILD_SECONDS = 5
+# Unlike principles retrieval, single letters and numbers are kept: "radius
+# 5 cm" and "radius 7 cm" are different questions.
+_word_re = re.compile(r"\w+")
+
+_index = None
+_index_lock = threading.Lock()
+_rebuilding = False
+
+
+def normalise_text(text):
+    """
+    Question text compared for exact reuse: Unicode-normalised, whitespace
+    collapsed. Case is kept: "pH" and "PH", or "Mg" and "mg", are different questions.
+    """
+    return " ".join(unicodedata.normalize('NFKC', text or "").split())
+
+def text_key(description, marking_scheme):
+    text = f"{normalise_text(description)}\0{normalise_text(marking_scheme)}"
+    return hashlib.sha256(text.encode('utf-8')).digest()
+
+def tokenize(text):
+    # Similarity search, unlike exact reuse, ignores case.
+    return [word for word in _word_re.findall(normalise_text(text).casefold()) if word not in STOP_WORDS]
+
+def has_model_answer(model_answer):
+    # Placeholders like "-" aren't worth suggesting.
+    return bool(tokenize(model_answer))
+
+
+class QuestionIndex:
+    """TF-IDF vectors of questions, with an inverted index for cosine similarity lookups."""
+
+    def __init__(self, questions, version=None):
+        """questions: (id, description, marking_scheme, has_image) for questions with a model answer."""
+        term_counts, document_frequency = {}, Counter()
+        self.has_image, self.exact = {}, {}
+        for question_id, description, marking_scheme, has_image in questions:
+            terms = Counter(tokenize(f"{description or ''}\n{marking_scheme or ''}"))
+            if not terms:
+                continue
+            term_counts[question_id] = terms
+            document_frequency.update(terms.keys())
+            self.has_image[question_id] = has_image
+            if not has_image:
+                # The newest question wins when the same text was saved more than once.
+                key = text_key(description, marking_scheme)
+                self.exact[key] = max(question_id, self.exact.get(key, 0))
+        self.count = len(term_counts)
+        self.idf = {term: self._idf(df) for term, df in document_frequency.items()}
+        self.postings, self.norms = defaultdict(list), {}
+        for question_id, terms in term_counts.items():
+            weights = self.weights(terms)
+            self.norms[question_id] = math.sqrt(sum(w * w for w in weights.values()))
+            for term, weight in weights.items():
+                self.postings[term].append((question_id, weight))
+        self.version = version
+        self.built_at = time.monotonic()
+
+    def _idf(self, df):
+        return math.log((self.count + 1) / (df + 1)) + 1
+
+    def weights(self, terms):
+        return {term: (1 + math.log(n)) * self.idf.get(term, self._idf(0)) for term, n in terms.items()}
+
+    def find_exact(self, description, marking_scheme):
+        """Id of a question without an image whose normalised text and scheme are identical, or None."""
+        return self.exact.get(text_key(description, marking_scheme))
+
+    def search(self, description, marking_scheme, limit, min_similarity, exclude=()):
+        """[(question id, cosine similarity)] of the most similar questions, best first."""
+        terms = Counter(tokenize(f"{description or ''}\n{marking_scheme or ''}"))
+        if not terms or not self.count:
+            return []
+        weights = self.weights(terms)
+        norm = math.sqrt(sum(w * w for w in weights.values()))
+        dots = defaultdict(float)
+        for term, weight in weights.items():
+            for question_id, document_weight in self.postings.get(term, ()):
+                dots[question_id] += weight * document_weight
+        scored = [
+            (dot / (norm * self.norms[question_id]), question_id)
+            for question_id, dot in dots.items() if question_id not in exclude
+        ]
+        # Newer questions first among equally similar ones.
+        scored = sorted((s for s in scored if s[0] >= min_similarity), key=lambda s: (-s[0], -s[1]))
+        return [(question_id, min(similarity, 1.0)) for similarity, question_id in scored[:limit]]
+
+
+def build_question_index(version=None):
+    rows = Question.objects.values_list('id', 'description', 'marking_scheme', 'model_answer', 'question_image')
+    return QuestionIndex(
+        ((question_id, description, marking_scheme, bool(image))
+         for question_id, description, marking_scheme, model_answer, image in rows.iterator(chunk_size=2000)
+         if has_model_answer(model_answer)),
+        version=version,
+    )
+
+def get_question_index():
+    """
+    This process's index. When questions changed or it's older than
+    MODEL_ANSWER_INDEX_MAX_AGE, a rebuild is started in the background and
+    the current index is returned meanwhile.
+    """
+    global _index, _rebuilding
+    version = IndexVersion.objects.filter(name=VERSION_NAME).values_list('version', flat=True).first()
+    with _index_lock:
+        if _index is None:
+            _index = build_question_index(version)
+            return _index
+        age = time.monotonic() - _index.built_at
+        stale = (age > settings.MODEL_ANSWER_INDEX_MAX_AGE
+                 or (_index.version != version and age > MIN_REBUILD_SECONDS))
+        if stale and not _rebuilding:
+            _rebuilding = True
+            threading.Thread(target=_rebuild_question_index, args=(version,),
+                             name="question-index-rebuild", daemon=True).start()
+        return _index
+
+def _rebuild_question_index(version):
+    global _index, _rebuilding
+    try:
+        index = build_question_index(version)
+        with _index_lock:
+            _index = index
+    except Exception:
+        logger.exception("Question index rebuild failed")
+    finally:
+        _rebuilding = False
+        connection.close()
+
+def invalidate_question_index():
+    versions = IndexVersion.objects.filter(name=VERSION_NAME)
+    if not versions.update(version=F('version') + 1):
+        # First change ever; another process may be creating the row too.
+        IndexVersion.objects.get_or_create(name=VERSION_NAME)
+        versions.update(version=F('version') + 1)
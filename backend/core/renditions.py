@@ -0,0 +1,61 @@
+# backend/core/renditions.py
+
+import io
+import os
+import traceback
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+
+def rendition_name(original_name, size):
+    """
+    Storage name of a rendition; it sits next to the original, e.g.
+    student_answers/renditions/scan.png_thumb.jpg. The original's extension
+    is kept, so scan.jpg and scan.png don't share (and overwrite) renditions.
+    """
+    directory, filename = os.path.split(original_name)
+    return f"{directory}/renditions/{filename}_{size}.jpg"
+
+def generate_rendition(field_file, size):
+    """Writes one rendition of the image to its storage and returns the storage name."""
+    storage = field_file.storage
+    name = rendition_name(field_file.name, size)
+    with field_file.storage.open(field_file.name, 'rb') as f:
+        image = ImageOps.exif_transpose(Image.open(f))
+        image = image.convert('L' if image.mode in ('L', 'LA', 'I', 'I;16') else 'RGB')
+    max_side = settings.IMAGE_RENDITIONS[size]
+    image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=80, optimize=True, progressive=True)
+    # Replace rather than let the storage pick a new name beside a stale copy.
+    if storage.exists(name):
+        storage.delete(name)
+    return storage.save(name, ContentFile(output.getvalue()))
+
+def generate_renditions(field_file):
+    """Generates every configured size. Failures are logged, not raised; the lazy view retries."""
+    for size in settings.IMAGE_RENDITIONS:
+        try:
+            generate_rendition(field_file, size)
+        except Exception:
+            traceback.print_exc()
+
+def delete_renditions(storage, original_name):
+    """Removes the renditions that belong to an original that was replaced or deleted."""
+    for size in settings.IMAGE_RENDITIONS:
+        name = rendition_name(original_name, size)
+        try:
+            if storage.exists(name):
+                storage.delete(name)
+        except Exception:
+            traceback.print_exc()
+
+def get_or_create_rendition_url(field_file, size):
+    """URL of the rendition, generating it first if it doesn't exist yet."""
+    name = rendition_name(field_file.name, size)
+    if not field_file.storage.exists(name):
+        name = generate_rendition(field_file, size)
+    return field_file.storage.url(name)
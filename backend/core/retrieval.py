@@ -0,0 +1,118 @@
+# backend/core/retrieval.py
+
+import math
+import re
+from collections import Counter
+
+# A BM25 index over the sections of a marking principles document, so a
+# prompt can carry the few sections relevant to a question instead of the
+# whole PDF. Plain Python: documents are a few hundred sections at most.
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Paragraphs are merged into sections of roughly this many words.
+SECTION_WORDS = 150
+INDEX_VERSION = 1
+
+STOP_WORDS = frozenset("""
+    a an and are as at be but by for from has have if in into is it its of on or
+    that the their then there these they this to was were will with which who
+    should must may can not no any all each per
+""".split())
+
+_word_re = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    return [word for word in _word_re.findall(text.lower()) if len(word) > 1 and word not in STOP_WORDS]
+
+def estimate_tokens(text):
+    # Same rough rule as api.services.estimate_tokens (about four characters per token).
+    return len(text) // 4 + 1
+
+def split_sections(pages, section_words=SECTION_WORDS):
+    """
+    Splits (page_number, text) pairs into sections: paragraphs merged up to
+    about section_words words, never across pages. PDF text often has no
+    blank lines, so an over-long paragraph is split into its lines.
+    """
+    sections = []
+    for page_number, text in pages:
+        current, current_words = [], 0
+        for paragraph in _paragraphs(text or "", section_words):
+            words = len(paragraph.split())
+            if current and current_words + words > section_words:
+                sections.append({'page': page_number, 'text': "\n".join(current)})
+                current, current_words = [], 0
+            current.append(paragraph)
+            current_words += words
+        if current:
+            sections.append({'page': page_number, 'text': "\n".join(current)})
+    return sections
+
+def _paragraphs(text, section_words):
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if len(paragraph.split()) > section_words:
+            yield from (line.strip() for line in paragraph.splitlines() if line.strip())
+        elif paragraph:
+            yield paragraph
+
+def build_index(sections):
+    """Term counts per section plus document frequencies; JSON-serialisable."""
+    indexed, document_frequency = [], Counter()
+    for section in sections:
+        term_counts = Counter(tokenize(section['text']))
+        document_frequency.update(term_counts.keys())
+        indexed.append({**section, 'terms': dict(term_counts), 'length': sum(term_counts.values())})
+    total_length = sum(section['length'] for section in indexed)
+    return {
+        'version': INDEX_VERSION,
+        'sections': indexed,
+        'df': dict(document_frequency),
+        'avgdl': total_length / len(indexed) if indexed else 0.0,
+    }
+
+def bm25_scores(index, query):
+    """Okapi BM25 score of every section for the query text."""
+    sections = index['sections']
+    count, avgdl = len(sections), index['avgdl'] or 1.0
+    query_terms = set(tokenize(query))
+    scores = []
+    for section in sections:
+        score = 0.0
+        length_norm = BM25_K1 * (1 - BM25_B + BM25_B * section['length'] / avgdl)
+        for term in query_terms:
+            frequency = section['terms'].get(term)
+            if not frequency:
+                continue
+            df = index['df'][term]
+            idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+            score += idf * frequency * (BM25_K1 + 1) / (frequency + length_norm)
+        scores.append(score)
+    return scores
+
+def select_sections(index, query, top_k, token_budget):
+    """
+    The top_k best-scoring sections that fit in token_budget, returned in
+    document order. Sections that don't match the query at all are left out.
+    """
+    scores = bm25_scores(index, query)
+    ranked = sorted((i for i, score in enumerate(scores) if score > 0), key=lambda i: -scores[i])
+    chosen, used = [], 0
+    for i in ranked:
+        if len(chosen) >= top_k:
+            break
+        tokens = estimate_tokens(index['sections'][i]['text'])
+        if used + tokens > token_budget:
+            continue
+        chosen.append(i)
+        used += tokens
+    return [index['sections'][i] for i in sorted(chosen)]
+
+def format_sections(sections):
+    parts = []
+    for section in sections:
+        heading = f"[Page {section['page']}] " if section.get('page') else ""
+        parts.append(f"{heading}{section['text']}")
+    return "\n...\n".join(parts)
@@ -1,28 +1,95 @@
 # backend/core/signals.py
 
-from django.db.models.signals import post_save
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
-from PyPDF2 import PdfReader
-from .models import MarkingPrinciple
+from .models import MarkingPrinciple, StudentAnswer, Question, Test
+from .principles import start_extraction
+from .question_index import invalidate_question_index
+from .renditions import delete_renditions, generate_renditions
+
+# Image fields that get thumbnail/preview renditions
+RENDITION_FIELDS = {StudentAnswer: 'uploaded_image', Question: 'question_image'}
+# Question fields the model answer index is built from.
+INDEXED_QUESTION_FIELDS = {'description', 'marking_scheme', 'model_answer', 'question_image'}
+
+@receiver(pre_save, sender=MarkingPrinciple)
+def reset_extraction_on_upload(sender, instance, **kwargs):
+    # A new or replaced PDF is uncommitted until this save writes it; its
+    # text has to be extracted again.
+    if instance.pdf_file and not instance.pdf_file._committed:
+        instance.extracted_text = None
+        instance.extraction_error = ""
+        instance.extraction_status = 'pending'
+        instance.page_count = instance.pages_extracted = 0
+        instance.retrieval_index = None
 
 @receiver(post_save, sender=MarkingPrinciple)
 def extract_text_from_pdf(sender, instance, created, **kwargs):
-    # This function runs every time a MarkingPrinciple is saved.
-    # We check if the extracted_text is empty or if the file has been re-uploaded.
-    
-    if instance.pdf_file and not instance.extracted_text:
-        text = ""
-        try:
-            # Open the PDF file from storage
-            with instance.pdf_file.open('rb') as f:
-                reader = PdfReader(f)
-                for page in reader.pages:
-                    text += page.extract_text() + "\n"
-            
-            # Update the instance without triggering the signal again to avoid a loop
-            MarkingPrinciple.objects.filter(pk=instance.pk).update(extracted_text=text)
-            print(f"Successfully extracted text from {instance.name}")
-
-        except Exception as e:
-            print(f"Error extracting text from PDF for {instance.name}: {e}")
-            MarkingPrinciple.objects.filter(pk=instance.pk).update(extracted_text=f"Error: {e}")
\ No newline at end of file
+    # Extraction can take a while for a long syllabus, so it runs in the
+    # background instead of holding up the admin or API save.
+    if instance.pdf_file and instance.extraction_status == 'pending':
+        start_extraction(instance)
+
+@receiver(pre_save, sender=StudentAnswer)
+def hash_uploaded_image(sender, instance, **kwargs):
+    # Only new uploads (create or PATCH with a new file) are uncommitted, so
+    # saves that don't touch the image skip the hashing.
+    if instance.uploaded_image and not instance.uploaded_image._committed:
+        instance.image_sha256 = instance.compute_image_hash()
+
+@receiver(pre_save, sender=Question)
+def remember_previous_test(sender, instance, **kwargs):
+    # If a question is moved to another test, both tests' totals change.
+    instance._previous_test_id = None
+    if instance.pk:
+        instance._previous_test_id = (
+            Question.objects.filter(pk=instance.pk).values_list('test_id', flat=True).first()
+        )
+
+@receiver(post_save, sender=Question)
+@receiver(post_delete, sender=Question)
+def update_test_totals(sender, instance, **kwargs):
+    test_ids = {instance.test_id, getattr(instance, '_previous_test_id', None)} - {None}
+    Test.refresh_question_totals(*test_ids)
+
+@receiver(post_save, sender=Question)
+@receiver(post_delete, sender=Question)
+def refresh_question_index(sender, instance, update_fields=None, **kwargs):
+    # Model answer suggestions search every question; have processes rebuild
+    # their index, unless the save only touched fields it doesn't use.
+    if update_fields is not None and not set(update_fields) & INDEXED_QUESTION_FIELDS:
+        return
+    invalidate_question_index()
+
+@receiver(pre_save, sender=StudentAnswer)
+@receiver(pre_save, sender=Question)
+def remember_replaced_image(sender, instance, **kwargs):
+    # A new upload is uncommitted until the save writes it; remember the file
+    # it replaces so that file's renditions can be removed afterwards.
+    field_name = RENDITION_FIELDS[sender]
+    image = getattr(instance, field_name)
+    instance._image_uploaded = bool(image) and not image._committed
+    instance._replaced_image_name = None
+    if instance._image_uploaded and instance.pk:
+        instance._replaced_image_name = (
+            sender.objects.filter(pk=instance.pk).values_list(field_name, flat=True).first()
+        )
+
+@receiver(post_save, sender=StudentAnswer)
+@receiver(post_save, sender=Question)
+def refresh_renditions(sender, instance, **kwargs):
+    image = getattr(instance, RENDITION_FIELDS[sender])
+    replaced = getattr(instance, '_replaced_image_name', None)
+    if replaced and replaced != image.name:
+        delete_renditions(image.storage, replaced)
+    if getattr(instance, '_image_uploaded', False) and settings.RENDITIONS_ON_UPLOAD:
+        transaction.on_commit(lambda: generate_renditions(image))
+
+@receiver(post_delete, sender=StudentAnswer)
+@receiver(post_delete, sender=Question)
+def remove_renditions(sender, instance, **kwargs):
+    image = getattr(instance, RENDITION_FIELDS[sender])
+    if image:
+        delete_renditions(image.storage, image.name)
@@ -1,3 +1,52 @@
-from django.test import TestCase
+import io
+import shutil
+import tempfile
 
-# Create your tests here.
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.test import TestCase, override_settings
+from PIL import Image
+
+from .renditions import delete_renditions, generate_rendition, rendition_name
+
+
+def image_file(color, image_format):
+    output = io.BytesIO()
+    Image.new('RGB', (300, 200), color).save(output, format=image_format)
+    return ContentFile(output.getvalue())
+
+
+@override_settings(IMAGE_RENDITIONS={'thumb': 50})
+class RenditionNameTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.storage = FileSystemStorage(location=self.media_root)
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def test_originals_sharing_a_stem_get_their_own_renditions(self):
+        jpeg_name = self.storage.save('student_answers/scan.jpg', image_file('red', 'JPEG'))
+        png_name = self.storage.save('student_answers/scan.png', image_file('blue', 'PNG'))
+        self.assertNotEqual(rendition_name(jpeg_name, 'thumb'), rendition_name(png_name, 'thumb'))
+
+        jpeg_file, png_file = self.field_file(jpeg_name), self.field_file(png_name)
+        jpeg_rendition = generate_rendition(jpeg_file, 'thumb')
+        png_rendition = generate_rendition(png_file, 'thumb')
+        self.assertEqual(jpeg_rendition, rendition_name(jpeg_name, 'thumb'))
+        self.assertEqual(png_rendition, rendition_name(png_name, 'thumb'))
+        self.assertTrue(self.is_red(jpeg_rendition))
+        self.assertFalse(self.is_red(png_rendition))
+
+        # Removing one original's renditions leaves the other's alone.
+        delete_renditions(self.storage, png_name)
+        self.assertFalse(self.storage.exists(png_rendition))
+        self.assertTrue(self.storage.exists(jpeg_rendition))
+
+    def field_file(self, name):
+        return type('FieldFile', (), {'storage': self.storage, 'name': name})()
+
+    def is_red(self, name):
+        with self.storage.open(name, 'rb') as f:
+            r, g, b = Image.open(f).convert('RGB').getpixel((10, 10))
+        return r > b